@@ -1,5 +1,5 @@
 
-from typing import List, Optional, Tuple, Dict
+from typing import List, Optional, Tuple, Dict, Union
 from dataclasses import dataclass
 
 
@@ -82,6 +82,11 @@ PickleableFPAMetadata = Tuple[PickleableIndexer,
                               PickleableFeaturesTokenMap]
 
 
+class FPAMetadataHandle:
+    def __init__(self, metadata: PickleableFPAMetadata) -> None:
+        ...
+
+
 def features_to_total_distances_tensors(args: DataloaderArgs,
                                         filename: str) -> \
         Tuple[TokenMap, List[List[int]], List[List[float]],
@@ -97,6 +102,29 @@ def features_to_total_distances_tensors_with_map(args: DataloaderArgs,
     ...
 
 
+ScrapedObligationTuple = Tuple[List[str], str]
+ScrapedTacticTuple = Tuple[List[str], List[str],
+                           Tuple[List[ScrapedObligationTuple],
+                                 List[ScrapedObligationTuple],
+                                 List[ScrapedObligationTuple],
+                                 List[ScrapedObligationTuple]],
+                           str]
+
+
+class ScrapedChunkStream:
+    def __iter__(self) -> "ScrapedChunkStream":
+        ...
+
+    def __next__(self) -> List[Union[str, ScrapedTacticTuple]]:
+        ...
+
+
+def scraped_chunks_from_file(filename: str,
+                             chunk_lines: int,
+                             tactics_only: bool) -> ScrapedChunkStream:
+    ...
+
+
 def scraped_tactics_from_file(filename: str,
                               filter_spec: str,
                               max_term_length: int,
@@ -138,7 +166,14 @@ def features_polyarg_tensors_with_meta(args: DataloaderArgs, filename: str,
     ...
 
 
-def sample_fpa(args: DataloaderArgs, metadata: PickleableFPAMetadata,
+def features_polyarg_tensors_to_npy(args: DataloaderArgs, filename: str,
+                                    meta: Optional[PickleableFPAMetadata],
+                                    out_dir: str) -> \
+    Tuple[PickleableFPAMetadata, Tuple[List[int], int]]:
+    ...
+
+
+def sample_fpa(args: DataloaderArgs, metadata: FPAMetadataHandle,
                relevant_lemmas: List[str],
                prev_tactics: List[str],
                hypotheses: List[str],
@@ -154,7 +189,7 @@ def sample_fpa(args: DataloaderArgs, metadata: PickleableFPAMetadata,
     ...
 
 
-def sample_fpa_batch(args: DataloaderArgs, metadata: PickleableFPAMetadata,
+def sample_fpa_batch(args: DataloaderArgs, metadata: FPAMetadataHandle,
                      context_batch: List[TacticContext]) -> \
                      Tuple[
                          List[List[List[int]]],
@@ -171,30 +206,94 @@ def get_fpa_words(s: str) -> List[str]:
     ...
 
 
-def decode_fpa_result(args: DataloaderArgs, metadata: PickleableFPAMetadata,
+def decode_fpa_result(args: DataloaderArgs, metadata: FPAMetadataHandle,
                       hyps: List[str], goal: str, tac_idx: int,
                       arg_idx: int) -> str:
     ...
 
 
+def decode_fpa_results(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                       hyps: List[str], goal: str,
+                       idxs: List[Tuple[int, int]]) -> List[str]:
+    ...
+
+
+def encode_fpa_actions(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                       hyps: List[str], goal: str,
+                       actions: List[Tuple[str, str]]) \
+                       -> List[Tuple[int, Optional[int]]]:
+    ...
+
+
+def decode_fpa_stem(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                    tac_idx: int) -> str:
+    ...
+
+
+def encode_fpa_stem(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                    tac_stem: str) -> int:
+    ...
+
+
+def decode_fpa_arg(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                   hyps: List[str], goal: str, arg_idx: int) -> str:
+    ...
+
+
+def encode_fpa_arg(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                   hyps: List[str], goal: str, arg: str) -> Optional[int]:
+    ...
+
+
+def tokenize(args: DataloaderArgs, metadata: FPAMetadataHandle,
+             term: str) -> List[int]:
+    ...
+
+
+def get_premise_features(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                         goal: str, premise: str) -> List[float]:
+    ...
+
+
+def get_premises_features(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                          goal: str, premises: List[str]) -> List[List[float]]:
+    ...
+
+
+def sample_contexts_features(args: DataloaderArgs,
+                             metadata: FPAMetadataHandle,
+                             contexts: List[TacticContext]) \
+                             -> Tuple[List[List[int]], List[List[float]]]:
+    ...
+
+
+def tokenize_batch(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                   terms: List[str]) -> List[List[int]]:
+    ...
+
+
+def get_premise_features_size(args: DataloaderArgs,
+                              metadata: FPAMetadataHandle) -> int:
+    ...
+
+
 def features_vocab_sizes(tmap: TokenMap) -> Tuple[List[int], int]:
     ...
 
 
-def get_num_tokens(metadata: PickleableFPAMetadata) -> int:
+def get_num_tokens(metadata: FPAMetadataHandle) -> int:
     ...
 
 
-def get_num_indices(metadata: PickleableFPAMetadata) -> \
-  Tuple[PickleableFPAMetadata, int]:
+def get_num_indices(metadata: FPAMetadataHandle) -> int:
     ...
 
 
-def get_word_feature_vocab_sizes(metadata: PickleableFPAMetadata) -> List[int]:
+def get_word_feature_vocab_sizes(metadata: FPAMetadataHandle) -> List[int]:
     ...
 
 
-def get_vec_features_size(metadata: PickleableFPAMetadata) -> int:
+def get_vec_features_size(metadata: FPAMetadataHandle) -> int:
     ...
 
 
@@ -247,7 +346,7 @@ def tactic_transitions_from_file(args: DataloaderArgs,
 def rust_parse_sexp_one_level(sexpstr: str) -> List[str]:
     ...
 
-def get_all_tactics(metadata: PickleableFPAMetadata) -> List[str]:
+def get_all_tactics(metadata: FPAMetadataHandle) -> List[str]:
     ...
-def get_token(metadata: PickleableFPAMetadata) -> List[str]:
+def get_tokens(metadata: FPAMetadataHandle) -> List[str]:
     ...
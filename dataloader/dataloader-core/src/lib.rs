@@ -28,6 +28,7 @@ mod context_filter;
 mod context_filter_ast;
 mod features;
 mod models;
+mod npy;
 mod paren_util;
 mod scraped_data;
 mod tokenizer;
@@ -44,6 +45,7 @@ use tokenizer::get_words;
 extern crate lazy_static;
 
 extern crate rayon;
+use rayon::prelude::*;
 #[pymodule]
 fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     #[pyfn(m)]
@@ -123,10 +125,20 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
         py.allow_threads(move || features_polyarg_tensors_rs(args, filename, Some(meta)))
     }
     #[pyfn(m)]
+    fn features_polyarg_tensors_to_npy(
+        py: Python,
+        args: DataloaderArgs,
+        filename: String,
+        meta: Option<PickleableFPAMetadata>,
+        out_dir: String,
+    ) -> PyResult<(PickleableFPAMetadata, (Vec<i64>, i64))> {
+        py.allow_threads(move || features_polyarg_tensors_to_npy_rs(args, filename, meta, out_dir))
+    }
+    #[pyfn(m)]
     fn sample_fpa_batch(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadataHandle,
         context_batch: Vec<TacticContext>,
     ) -> (
         LongUnpaddedTensor3D,
@@ -143,7 +155,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     fn sample_fpa(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadataHandle,
         relevant_lemmas: Vec<String>,
         prev_tactics: Vec<String>,
         hypotheses: Vec<String>,
@@ -170,26 +182,94 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     fn decode_fpa_result(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadataHandle,
         hyps: Vec<String>,
         goal: &str,
         tac_idx: i64,
         arg_idx: i64,
     ) -> String {
-        decode_fpa_result_rs(args, metadata, hyps, goal, tac_idx, arg_idx)
+        decode_fpa_result_rs(&args, metadata, &hyps, goal, tac_idx, arg_idx)
+    }
+    #[pyfn(m)]
+    fn decode_fpa_results(
+        py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadataHandle,
+        hyps: Vec<String>,
+        goal: String,
+        idxs: Vec<(i64, i64)>,
+    ) -> Vec<String> {
+        let metadata = metadata.shared();
+        py.allow_threads(move || decode_fpa_results_rs(&args, &metadata, &hyps, &goal, &idxs))
+    }
+    #[pyfn(m)]
+    fn encode_fpa_actions(
+        py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadataHandle,
+        hyps: Vec<String>,
+        goal: String,
+        actions: Vec<(String, String)>,
+    ) -> Vec<(i64, Option<i64>)> {
+        let metadata = metadata.shared();
+        py.allow_threads(move || encode_fpa_actions_rs(&args, &metadata, &hyps, &goal, &actions))
+    }
+    #[pyfn(m)]
+    fn sample_contexts_features(
+        py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadataHandle,
+        contexts: Vec<TacticContext>,
+    ) -> (LongTensor2D, FloatTensor2D) {
+        let metadata = metadata.shared();
+        py.allow_threads(move || {
+            contexts
+                .par_iter()
+                .map(|context| {
+                    sample_context_features_rs(
+                        &args,
+                        metadata.ftmap(),
+                        &context.relevant_lemmas,
+                        &context.prev_tactics,
+                        &context.obligation.hypotheses,
+                        &context.obligation.goal,
+                    )
+                })
+                .unzip()
+        })
+    }
+    #[pyfn(m)]
+    fn tokenize_batch(
+        py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadataHandle,
+        terms: Vec<String>,
+    ) -> LongTensor2D {
+        let metadata = metadata.shared();
+        py.allow_threads(move || tokenize_fpa_batch(&args, &metadata, &terms))
+    }
+    #[pyfn(m)]
+    fn get_premises_features(
+        py: Python,
+        _args: DataloaderArgs,
+        _metadata: &FPAMetadataHandle,
+        goal: String,
+        premises: Vec<String>,
+    ) -> FloatTensor2D {
+        py.allow_threads(move || get_premises_features_rs(&goal, &premises))
     }
     #[pyfn(m)]
     fn tokenize(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadataHandle,
         term: String) -> LongTensor1D {
         tokenize_fpa(args, metadata, term)
     }
     #[pyfn(m)]
     pub fn get_premise_features(
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadataHandle,
         goal: String,
         premise: String) -> FloatTensor1D {
         get_premise_features_rs(args, metadata, goal, premise)
@@ -197,14 +277,14 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     #[pyfn(m)]
     pub fn get_premise_features_size(
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata) -> i64 {
+        metadata: &FPAMetadataHandle) -> i64 {
         get_premise_features_size_rs(args, metadata)
     }
     #[pyfn(m)]
     fn decode_fpa_stem(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadataHandle,
         tac_idx: i64,
     ) -> String {
         decode_fpa_stem_rs(&args, metadata, tac_idx)
@@ -213,7 +293,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     fn encode_fpa_stem(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadataHandle,
         tac_stem: String,
     ) -> i64 {
         encode_fpa_stem_rs(&args, metadata, tac_stem)
@@ -222,60 +302,53 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     fn decode_fpa_arg(
         _py: Python,
         args: DataloaderArgs,
-        _metadata: PickleableFPAMetadata,
+        _metadata: &FPAMetadataHandle,
         hyps: Vec<String>,
         goal: &str,
         arg_idx: i64,
     ) -> String {
-        decode_fpa_arg_rs(&args, hyps, goal, arg_idx)
+        decode_fpa_arg_rs(&args, &hyps, goal, arg_idx)
     }
     #[pyfn(m)]
     fn encode_fpa_arg(
         _py: Python,
         args: DataloaderArgs,
-        _metadata: PickleableFPAMetadata,
+        _metadata: &FPAMetadataHandle,
         hyps: Vec<String>,
         goal: &str,
         arg: &str,
     ) -> Option<i64> {
-        match encode_fpa_arg_unbounded(&args, hyps, goal, arg) {
+        match encode_fpa_arg_unbounded(&args, &hyps, goal, arg) {
             Ok(val) => Some(val),
             Err(_err) => None
         }
     }
     #[pyfn(m)]
-    fn get_num_tokens(_py: Python, metadata: PickleableFPAMetadata) -> i64 {
-        let (_indexer, tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
-        tokenizer.num_tokens()
+    fn get_num_tokens(_py: Python, metadata: &FPAMetadataHandle) -> i64 {
+        metadata.tokenizer().num_tokens()
     }
     #[pyfn(m)]
-    fn get_tokens(_py: Python, metadata: PickleableFPAMetadata) -> Vec<String> {
-        let (_indexer, tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
-	tokenizer.tokens()
+    fn get_tokens(_py: Python, metadata: &FPAMetadataHandle) -> Vec<String> {
+	metadata.tokenizer().tokens()
     }
     #[pyfn(m)]
     fn fpa_get_num_possible_args(_py: Python, args: DataloaderArgs) -> i64 {
         fpa_get_num_possible_args_rs(&args)
     }
     #[pyfn(m)]
-    fn get_num_indices(_py: Python, metadata: PickleableFPAMetadata) -> (PickleableFPAMetadata, i64) {
-        let (mut indexer, tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
-        indexer.freeze();
-        let num_indices = indexer.num_indices();
-        (fpa_metadata_to_pickleable((indexer, tokenizer, ftmap)), num_indices)
+    fn get_num_indices(_py: Python, metadata: &FPAMetadataHandle) -> i64 {
+        metadata.num_indices()
     }
     #[pyfn(m)]
-    fn get_all_tactics(_py: Python, metadata: PickleableFPAMetadata) -> Vec<String> {
-	let (indexer, _, _) = fpa_metadata_from_pickleable(metadata);
-	indexer.get_all_tactics()
+    fn get_all_tactics(_py: Python, metadata: &FPAMetadataHandle) -> Vec<String> {
+	metadata.all_tactics()
     }
     #[pyfn(m)]
-    fn get_word_feature_vocab_sizes(_py: Python, metadata: PickleableFPAMetadata) -> Vec<i64> {
-        let (_indexer, _tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
-        ftmap.word_features_sizes()
+    fn get_word_feature_vocab_sizes(_py: Python, metadata: &FPAMetadataHandle) -> Vec<i64> {
+        metadata.ftmap().word_features_sizes()
     }
     #[pyfn(m)]
-    fn get_vec_features_size(_py: Python, _metadata: PickleableFPAMetadata) -> i64 {
+    fn get_vec_features_size(_py: Python, _metadata: &FPAMetadataHandle) -> i64 {
         VEC_FEATURES_SIZE
     }
     #[pyfn(m)]
@@ -332,6 +405,20 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
         ).map(|scraped| scraped.to_object(py)).collect())
     }
     #[pyfn(m)]
+    fn scraped_chunks_from_file(
+        _py: Python,
+        filename: String,
+        chunk_lines: usize,
+        tactics_only: bool,
+    ) -> PyResult<ScrapedChunkStream> {
+        Ok(ScrapedChunkStream::new(
+            File::open(filename)
+                .map_err(|_err| exceptions::PyValueError::new_err("Failed to open file"))?,
+            chunk_lines,
+            tactics_only,
+        ))
+    }
+    #[pyfn(m)]
     fn scraped_tactics_from_file(
         _py: Python,
         filename: String,
@@ -397,6 +484,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_wrapped(wrap_pyfunction!(sample_context_features))?;
     m.add_wrapped(wrap_pyfunction!(rust_parse_sexp_one_level))?;
     m.add_class::<TokenMap>()?;
+    m.add_class::<FPAMetadataHandle>()?;
     m.add_class::<DataloaderArgs>()?;
     m.add_class::<GoalEncMetadata>()?;
     m.add_class::<ScrapedTactic>()?;
@@ -404,5 +492,6 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_class::<ScrapedTransition>()?;
     m.add_class::<Obligation>()?;
     m.add_class::<TacticContext>()?;
+    m.add_class::<ScrapedChunkStream>()?;
     Ok(())
 }
@@ -6,11 +6,16 @@ use rand::Rng;
 use rayon::prelude::*;
 use regex::Regex;
 use serde::{Deserialize, Serialize};
+use std::collections::HashMap;
+use std::ops::Deref;
 use std::fs::File;
 use std::io::{Write, stdout};
+use std::path::Path;
+use std::sync::Arc;
 use indicatif::{ProgressBar, ProgressIterator, ParallelProgressIterator, ProgressStyle, ProgressFinish};
 
 use crate::context_filter::{parse_filter, apply_filter};
+use crate::npy::write_npy;
 use crate::features::PickleableTokenMap as PickleableFeaturesTokenMap;
 use crate::features::TokenMap as FeaturesTokenMap;
 use crate::features::*;
@@ -68,6 +73,96 @@ pub fn fpa_metadata_from_pickleable(pick: PickleableFPAMetadata) -> FPAMetadata
     )
 }
 
+/// The FPA metadata, unpacked once into its Rust structures so that the
+/// per-prediction entry points can borrow it instead of converting the whole
+/// pickleable form on every call.
+pub struct LoadedFPAMetadata {
+    indexer: OpenIndexer<String>,
+    tokenizer: Tokenizer,
+    ftmap: FeaturesTokenMap,
+    stems: HashMap<i64, String>,
+}
+
+/// The Python handle for LoadedFPAMetadata. The metadata is behind an Arc,
+/// so entry points that release the GIL can clone it into their closure
+/// instead of holding a borrow of the Python object.
+#[pyclass(module = "dataloader")]
+pub struct FPAMetadataHandle {
+    metadata: Arc<LoadedFPAMetadata>,
+}
+
+#[pymethods]
+impl FPAMetadataHandle {
+    #[new]
+    pub fn new(metadata: PickleableFPAMetadata) -> Self {
+        let (mut indexer, tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
+        // Nothing adds stems through a handle, so every unknown stem should
+        // look up to the same index.
+        indexer.freeze();
+        let stems = indexer.reverse_map();
+        FPAMetadataHandle {
+            metadata: Arc::new(LoadedFPAMetadata {
+                indexer,
+                tokenizer,
+                ftmap,
+                stems,
+            }),
+        }
+    }
+    fn __reduce__(&self, py: Python) -> (PyObject, (PickleableFPAMetadata,)) {
+        (
+            py.get_type::<FPAMetadataHandle>().to_object(py),
+            (self.metadata.to_pickleable(),),
+        )
+    }
+}
+
+impl FPAMetadataHandle {
+    pub fn shared(&self) -> Arc<LoadedFPAMetadata> {
+        self.metadata.clone()
+    }
+}
+
+impl Deref for FPAMetadataHandle {
+    type Target = LoadedFPAMetadata;
+    fn deref(&self) -> &LoadedFPAMetadata {
+        &self.metadata
+    }
+}
+
+impl LoadedFPAMetadata {
+    pub fn to_pickleable(&self) -> PickleableFPAMetadata {
+        fpa_metadata_to_pickleable((
+            self.indexer.clone(),
+            self.tokenizer.clone(),
+            self.ftmap.clone(),
+        ))
+    }
+    pub fn tokenizer(&self) -> &Tokenizer {
+        &self.tokenizer
+    }
+    pub fn ftmap(&self) -> &FeaturesTokenMap {
+        &self.ftmap
+    }
+    pub fn num_indices(&self) -> i64 {
+        self.indexer.num_indices()
+    }
+    pub fn all_tactics(&self) -> Vec<String> {
+        (1..self.indexer.num_indices())
+            .map(|i| self.decode_stem(i))
+            .collect()
+    }
+    pub fn encode_stem(&self, stem: &str) -> i64 {
+        self.indexer.peek(&stem.to_string())
+    }
+    pub fn decode_stem(&self, tac_idx: i64) -> String {
+        self.stems
+            .get(&tac_idx)
+            .expect("That token doesn't exist!")
+            .clone()
+    }
+}
+
 pub fn features_polyarg_tensors_rs(
     args: DataloaderArgs,
     filename: String,
@@ -266,6 +361,100 @@ pub fn features_polyarg_tensors_rs(
     ))
 }
 
+/// Like features_polyarg_tensors_rs, but writes each tensor into out_dir as a
+/// dense .npy file (hypotheses padded out to the largest count in the
+/// dataset), so python can memory-map them instead of building lists.
+pub fn features_polyarg_tensors_to_npy_rs(
+    args: DataloaderArgs,
+    filename: String,
+    metadata: Option<PickleableFPAMetadata>,
+    out_dir: String,
+) -> PyResult<(PickleableFPAMetadata, (Vec<i64>, i64))> {
+    let (
+        metadata,
+        (
+            tokenized_hyps,
+            hyp_features,
+            num_hyps,
+            tokenized_goals,
+            goal_masks,
+            word_features,
+            vec_features,
+            tactic_stem_indices,
+            arg_indices,
+        ),
+        sizes,
+    ) = features_polyarg_tensors_rs(args, filename, metadata)?;
+    let out_dir = Path::new(&out_dir);
+    let to_py_err = |err: std::io::Error| exceptions::PyIOError::new_err(err.to_string());
+    let num_samples = tokenized_goals.len();
+    let max_hyps = tokenized_hyps.iter().map(|hyps| hyps.len()).max().unwrap_or(0);
+    let hyp_length = tokenized_hyps.iter().flatten().next().map_or(0, |hyp| hyp.len());
+    let hyp_features_size = hyp_features.iter().flatten().next().map_or(0, |f| f.len());
+    fn row_width<T>(rows: &Vec<Vec<T>>) -> usize {
+        rows.first().map_or(0, |row| row.len())
+    }
+
+    write_npy(
+        &out_dir.join("tokenized_hyp_types.npy"),
+        &[num_samples, max_hyps, hyp_length],
+        tokenized_hyps.iter().flat_map(|hyps| {
+            hyps.iter()
+                .flatten()
+                .copied()
+                .chain(std::iter::repeat(0).take((max_hyps - hyps.len()) * hyp_length))
+        }),
+    )
+    .map_err(to_py_err)?;
+    write_npy(
+        &out_dir.join("hyp_features.npy"),
+        &[num_samples, max_hyps, hyp_features_size],
+        hyp_features.iter().flat_map(|features| {
+            features
+                .iter()
+                .flatten()
+                .map(|f| *f as f32)
+                .chain(std::iter::repeat(0.0).take((max_hyps - features.len()) * hyp_features_size))
+        }),
+    )
+    .map_err(to_py_err)?;
+    write_npy(&out_dir.join("num_hyps.npy"), &[num_samples], num_hyps)
+        .map_err(to_py_err)?;
+    write_npy(
+        &out_dir.join("tokenized_goals.npy"),
+        &[num_samples, row_width(&tokenized_goals)],
+        tokenized_goals.iter().flatten().copied(),
+    )
+    .map_err(to_py_err)?;
+    write_npy(
+        &out_dir.join("goal_masks.npy"),
+        &[num_samples, row_width(&goal_masks)],
+        goal_masks.iter().flatten().map(|b| *b as u8),
+    )
+    .map_err(to_py_err)?;
+    write_npy(
+        &out_dir.join("word_features.npy"),
+        &[num_samples, row_width(&word_features)],
+        word_features.iter().flatten().copied(),
+    )
+    .map_err(to_py_err)?;
+    write_npy(
+        &out_dir.join("vec_features.npy"),
+        &[num_samples, row_width(&vec_features)],
+        vec_features.iter().flatten().map(|f| *f as f32),
+    )
+    .map_err(to_py_err)?;
+    write_npy(
+        &out_dir.join("tactic_stem_indices.npy"),
+        &[num_samples],
+        tactic_stem_indices,
+    )
+    .map_err(to_py_err)?;
+    write_npy(&out_dir.join("arg_indices.npy"), &[num_samples], arg_indices)
+        .map_err(to_py_err)?;
+    Ok((metadata, sizes))
+}
+
 /// This function is for debugging purposes
 #[allow(dead_code)]
 pub fn lookup_hyp(premises: Vec<String>, hyp_name: &str) -> String {
@@ -298,18 +487,17 @@ fn get_goal_mask(goal: &str, max_length: usize) -> Vec<bool> {
 
 pub fn tokenize_fpa(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &LoadedFPAMetadata,
     term: String) -> LongTensor1D {
 
-    let (_indexer, tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
     normalize_sentence_length(
-        tokenizer.tokenize(&term),
+        metadata.tokenizer().tokenize(&term),
         args.max_length, 0)
 }
 
 pub fn get_premise_features_rs(
     _args: DataloaderArgs,
-    _metadata: PickleableFPAMetadata,
+    _metadata: &LoadedFPAMetadata,
     goal: String,
     premise: String) -> FloatTensor1D {
     let score = gestalt_ratio(&goal, get_hyp_type(&premise));
@@ -318,13 +506,13 @@ pub fn get_premise_features_rs(
 }
 pub fn get_premise_features_size_rs(
     _args: DataloaderArgs,
-    _metadata: PickleableFPAMetadata) -> i64 {
+    _metadata: &LoadedFPAMetadata) -> i64 {
     2
 }
 
 pub fn sample_fpa_batch_rs(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &LoadedFPAMetadata,
     context_batch: Vec<TacticContext>,
 ) -> (
     LongUnpaddedTensor3D,
@@ -335,13 +523,13 @@ pub fn sample_fpa_batch_rs(
     LongTensor2D,
     FloatTensor2D,
 ) {
-    let (_indexer, tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
+    let tokenizer = metadata.tokenizer();
     let (word_features_batch, vec_features_batch) = context_batch
         .iter()
         .map(|ctxt| {
             sample_context_features_rs(
                 &args,
-                &ftmap,
+                metadata.ftmap(),
                 &ctxt.relevant_lemmas,
                 &ctxt.prev_tactics,
                 &ctxt.obligation.hypotheses,
@@ -431,7 +619,7 @@ pub fn sample_fpa_batch_rs(
 
 pub fn sample_fpa_rs(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &LoadedFPAMetadata,
     relevant_lemmas: Vec<String>,
     prev_tactics: Vec<String>,
     hypotheses: Vec<String>,
@@ -445,10 +633,10 @@ pub fn sample_fpa_rs(
     LongTensor2D,
     FloatTensor2D,
 ) {
-    let (_indexer, tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
+    let tokenizer = metadata.tokenizer();
     let (word_features, vec_features) = sample_context_features_rs(
         &args,
-        &ftmap,
+        metadata.ftmap(),
         &relevant_lemmas,
         &prev_tactics,
         &hypotheses,
@@ -491,15 +679,15 @@ pub fn sample_fpa_rs(
 }
 
 pub fn decode_fpa_result_rs(
-    args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
-    premises: Vec<String>,
+    args: &DataloaderArgs,
+    metadata: &LoadedFPAMetadata,
+    premises: &[String],
     goal: &str,
     tac_idx: i64,
     arg_idx: i64,
 ) -> String {
-    let stem = decode_fpa_stem_rs(&args, metadata, tac_idx);
-    let arg = decode_fpa_arg_rs(&args, premises, goal, arg_idx);
+    let stem = decode_fpa_stem_rs(args, metadata, tac_idx);
+    let arg = decode_fpa_arg_rs(args, premises, goal, arg_idx);
     if arg == "" {
         format!("{}.", stem)
     } else {
@@ -507,27 +695,86 @@ pub fn decode_fpa_result_rs(
     }
 }
 
+pub fn decode_fpa_results_rs(
+    args: &DataloaderArgs,
+    metadata: &LoadedFPAMetadata,
+    premises: &[String],
+    goal: &str,
+    idxs: &[(i64, i64)],
+) -> Vec<String> {
+    idxs.iter()
+        .map(|(tac_idx, arg_idx)| {
+            decode_fpa_result_rs(args, metadata, premises, goal, *tac_idx, *arg_idx)
+        })
+        .collect()
+}
+
+pub fn encode_fpa_actions_rs(
+    args: &DataloaderArgs,
+    metadata: &LoadedFPAMetadata,
+    premises: &[String],
+    goal: &str,
+    actions: &[(String, String)],
+) -> Vec<(i64, Option<i64>)> {
+    actions
+        .iter()
+        .map(|(stem, arg)| {
+            (
+                metadata.encode_stem(stem),
+                encode_fpa_arg_unbounded(args, premises, goal, arg).ok(),
+            )
+        })
+        .collect()
+}
+
+pub fn get_premises_features_rs(goal: &str, premises: &[String]) -> FloatTensor2D {
+    premises
+        .par_iter()
+        .map(|premise| {
+            vec![
+                gestalt_ratio(goal, get_hyp_type(premise)),
+                equality_hyp_feature(premise, goal),
+            ]
+        })
+        .collect()
+}
+
+pub fn tokenize_fpa_batch(
+    args: &DataloaderArgs,
+    metadata: &LoadedFPAMetadata,
+    terms: &[String],
+) -> LongTensor2D {
+    terms
+        .par_iter()
+        .map(|term| {
+            normalize_sentence_length(
+                metadata.tokenizer().tokenize(term),
+                args.max_length,
+                0,
+            )
+        })
+        .collect()
+}
+
 pub fn decode_fpa_stem_rs(
     _args: &DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &LoadedFPAMetadata,
     tac_idx: i64,
 ) -> String {
-    let (indexer, _tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
-    indexer.reverse_lookup(tac_idx)
+    metadata.decode_stem(tac_idx)
 }
 
 pub fn encode_fpa_stem_rs(
     _args: &DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &LoadedFPAMetadata,
     tac_stem: String,
 ) -> i64 {
-    let (mut indexer, _tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
-    indexer.lookup(tac_stem)
+    metadata.encode_stem(&tac_stem)
 }
 
 pub fn decode_fpa_arg_rs(
     args: &DataloaderArgs,
-    premises: Vec<String>,
+    premises: &[String],
     goal: &str,
     arg_idx: i64,
 ) -> String {
@@ -598,7 +845,7 @@ pub fn fpa_get_num_possible_args_rs(
 
 pub fn encode_fpa_arg_unbounded(
     args: &DataloaderArgs,
-    hyps: Vec<String>,
+    hyps: &[String],
     goal: &str,
     arg: &str,
 ) -> Result<i64, String> {
@@ -0,0 +1,99 @@
+/* *********************************************************************** */
+//
+//    This file is part of Proverbot9001.
+//
+//    Proverbot9001 is free software: you can redistribute it and/or modify
+//    it under the terms of the GNU General Public License as published by
+//    the Free Software Foundation, either version 3 of the License, or
+//    (at your option) any later version.
+//
+//    Proverbot9001 is distributed in the hope that it will be useful,
+//    but WITHOUT ANY WARRANTY; without even the implied warranty of
+//    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+//    GNU General Public License for more details.
+//
+//    You should have received a copy of the GNU General Public License
+//    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+//
+//    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+//
+/* *********************************************************************** */
+
+// Just enough of the numpy .npy format (version 1.0) to write the dense
+// arrays the python side memory-maps with numpy.load(mmap_mode=...).
+
+use std::fs::File;
+use std::io::{self, BufWriter, Write};
+use std::path::Path;
+
+pub trait NpyElement {
+    const DESCR: &'static str;
+    fn write_le<W: Write>(&self, w: &mut W) -> io::Result<()>;
+}
+
+impl NpyElement for i64 {
+    const DESCR: &'static str = "<i8";
+    fn write_le<W: Write>(&self, w: &mut W) -> io::Result<()> {
+        w.write_all(&self.to_le_bytes())
+    }
+}
+
+impl NpyElement for f32 {
+    const DESCR: &'static str = "<f4";
+    fn write_le<W: Write>(&self, w: &mut W) -> io::Result<()> {
+        w.write_all(&self.to_le_bytes())
+    }
+}
+
+impl NpyElement for u8 {
+    const DESCR: &'static str = "|u1";
+    fn write_le<W: Write>(&self, w: &mut W) -> io::Result<()> {
+        w.write_all(&[*self])
+    }
+}
+
+pub fn write_npy<T, I>(path: &Path, shape: &[usize], data: I) -> io::Result<()>
+where
+    T: NpyElement,
+    I: IntoIterator<Item = T>,
+{
+    let shape_str = if shape.len() == 1 {
+        format!("({},)", shape[0])
+    } else {
+        format!(
+            "({})",
+            shape
+                .iter()
+                .map(|dim| dim.to_string())
+                .collect::<Vec<_>>()
+                .join(", ")
+        )
+    };
+    let mut header = format!(
+        "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}",
+        T::DESCR,
+        shape_str
+    );
+    // The magic string, version, and header length take ten bytes, and the
+    // header is padded with spaces so the data starts 64-byte aligned.
+    let unpadded_len = 10 + header.len() + 1;
+    header.push_str(&" ".repeat((64 - unpadded_len % 64) % 64));
+    header.push('\n');
+
+    let mut writer = BufWriter::new(File::create(path)?);
+    writer.write_all(b"\x93NUMPY\x01\x00")?;
+    writer.write_all(&(header.len() as u16).to_le_bytes())?;
+    writer.write_all(header.as_bytes())?;
+    let mut num_written = 0;
+    for item in data {
+        item.write_le(&mut writer)?;
+        num_written += 1;
+    }
+    assert_eq!(
+        num_written,
+        shape.iter().product::<usize>(),
+        "Wrote the wrong number of elements for shape {:?}",
+        shape
+    );
+    writer.flush()
+}
@@ -21,14 +21,18 @@
 
 use crate::tokenizer::{get_symbols, get_words};
 use core::cmp::{Eq, Ord, Ordering, PartialEq, PartialOrd};
+use pyo3::exceptions;
 use pyo3::prelude::*;
 use pyo3::ToPyObject;
+use rayon::prelude::*;
 use serde::{Deserialize, Serialize};
 use serde_json;
 use std::collections::HashMap;
 use std::fs::File;
 use std::io::{BufRead, BufReader, Result, Write};
 use std::iter;
+use std::sync::mpsc;
+use std::thread;
 
 use crate::paren_util::*;
 use regex::Regex;
@@ -243,18 +247,326 @@ impl<I: Iterator<Item = T>, T: Clone> Iterator for AdjacentPairs<I, T> {
     }
 }
 
-pub fn scraped_from_file(file: File) -> impl iter::Iterator<Item = ScrapedData> {
-    BufReader::new(file).lines().map(|line: Result<String>| {
-        let actual_line = line.expect("Couldn't read line");
-        if actual_line.starts_with("\"") {
-            ScrapedData::Vernac(VernacCommand {
-                command: serde_json::from_str(&actual_line).expect("Couldn't parse string"),
+const COMPACT_SCRAPE_FORMAT: &str = "proverbot9001-compact-scrape";
+const COMPACT_SCRAPE_VERSION: u32 = 1;
+
+#[derive(Deserialize)]
+struct CompactScrapeHeader {
+    format: String,
+    version: u32,
+}
+
+// A tactic line of a compact scrape file (see src/compact_scrape.py), which
+// only stores what changed since the previous tactic of the same proof.
+#[derive(Deserialize)]
+struct CompactTacticRecord {
+    tactic: String,
+    prev_keep: usize,
+    prev_add: Vec<String>,
+    #[serde(default)]
+    relevant_lemmas: Option<Vec<String>>,
+    #[serde(default)]
+    new_strings: Vec<String>,
+    context: Vec<Vec<Vec<usize>>>,
+}
+
+// Parse errors in the chunked reader are passed back to python instead of
+// panicking its background thread.
+type ParseResult<T> = std::result::Result<T, String>;
+
+#[derive(Default)]
+struct CompactScrapeDecoder {
+    strings: Vec<String>,
+    prev_tactics: Vec<String>,
+    relevant_lemmas: Vec<String>,
+}
+
+impl CompactScrapeDecoder {
+    fn string(&self, idx: usize) -> ParseResult<String> {
+        self.strings
+            .get(idx)
+            .cloned()
+            .ok_or_else(|| format!("Unknown string index {}", idx))
+    }
+    fn decode_obligation(&self, obl: &[usize]) -> ParseResult<Obligation> {
+        let (goal_idx, hyp_idxs) = obl
+            .split_first()
+            .ok_or_else(|| "Empty obligation".to_string())?;
+        Ok(Obligation {
+            hypotheses: hyp_idxs
+                .iter()
+                .map(|idx| self.string(*idx))
+                .collect::<ParseResult<Vec<String>>>()?,
+            goal: self.string(*goal_idx)?,
+        })
+    }
+    fn decode_line(&mut self, line: &str) -> ParseResult<ScrapedData> {
+        if line.starts_with("\"") {
+            *self = CompactScrapeDecoder::default();
+            return parse_scrape_line(line);
+        }
+        let record: CompactTacticRecord = serde_json::from_str(line)
+            .map_err(|err| format!("Couldn't parse line {}: {}", line, err))?;
+        self.prev_tactics.truncate(record.prev_keep);
+        self.prev_tactics.extend(record.prev_add);
+        if let Some(lemmas) = record.relevant_lemmas {
+            self.relevant_lemmas = lemmas;
+        }
+        self.strings.extend(record.new_strings);
+        let mut goal_lists = record
+            .context
+            .iter()
+            .map(|goals| {
+                goals
+                    .iter()
+                    .map(|obl| self.decode_obligation(obl))
+                    .collect::<ParseResult<Vec<Obligation>>>()
             })
+            .collect::<ParseResult<Vec<Vec<Obligation>>>>()
+            .map_err(|err| format!("In line {}: {}", line, err))?
+            .into_iter();
+        Ok(ScrapedData::Tactic(ScrapedTactic {
+            relevant_lemmas: self.relevant_lemmas.clone(),
+            prev_tactics: self.prev_tactics.clone(),
+            context: ProofContext {
+                fg_goals: goal_lists.next().unwrap_or_default(),
+                bg_goals: goal_lists.next().unwrap_or_default(),
+                shelved_goals: goal_lists.next().unwrap_or_default(),
+                given_up_goals: goal_lists.next().unwrap_or_default(),
+            },
+            tactic: record.tactic,
+        }))
+    }
+}
+
+fn parse_scrape_line(line: &str) -> ParseResult<ScrapedData> {
+    if line.starts_with("\"") {
+        Ok(ScrapedData::Vernac(VernacCommand {
+            command: serde_json::from_str(line)
+                .map_err(|err| format!("Couldn't parse string {}: {}", line, err))?,
+        }))
+    } else {
+        Ok(ScrapedData::Tactic(serde_json::from_str(line).map_err(
+            |err| format!("Couldn't parse line {}: {}", line, err),
+        )?))
+    }
+}
+
+// Returns whether the file is in the compact scrape format, and an iterator
+// over its remaining lines.
+fn scrape_file_lines(
+    file: File,
+) -> ParseResult<(bool, Box<dyn iter::Iterator<Item = Result<String>>>)> {
+    let mut reader = BufReader::new(file);
+    let mut first_line = String::new();
+    reader
+        .read_line(&mut first_line)
+        .map_err(|err| format!("Couldn't read line: {}", err))?;
+    let first_line = first_line.trim_end_matches(&['\n', '\r'][..]).to_string();
+    let rest = reader.lines();
+    match serde_json::from_str::<CompactScrapeHeader>(&first_line) {
+        Ok(header) if header.format == COMPACT_SCRAPE_FORMAT => {
+            if header.version != COMPACT_SCRAPE_VERSION {
+                return Err(format!(
+                    "Unsupported compact scrape version {}",
+                    header.version
+                ));
+            }
+            Ok((
+                true,
+                Box::new(rest.filter(|line| !matches!(line, Ok(line) if line.is_empty()))),
+            ))
+        }
+        _ => Ok((
+            false,
+            Box::new(
+                iter::once(Ok(first_line))
+                    .filter(|line| !matches!(line, Ok(line) if line.is_empty()))
+                    .chain(rest),
+            ),
+        )),
+    }
+}
+
+fn parse_scrape_lines(lines: Vec<String>, compact: bool) -> ParseResult<Vec<ScrapedData>> {
+    if compact {
+        let mut decoder = CompactScrapeDecoder::default();
+        lines.iter().map(|line| decoder.decode_line(line)).collect()
+    } else {
+        lines.iter().map(|line| parse_scrape_line(line)).collect()
+    }
+}
+
+// Reads either the original scrape format or the compact one, depending on
+// whether the file starts with a compact scrape header.
+pub fn scraped_from_file(file: File) -> Box<dyn iter::Iterator<Item = ScrapedData>> {
+    let (compact, lines) = scrape_file_lines(file).unwrap_or_else(|err| panic!("{}", err));
+    let lines = lines.map(|line: Result<String>| line.expect("Couldn't read line"));
+    if compact {
+        let mut decoder = CompactScrapeDecoder::default();
+        Box::new(lines.map(move |line| {
+            decoder
+                .decode_line(&line)
+                .unwrap_or_else(|err| panic!("{}", err))
+        }))
+    } else {
+        Box::new(lines.map(|line| parse_scrape_line(&line).unwrap_or_else(|err| panic!("{}", err))))
+    }
+}
+
+// Like scraped_from_file, but parses the file in chunks of about chunk_lines
+// lines, one chunk per rayon thread at a time. Compact scrape chunks are only
+// split after vernacular commands, so each chunk starts on a proof boundary
+// and can be decoded on its own. A chunk that can't be read or parsed comes
+// back as an error, and nothing after it is read.
+pub fn scraped_chunks_from_file(
+    file: File,
+    chunk_lines: usize,
+) -> Box<dyn iter::Iterator<Item = ParseResult<Vec<ScrapedData>>>> {
+    let (compact, mut lines) = match scrape_file_lines(file) {
+        Ok(header_and_lines) => header_and_lines,
+        Err(err) => {
+            let failure: ParseResult<Vec<ScrapedData>> = Err(err);
+            return Box::new(iter::once(failure));
+        }
+    };
+    let mut failed = false;
+    let mut line_chunks = iter::from_fn(move || {
+        if failed {
+            return None;
+        }
+        let mut chunk = Vec::new();
+        for line in lines.by_ref() {
+            let line = match line {
+                Ok(line) => line,
+                Err(err) => {
+                    failed = true;
+                    return Some(Err(format!("Couldn't read line: {}", err)));
+                }
+            };
+            let is_vernac = line.starts_with("\"");
+            chunk.push(line);
+            if chunk.len() >= chunk_lines && (!compact || is_vernac) {
+                break;
+            }
+        }
+        if chunk.is_empty() {
+            None
         } else {
-            ScrapedData::Tactic(serde_json::from_str(&actual_line)
-                                .expect(&format!("Couldn't parse line {}", actual_line)))
+            Some(Ok(chunk))
         }
-    })
+    });
+    let num_threads = rayon::current_num_threads();
+    Box::new(
+        iter::from_fn(move || {
+            let chunk_group: Vec<ParseResult<Vec<String>>> =
+                line_chunks.by_ref().take(num_threads).collect();
+            if chunk_group.is_empty() {
+                None
+            } else {
+                Some(
+                    chunk_group
+                        .into_par_iter()
+                        .map(|chunk| chunk.and_then(|lines| parse_scrape_lines(lines, compact)))
+                        .collect::<Vec<_>>(),
+                )
+            }
+        })
+        .flatten(),
+    )
+}
+
+// A python iterator over the points of a scrape file. The file is parsed on a
+// background thread by scraped_chunks_from_file, and each call to __next__
+// returns the next parsed chunk as a list, with tactics as plain tuples of
+//   (relevant_lemmas, prev_tactics,
+//    (fg_goals, bg_goals, shelved_goals, given_up_goals), tactic)
+// where each goal is a (hypotheses, goal) tuple, and vernacular commands as
+// strings. Only a few chunks are parsed ahead of the consumer. If part of
+// the file can't be parsed, or the background thread dies, __next__ raises
+// a ValueError instead of ending the iteration early.
+#[pyclass(module = "dataloader")]
+pub struct ScrapedChunkStream {
+    receiver: mpsc::Receiver<ParseResult<Vec<ScrapedData>>>,
+    reader_thread: Option<thread::JoinHandle<()>>,
+}
+
+impl ScrapedChunkStream {
+    pub fn new(file: File, chunk_lines: usize, tactics_only: bool) -> Self {
+        let (sender, receiver) = mpsc::sync_channel(rayon::current_num_threads() * 2);
+        let reader_thread = thread::spawn(move || {
+            for chunk in scraped_chunks_from_file(file, chunk_lines) {
+                let failed = chunk.is_err();
+                let chunk = chunk.map(|chunk| {
+                    if tactics_only {
+                        chunk
+                            .into_iter()
+                            .filter(|point| matches!(point, ScrapedData::Tactic(_)))
+                            .collect()
+                    } else {
+                        chunk
+                    }
+                });
+                // The receiver is gone once python drops the stream.
+                if sender.send(chunk).is_err() || failed {
+                    break;
+                }
+            }
+        });
+        ScrapedChunkStream {
+            receiver,
+            reader_thread: Some(reader_thread),
+        }
+    }
+}
+
+fn obligations_to_tuples(obls: Vec<Obligation>) -> Vec<(Vec<String>, String)> {
+    obls.into_iter().map(|obl| (obl.hypotheses, obl.goal)).collect()
+}
+
+#[pymethods]
+impl ScrapedChunkStream {
+    fn __iter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
+        slf
+    }
+    fn __next__(&mut self, py: Python) -> PyResult<Option<Vec<PyObject>>> {
+        let receiver = &mut self.receiver;
+        let chunk = match py.allow_threads(move || receiver.recv()) {
+            Ok(chunk) => chunk.map_err(exceptions::PyValueError::new_err)?,
+            Err(_) => {
+                // The sender is only dropped early if the reader thread
+                // panicked.
+                if let Some(reader_thread) = self.reader_thread.take() {
+                    if reader_thread.join().is_err() {
+                        return Err(exceptions::PyValueError::new_err(
+                            "Scrape reader thread crashed",
+                        ));
+                    }
+                }
+                return Ok(None);
+            }
+        };
+        Ok(Some(
+            chunk
+                .into_iter()
+                .map(|point| match point {
+                    ScrapedData::Vernac(cmd) => cmd.command.into_py(py),
+                    ScrapedData::Tactic(tac) => (
+                        tac.relevant_lemmas,
+                        tac.prev_tactics,
+                        (
+                            obligations_to_tuples(tac.context.fg_goals),
+                            obligations_to_tuples(tac.context.bg_goals),
+                            obligations_to_tuples(tac.context.shelved_goals),
+                            obligations_to_tuples(tac.context.given_up_goals),
+                        ),
+                        tac.tactic,
+                    )
+                        .into_py(py),
+                })
+                .collect(),
+        ))
+    }
 }
 
 pub fn scraped_to_file(mut file: File, scraped: impl iter::Iterator<Item = ScrapedData>) {
@@ -12,6 +12,7 @@ use regex::Regex;
 
 pub type Token = i64;
 
+#[derive(Clone)]
 pub struct OpenIndexer<T>
 where
     T: Eq + Hash + Clone,
@@ -48,6 +49,26 @@ where
         }
         *self.map.get(&v).unwrap()
     }
+    // Like lookup, but never adds anything to the map, so an unknown value
+    // gets the index it would have been given.
+    pub fn peek(&self, v: &T) -> i64 {
+        match self.map.get(v) {
+            Some(idx) => *idx,
+            None => {
+                if self.frozen {
+                    0
+                } else {
+                    self.next_idx
+                }
+            }
+        }
+    }
+    pub fn reverse_map(&self) -> HashMap<i64, T> {
+        self.map
+            .iter()
+            .map(|(item, idx)| (*idx, item.clone()))
+            .collect()
+    }
     pub fn reverse_lookup(&self, i: i64) -> T {
         self.map
             .iter()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A compact version of the scrape format. Like a normal scrape file, it's
+# one JSON value per line, and vernacular commands are written as plain JSON
+# strings. The first line is a header object marking the format, and tactic
+# lines only store what changed since the previous tactic in the same proof:
+#
+#   {"tactic": "...",
+#    "prev_keep": n, "prev_add": [...],   # prev_tactics = old[:n] + add
+#    "relevant_lemmas": [...],            # only when they changed
+#    "new_strings": [...],                # hyps/goals not seen in this proof
+#    "context": [fg, bg, shelved, given_up]}
+#
+# where each goal list holds obligations as [goal_idx, hyp_idx, ...],
+# indexing into the strings seen so far in the proof. Every vernacular
+# command ends the current proof, so decoding can start at the first tactic
+# of any proof. The byte offset and tactic count of each proof are written
+# to a sidecar index file (the scrape filename plus ".index"), so a reader
+# can seek straight to the proofs it wants with read_compact_proofs. Training
+# reads compact scrapes through the rust dataloader, with the same
+# scraped_from_file and scraped_chunks_from_file calls as the original format.
+
+import argparse
+import json
+from pathlib import Path
+from typing import (Any, Dict, Iterable, Iterator, List, Optional, TextIO,
+                    Tuple, Union)
+
+from coq_serapy.contexts import (ScrapedTactic, ScrapedCommand, ProofContext,
+                                 Obligation, read_tuple)
+from util import eprint
+
+COMPACT_SCRAPE_FORMAT = "proverbot9001-compact-scrape"
+COMPACT_SCRAPE_VERSION = 1
+
+ProofOffset = Tuple[int, int]
+
+
+def index_path(scrape_path: Union[str, Path]) -> Path:
+    return Path(str(scrape_path) + ".index")
+
+
+def is_compact_scrape(scrape_path: Union[str, Path]) -> bool:
+    with open(scrape_path, 'rb') as f:
+        first_line = f.readline()
+    try:
+        header = json.loads(first_line)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(header, dict) and \
+        header.get("format") == COMPACT_SCRAPE_FORMAT
+
+
+class CompactScrapeWriter:
+    def __init__(self, out: TextIO) -> None:
+        self.out = out
+        self.proof_offsets: List[ProofOffset] = []
+        self._offset = 0
+        self._end_proof()
+        self._write_line(json.dumps({"format": COMPACT_SCRAPE_FORMAT,
+                                     "version": COMPACT_SCRAPE_VERSION}))
+
+    def _write_line(self, line: str) -> None:
+        self.out.write(line)
+        self.out.write("\n")
+        self._offset += len(line.encode("utf-8")) + 1
+
+    def _end_proof(self) -> None:
+        self._strings: Dict[str, int] = {}
+        self._prev_tactics: List[str] = []
+        self._relevant_lemmas: Optional[List[str]] = None
+
+    def _intern(self, s: str, new_strings: List[str]) -> int:
+        idx = self._strings.get(s)
+        if idx is None:
+            idx = len(self._strings)
+            self._strings[s] = idx
+            new_strings.append(s)
+        return idx
+
+    def write_command(self, command: ScrapedCommand) -> None:
+        if isinstance(command, ScrapedTactic):
+            self.write_tactic(command)
+        else:
+            self.write_vernac(command)
+
+    def write_vernac(self, command: str) -> None:
+        self._end_proof()
+        self._write_line(json.dumps(command))
+
+    def write_tactic(self, tactic: ScrapedTactic) -> None:
+        if self._relevant_lemmas is None:
+            self.proof_offsets.append((self._offset, 0))
+        offset, num_tactics = self.proof_offsets[-1]
+        self.proof_offsets[-1] = (offset, num_tactics + 1)
+
+        prev_keep = 0
+        for old, new in zip(self._prev_tactics, tactic.prev_tactics):
+            if old != new:
+                break
+            prev_keep += 1
+        record: Dict[str, Any] = {
+            "tactic": tactic.tactic,
+            "prev_keep": prev_keep,
+            "prev_add": tactic.prev_tactics[prev_keep:]}
+        self._prev_tactics = list(tactic.prev_tactics)
+
+        if tactic.relevant_lemmas != self._relevant_lemmas:
+            record["relevant_lemmas"] = tactic.relevant_lemmas
+            self._relevant_lemmas = list(tactic.relevant_lemmas)
+
+        new_strings: List[str] = []
+        context = tactic.context
+        record["context"] = [
+            [[self._intern(obl.goal, new_strings)] +
+             [self._intern(hyp, new_strings) for hyp in obl.hypotheses]
+             for obl in goals]
+            for goals in [context.fg_goals, context.bg_goals,
+                          context.shelved_goals, context.given_up_goals]]
+        if new_strings:
+            record["new_strings"] = new_strings
+        self._write_line(json.dumps(record))
+
+    def write_index(self, path: Union[str, Path]) -> None:
+        with open(path, 'w') as f:
+            json.dump({"format": COMPACT_SCRAPE_FORMAT,
+                       "version": COMPACT_SCRAPE_VERSION,
+                       "proofs": self.proof_offsets}, f)
+
+
+class CompactScrapeDecoder:
+    def __init__(self) -> None:
+        self._end_proof()
+
+    def _end_proof(self) -> None:
+        self._strings: List[str] = []
+        self._prev_tactics: List[str] = []
+        self._relevant_lemmas: List[str] = []
+
+    def decode_line(self, line: Union[str, bytes]) -> ScrapedCommand:
+        obj = json.loads(line)
+        if isinstance(obj, str):
+            self._end_proof()
+            return obj
+        self._prev_tactics = self._prev_tactics[:obj["prev_keep"]] + \
+            obj["prev_add"]
+        if "relevant_lemmas" in obj:
+            self._relevant_lemmas = obj["relevant_lemmas"]
+        self._strings.extend(obj.get("new_strings", []))
+        goal_lists = [[Obligation([self._strings[hyp_idx]
+                                   for hyp_idx in obl[1:]],
+                                  self._strings[obl[0]])
+                       for obl in goals]
+                      for goals in obj["context"]]
+        return ScrapedTactic(list(self._relevant_lemmas),
+                             list(self._prev_tactics),
+                             ProofContext(*goal_lists),
+                             obj["tactic"])
+
+
+def read_compact_scrape(scrape_path: Union[str, Path]) \
+        -> Iterator[ScrapedCommand]:
+    decoder = CompactScrapeDecoder()
+    with open(scrape_path, 'rb') as f:
+        header = json.loads(f.readline())
+        assert header["version"] == COMPACT_SCRAPE_VERSION, \
+            f"Unsupported compact scrape version {header['version']}"
+        for line in f:
+            if line.strip():
+                yield decoder.decode_line(line)
+
+
+def read_compact_index(scrape_path: Union[str, Path]) \
+        -> Optional[List[ProofOffset]]:
+    try:
+        with index_path(scrape_path).open('r') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    assert index["version"] == COMPACT_SCRAPE_VERSION, \
+        f"Unsupported compact scrape index version {index['version']}"
+    return [(offset, num_tactics) for offset, num_tactics in index["proofs"]]
+
+
+def read_compact_proofs(scrape_path: Union[str, Path],
+                        proofs: Iterable[ProofOffset]) -> List[ScrapedTactic]:
+    tactics: List[ScrapedTactic] = []
+    with open(scrape_path, 'rb') as f:
+        for offset, num_tactics in proofs:
+            f.seek(offset)
+            decoder = CompactScrapeDecoder()
+            for _ in range(num_tactics):
+                tactic = decoder.decode_line(f.readline())
+                assert isinstance(tactic, ScrapedTactic), \
+                    f"Index for {scrape_path} doesn't match the scrape"
+                tactics.append(tactic)
+    return tactics
+
+
+def copy_scrape(in_f: TextIO, writer: CompactScrapeWriter) -> None:
+    command = read_tuple(in_f)
+    while command:
+        writer.write_command(command)
+        command = read_tuple(in_f)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Convert scrape files to the compact scrape format")
+    parser.add_argument("-v", "--verbose", action='count', default=0)
+    parser.add_argument("input", type=Path)
+    parser.add_argument("output", type=Path)
+    args = parser.parse_args()
+
+    if is_compact_scrape(args.input):
+        # Re-encoding a compact scrape rebuilds its index. Read it all first,
+        # so the output can be the input file.
+        commands = list(read_compact_scrape(args.input))
+        with args.output.open('w') as out_f:
+            writer = CompactScrapeWriter(out_f)
+            for command in commands:
+                writer.write_command(command)
+    else:
+        with args.input.open('r') as in_f, args.output.open('w') as out_f:
+            writer = CompactScrapeWriter(out_f)
+            copy_scrape(in_f, writer)
+    writer.write_index(index_path(args.output))
+    eprint(f"Wrote {len(writer.proof_offsets)} proofs to {args.output}",
+           guard=args.verbose >= 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,15 +22,13 @@
 import argparse
 import multiprocessing
 import functools
-import itertools
 
 import coq_serapy
 from coq_serapy.contexts import (ScrapedCommand, ScrapedTactic,
                                  strip_scraped_output, TacticContext)
 from context_filter import get_context_filter
 from util import eprint, stringified_percent
-from data import (read_all_text_data, read_all_text_data_worker__,
-                  MixedDataset, file_chunks)
+from data import read_all_text_data, MixedDataset
 from pathlib import Path
 
 from typing import List, Optional, Tuple, cast
@@ -172,11 +170,9 @@ def count_proofs(args: argparse.Namespace, filename: str) \
 def read_all_text_data_singlethreaded(data_path: Path,
                                       num_threads: Optional[int] = None) \
                                     -> MixedDataset:
-    line_chunks = file_chunks(data_path, 32768)
     try:
-        yield from itertools.chain.from_iterable((
-            read_all_text_data_worker__(chunk) for chunk in line_chunks))
-    except AssertionError:
+        yield from read_all_text_data(data_path)
+    except ValueError:
         print(f"Couldn't parse data in {str(data_path)}")
         raise
 
@@ -44,13 +44,13 @@ from coq_serapy.contexts import (read_tactic_tuple, ScrapedTactic,
                                  ScrapedCommand,
                                  read_tuple, TacticContext,
                                  strip_scraped_output,
-                                 ProofContext)
+                                 ProofContext, Obligation)
 from models.components import SimpleEmbedding
 import coq_serapy as serapi_instance
 
 from typing import (Tuple, NamedTuple, List, Callable, Optional,
                     Sized, Sequence, Dict, Generic, Iterable, TypeVar,
-                    Any)
+                    Any, cast)
 from util import (eprint, chunks, split_by_char_outside_matching,
                   unwrap, get_possible_arg)
 from context_filter import get_context_filter, ContextFilter
@@ -200,10 +200,25 @@ def read_all_text_data_worker__(lines : List[str]) -> MixedDataset:
                 yield t
                 t = read_tuple(f)
     return list(worker_generator())
+def read_scrape_rs(data_path : Path2, tactics_only : bool) -> MixedDataset:
+    import dataloader
+    # The rust dataloader parses the file on its own threads, and hands
+    # back each chunk as plain tuples, so nothing has to be pickled across
+    # processes.
+    for chunk in dataloader.scraped_chunks_from_file(str(data_path), 4096,
+                                                     tactics_only):
+        for point in chunk:
+            if isinstance(point, str):
+                yield point
+            else:
+                relevant_lemmas, prev_tactics, goal_lists, tactic = point
+                yield ScrapedTactic(relevant_lemmas, prev_tactics,
+                                    ProofContext(*[[Obligation(hyps, goal)
+                                                    for hyps, goal in goals]
+                                                   for goals in goal_lists]),
+                                    tactic)
 def read_all_text_data(data_path : Path2) -> MixedDataset:
-    line_chunks = file_chunks(data_path, 32768)
-    data_chunks = lazy_multiprocessing_imap(read_all_text_data_worker__, line_chunks)
-    yield from itertools.chain.from_iterable(data_chunks)
+    yield from read_scrape_rs(data_path, tactics_only=False)
 def read_text_data_worker__(lines : List[str]) -> RawDataset:
     def worker_generator() -> Iterable[ScrapedTactic]:
         with io.StringIO("".join(lines)) as f:
@@ -230,9 +245,8 @@ def lazy_multiprocessing_imap(worker: Callable[[T], O], in_data : Iterable[T],
 
 def read_text_data(data_path: Path2) \
                   -> Iterable[ScrapedTactic]:
-    line_chunks = file_chunks(data_path, 32768)
-    data_chunks = lazy_multiprocessing_imap(read_text_data_worker__, line_chunks)
-    yield from itertools.chain.from_iterable(data_chunks)
+    yield from cast(Iterable[ScrapedTactic],
+                    read_scrape_rs(data_path, tactics_only=True))
 
 @dataclass
 class StateScore:
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# Estimates how long each search job will take, so that runs can start the
+# most expensive jobs first instead of finding them at the end of the queue.
+# Costs are in seconds, and come from the -proofs.txt files of earlier runs
+# (passed with --cost-history). Jobs that weren't in an earlier run are
+# estimated from the other jobs in their file, or failing that, from the
+# length of their lemma statement.
+
+import argparse
+import heapq
+import json
+import statistics
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import coq_serapy
+
+from search_worker import ReportJob
+from util import eprint
+
+# Used when there's no history to fit these from.
+DEFAULT_SECONDS_PER_STEP = 1.0
+DEFAULT_SECONDS_PER_CHAR = 0.1
+
+PREDICTED_COSTS_FILE = "predicted-costs.txt"
+
+JobKey = Tuple[str, str, str]
+
+
+def job_key(job: ReportJob) -> JobKey:
+    return (job.project_dir, str(job.filename), job.lemma_statement)
+
+
+def statement_length(job: ReportJob) -> int:
+    return max(1, len(coq_serapy.kill_comments(job.lemma_statement).strip()))
+
+
+def read_proofs_files(output_dir: Path) \
+        -> Iterator[Tuple[ReportJob, Dict]]:
+    for proofs_file in output_dir.glob("**/*-proofs.txt"):
+        with proofs_file.open('r') as f:
+            for line in f:
+                try:
+                    job, sol = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # The last line of a run that was killed might be
+                    # half-written
+                    continue
+                yield ReportJob(*job), sol
+
+
+class JobCostModel:
+    def __init__(self, results: List[Tuple[ReportJob, Dict]]) -> None:
+        timed = [(sol["steps_taken"], sol["time_taken"])
+                 for _, sol in results
+                 if sol.get("time_taken") is not None and
+                 sol["steps_taken"] > 0]
+        if timed:
+            self.seconds_per_step = statistics.median(
+                time_taken / steps for steps, time_taken in timed)
+        else:
+            self.seconds_per_step = DEFAULT_SECONDS_PER_STEP
+
+        self.known_costs: Dict[JobKey, float] = {}
+        for job, sol in results:
+            self.known_costs[job_key(job)] = self.result_cost(sol)
+
+        file_costs: Dict[Tuple[str, str], List[float]] = {}
+        for (project, filename, _), cost in self.known_costs.items():
+            file_costs.setdefault((project, filename), []).append(cost)
+        self.file_costs = {f: statistics.mean(costs)
+                           for f, costs in file_costs.items()}
+
+        if results:
+            self.seconds_per_char = statistics.median(
+                self.known_costs[job_key(job)] / statement_length(job)
+                for job, _ in results)
+        else:
+            self.seconds_per_char = DEFAULT_SECONDS_PER_CHAR
+
+    @classmethod
+    def from_output_dirs(cls, output_dirs: List[Path],
+                         verbose: int = 0) -> 'JobCostModel':
+        results = [result for output_dir in output_dirs
+                   for result in read_proofs_files(output_dir)]
+        eprint(f"Estimating job costs from {len(results)} earlier results",
+               guard=verbose >= 1 and len(results) > 0)
+        return cls(results)
+
+    def result_cost(self, sol: Dict) -> float:
+        # Results from before jobs were timed only have a step count.
+        if sol.get("time_taken") is not None:
+            return sol["time_taken"]
+        return sol["steps_taken"] * self.seconds_per_step
+
+    def estimate(self, job: ReportJob) -> float:
+        key = job_key(job)
+        if key in self.known_costs:
+            return self.known_costs[key]
+        file_cost = self.file_costs.get((job.project_dir, str(job.filename)))
+        if file_cost is not None:
+            return file_cost
+        return statement_length(job) * self.seconds_per_char
+
+    def group_cost(self, jobs: List[ReportJob]) -> float:
+        return sum(self.estimate(job) for job in jobs)
+
+    def split_group(self, jobs: List[ReportJob], max_cost: float) \
+            -> List[List[ReportJob]]:
+        if len(jobs) < 2 or self.group_cost(jobs) <= max_cost:
+            return [jobs]
+        runs: List[List[ReportJob]] = [[]]
+        run_cost = 0.0
+        for job in jobs:
+            cost = self.estimate(job)
+            if runs[-1] and run_cost + cost > max_cost:
+                runs.append([])
+                run_cost = 0.0
+            runs[-1].append(job)
+            run_cost += cost
+        return runs
+
+    def order_groups(self, groups: List[List[ReportJob]],
+                     num_workers: int) -> List[List[ReportJob]]:
+        """
+        Orders groups of jobs most expensive first. Jobs in the same file
+        stay together, unless their file would take longer than a fair
+        share of the whole run, in which case it's split into contiguous
+        runs of about that cost.
+        """
+        fair_share = sum(self.group_cost(group) for group in groups) / \
+            max(1, num_workers)
+        split_groups = [run for group in groups
+                        for run in self.split_group(group, fair_share)]
+        return sorted(split_groups, key=self.group_cost, reverse=True)
+
+    def assign_shards(self, groups: List[List[ReportJob]],
+                      num_shards: int) -> List[List[ReportJob]]:
+        """
+        Deals ordered groups out to shards, each to the shard with the
+        least estimated work so far. Within a shard, the most expensive
+        groups come first.
+        """
+        shards: List[List[ReportJob]] = [[] for _ in range(num_shards)]
+        loads = [(0.0, shard_idx) for shard_idx in range(num_shards)]
+        for group in self.order_groups(groups, num_shards):
+            load, shard_idx = heapq.heappop(loads)
+            shards[shard_idx].extend(group)
+            heapq.heappush(loads, (load + self.group_cost(group), shard_idx))
+        return shards
+
+    def write_predictions(self, output_dir: Path,
+                          jobs: List[ReportJob]) -> None:
+        with (output_dir / PREDICTED_COSTS_FILE).open('w') as f:
+            for job in jobs:
+                print(json.dumps((job, self.estimate(job))), file=f)
+
+
+def rank(values: List[float]) -> List[float]:
+    """
+    Ranks values from zero, giving tied values the average of the ranks
+    they span, as Spearman's correlation expects.
+    """
+    order = sorted(range(len(values)), key=lambda idx: values[idx])
+    ranks = [0.0] * len(values)
+    start = 0
+    while start < len(order):
+        end = start + 1
+        while end < len(order) and \
+                values[order[end]] == values[order[start]]:
+            end += 1
+        for idx in order[start:end]:
+            ranks[idx] = (start + end - 1) / 2
+        start = end
+    return ranks
+
+
+def correlation(xs: List[float], ys: List[float]) -> Optional[float]:
+    if len(xs) < 2:
+        return None
+    x_mean, y_mean = statistics.mean(xs), statistics.mean(ys)
+    cov = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys))
+    x_var = sum((x - x_mean) ** 2 for x in xs)
+    y_var = sum((y - y_mean) ** 2 for y in ys)
+    if x_var == 0 or y_var == 0:
+        return None
+    return cov / (x_var * y_var) ** 0.5
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the predicted cost of each job in a search run "
+        "with how long it actually took")
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument("--csv", type=Path, default=None,
+                        help="Write the cost of every job to this file")
+    parser.add_argument("--num-worst", type=int, default=10)
+    args = parser.parse_args()
+
+    predicted: Dict[JobKey, float] = {}
+    with (args.output_dir / PREDICTED_COSTS_FILE).open('r') as f:
+        for line in f:
+            job, cost = json.loads(line)
+            predicted[job_key(ReportJob(*job))] = cost
+    actual: Dict[JobKey, float] = {}
+    for job, sol in read_proofs_files(args.output_dir):
+        if sol.get("time_taken") is not None:
+            actual[job_key(job)] = sol["time_taken"]
+    keys = [key for key in predicted if key in actual]
+    if not keys:
+        print("No timed results to compare against")
+        return
+
+    if args.csv:
+        with args.csv.open('w') as f:
+            print("project,file,lemma,predicted,actual", file=f)
+            for key in keys:
+                print(",".join([json.dumps(field) for field in key] +
+                               [f"{predicted[key]:.2f}",
+                                f"{actual[key]:.2f}"]), file=f)
+
+    predicted_costs = [predicted[key] for key in keys]
+    actual_costs = [actual[key] for key in keys]
+    print(f"Jobs compared: {len(keys)} of {len(predicted)} predicted")
+    print(f"Total predicted: {sum(predicted_costs):.1f}s, "
+          f"total actual: {sum(actual_costs):.1f}s")
+    print(f"Mean absolute error: "
+          f"{statistics.mean(abs(p - a) for p, a in zip(predicted_costs, actual_costs)):.2f}s")
+    rank_corr = correlation(rank(predicted_costs), rank(actual_costs))
+    if rank_corr is not None:
+        print(f"Rank correlation: {rank_corr:.3f}")
+    print("Most underestimated jobs:")
+    for key in sorted(keys, key=lambda key: actual[key] - predicted[key],
+                      reverse=True)[:args.num_worst]:
+        project, filename, lemma = key
+        print(f"  {filename}: {coq_serapy.lemma_name_from_statement(lemma)} "
+              f"predicted {predicted[key]:.1f}s, took {actual[key]:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -102,6 +102,15 @@ def add_nn_args(parser : argparse.ArgumentParser,
                                                    list(optimizers.keys())[0]))
     parser.add_argument("--max-premises", dest="max_premises", type=int,
                         default=default_values.get("max-premises", 20))
+    parser.add_argument("--num-data-workers", dest="num_data_workers",
+                        type=int,
+                        default=default_values.get("num-data-workers", 0),
+                        help="Number of processes to prefetch training "
+                        "batches with")
+    parser.add_argument("--shard-size", dest="shard_size", type=int,
+                        default=default_values.get("shard-size", 65536),
+                        help="Number of samples to bucket and shuffle "
+                        "together when batches are bucketed by length")
 
 class StraightlineClassifierModel(Generic[S], metaclass=ABCMeta):
     @staticmethod
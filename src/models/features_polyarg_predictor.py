@@ -19,12 +19,20 @@
 #
 ##########################################################################
 
-from tqdm import tqdm
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import autograd
 from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data.dataloader import default_collate
 
 from features import (WordFeature, VecFeature, Feature,
                       word_feature_constructors, vec_feature_constructors)
@@ -45,11 +53,12 @@ from models.tactic_predictor import (TrainablePredictor,
 import dataloader
 from dataloader import (features_polyarg_tensors,
                         features_polyarg_tensors_with_meta,
+                        features_polyarg_tensors_to_npy,
                         sample_fpa,
                         sample_fpa_batch,
-                        decode_fpa_result,
+                        decode_fpa_results,
                         encode_fpa_stem,
-                        encode_fpa_arg,
+                        encode_fpa_actions,
                         decode_fpa_stem,
                         # decode_fpa_arg,
                         # features_vocab_sizes,
@@ -58,15 +67,18 @@ from dataloader import (features_polyarg_tensors,
                         get_word_feature_vocab_sizes,
                         get_vec_features_size,
                         DataloaderArgs,
-                        get_fpa_words)
+                        get_fpa_words,
+                        FPAMetadataHandle)
 
 import coq_serapy
 
 import argparse
 import sys
 from argparse import Namespace
+from collections import OrderedDict
 from typing import (List, Tuple, NamedTuple, Optional, Sequence, Dict,
-                    cast, Union, Set, Type, Any, Iterable)
+                    cast, Union, Set, Type, Any, Iterable, Iterator,
+                    Callable)
 
 from enum import Enum, auto
 
@@ -104,6 +116,61 @@ class FeaturesPolyArgDataset(ListDataset[FeaturesPolyArgSample]):
     pass
 
 
+def top_args(log_probs: torch.FloatTensor,
+             stem_idxs: torch.LongTensor,
+             num_args: Optional[int] = None
+             ) -> Tuple[torch.FloatTensor, torch.LongTensor, torch.LongTensor]:
+    """
+    Pick the num_args most likely (stem, argument) pairs from each row of
+    log_probs, best first, and split their flat indices back into stem and
+    argument indices. With no num_args, every pair is sorted.
+    """
+    batch_size = log_probs.size()[0]
+    stem_width = stem_idxs.size()[1]
+    num_probs_per_stem = log_probs.size()[1] // stem_width
+    if num_args is None or num_args >= log_probs.size()[1]:
+        prediction_probs, flat_idxs = log_probs.sort(descending=True)
+    else:
+        prediction_probs, flat_idxs = log_probs.topk(num_args)
+    predicted_stem_keys = torch.div(flat_idxs, num_probs_per_stem,
+                                    rounding_mode="floor")
+    predicted_stem_idxs = stem_idxs.view(batch_size, stem_width)\
+                                   .gather(1, predicted_stem_keys)
+    predicted_arg_idxs = flat_idxs % num_probs_per_stem
+    return prediction_probs, predicted_stem_idxs, predicted_arg_idxs
+
+
+class PredictionCandidates:
+    """
+    The (log prob, stem idx, arg idx) candidates for one context, handed out
+    best first in chunks. Only the first chunk is computed up front, and
+    each later chunk takes a top-k twice the size of everything before it, so
+    the usual case never sorts all the candidates.
+    """
+    def __init__(self, log_probs: torch.FloatTensor,
+                 stem_idxs: torch.LongTensor,
+                 first_chunk: List[Tuple[float, int, int]]) -> None:
+        self._log_probs = log_probs
+        self._stem_idxs = stem_idxs
+        self._first_chunk = first_chunk
+
+    def __len__(self) -> int:
+        return self._log_probs.size()[0]
+
+    def chunks(self) -> Iterator[List[Tuple[float, int, int]]]:
+        yield self._first_chunk
+        num_taken = len(self._first_chunk)
+        while num_taken < len(self):
+            num_to_take = min(len(self), max(1, num_taken * 2))
+            probs, stems, args = top_args(self._log_probs.unsqueeze(0),
+                                          self._stem_idxs.unsqueeze(0),
+                                          num_to_take)
+            yield list(zip(probs[0, num_taken:].tolist(),
+                           stems[0, num_taken:].tolist(),
+                           args[0, num_taken:].tolist()))
+            num_taken = num_to_take
+
+
 FeaturesPolyargState = Tuple[Any, NeuralPredictorState]
 
 
@@ -196,10 +263,7 @@ class HypArgEncoder(nn.Module):
         assert hyps_batch.size()[0] == batch_size, \
             "batch_size: {}; hyps_batch_size()[0]: {}"\
             .format(batch_size, hyps_batch.size()[0])
-        stem_encoded = self._stem_embedding(stems_var)\
-                           .view(batch_size, self.hidden_size)
-        initial_hidden = self._in_hidden(torch.cat(
-            (stem_encoded, goals_encoded_batch), dim=1))\
+        initial_hidden = self.initial_hidden(stems_var, goals_encoded_batch)\
             .view(1, batch_size, self.hidden_size)
 
         # embed every hypothesis token
@@ -212,6 +276,50 @@ class HypArgEncoder(nn.Module):
 
         return encoded_tokens[:, -1]
 
+    @torch.jit.export
+    def initial_hidden(self, stems_batch: torch.LongTensor,
+                       goals_encoded_batch: torch.FloatTensor) \
+            -> torch.FloatTensor:
+        batch_size = stems_batch.size()[0]
+        stem_encoded = self._stem_embedding(stems_batch)\
+                           .view(batch_size, self.hidden_size)
+        return self._in_hidden(torch.cat(
+            (stem_encoded, goals_encoded_batch), dim=1))\
+            .view(batch_size, self.hidden_size)
+
+    @torch.jit.export
+    def hyp_inputs(self, hyps_batch: torch.LongTensor) -> torch.FloatTensor:
+        """
+        The input half of the GRU gates for every token of each hypothesis.
+        It doesn't depend on the stem or the goal, so it only has to be
+        computed once per hypothesis.
+        """
+        tokens_embedded = F.relu(self._token_embedding(hyps_batch))
+        return F.linear(tokens_embedded, self._hyp_gru.weight_ih_l0,
+                        self._hyp_gru.bias_ih_l0)
+
+    @torch.jit.export
+    def encode_hyp_inputs(self, initial_hidden: torch.FloatTensor,
+                          hyp_inputs: torch.FloatTensor,
+                          hyp_idxs: torch.LongTensor) -> torch.FloatTensor:
+        """
+        Gives the same encodings as forward, for the hypotheses with inputs
+        hyp_inputs[hyp_idxs], running the GRU one step at a time so that
+        only one token's inputs are gathered for each row at a time.
+        """
+        hidden = initial_hidden
+        for token_idx in range(hyp_inputs.size()[1]):
+            gate_inputs = hyp_inputs[:, token_idx].index_select(0, hyp_idxs)
+            gate_hiddens = F.linear(hidden, self._hyp_gru.weight_hh_l0,
+                                    self._hyp_gru.bias_hh_l0)
+            input_r, input_z, input_n = gate_inputs.chunk(3, 1)
+            hidden_r, hidden_z, hidden_n = gate_hiddens.chunk(3, 1)
+            reset_gate = torch.sigmoid(input_r + hidden_r)
+            update_gate = torch.sigmoid(input_z + hidden_z)
+            new_gate = torch.tanh(input_n + reset_gate * hidden_n)
+            hidden = new_gate + update_gate * (hidden - new_gate)
+        return hidden
+
 class HypArgModel(nn.Module):
     def __init__(self, goal_data_size: int,
                  stem_vocab_size: int,
@@ -234,6 +342,12 @@ class HypArgModel(nn.Module):
         batch_size = stems_batch.size()[0]
         encoded = self.arg_encoder(stems_batch, goals_encoded_batch,
                                    hyps_batch)
+        return self.score_encoded(encoded, hypfeatures_batch)
+
+    @torch.jit.export
+    def score_encoded(self, encoded: torch.FloatTensor,
+                      hypfeatures_batch: torch.FloatTensor) \
+            -> torch.FloatTensor:
         hyp_likelyhoods = self._likelyhood_decoder(
             torch.cat((encoded, hypfeatures_batch), dim=1))
         return hyp_likelyhoods
@@ -302,6 +416,20 @@ class FeaturesPolyargPredictor(
         # self._tokenizer : Optional[Tokenizer] = None
         # self._embedding : Optional[Embedding] = None
         self._model: Optional[FeaturesPolyArgModel] = None
+        # Goal encodings and hypothesis GRU inputs, keyed on their tokens.
+        # Sibling nodes in a search mostly share their goal and hypotheses,
+        # so each only needs to go through the model once. Hypothesis inputs
+        # are max_length times bigger than goal encodings, so fewer are kept.
+        self.encoding_cache_size = 16384
+        self.hyp_inputs_cache_size = 2048
+        self._goal_encodings: \
+            'OrderedDict[Tuple[int, ...], torch.FloatTensor]' = OrderedDict()
+        self._hyp_inputs: \
+            'OrderedDict[Tuple[int, ...], torch.FloatTensor]' = OrderedDict()
+
+    def clear_encoding_cache(self) -> None:
+        self._goal_encodings.clear()
+        self._hyp_inputs.clear()
 
     @property
     def goal_token_encoder(self) -> GoalTokenEncoderModel:
@@ -330,10 +458,20 @@ class FeaturesPolyargPredictor(
                                 (arg_values, sys.argv, metadata, state)), f)
 
     def predictKTactics_batch(self, contexts: List[TacticContext], k: int,
-                              verbosity:int = 0) -> List[List[Prediction]]:
+                              verbosity:int = 0,
+                              blacklist: Optional[List[str]] = None) \
+                              -> List[List[Prediction]]:
+        if blacklist is None:
+            blacklist = []
+        else:
+            for stem in blacklist:
+                assert coq_serapy.get_stem(stem) == stem, \
+                    "Item {stem} in blacklist isn't a tactic stem!"
         with torch.no_grad():
             all_predictions_batch = self.getAllPredictionIdxs_batch(contexts,
-                                                                    verbosity=verbosity)
+                                                                    verbosity=verbosity,
+                                                                    blacklist=blacklist,
+                                                                    first_chunk_size=2 * k)
 
         def generate():
             for context, prediction_idxs in zip(
@@ -353,11 +491,12 @@ class FeaturesPolyargPredictor(
         return predictions
 
     def getAllPredictionIdxs(self, context: TacticContext,
-                             blacklist: List[str]) -> List[Tuple[float, int, int]]:
+                             blacklist: List[str],
+                             first_chunk_size: int = 32) -> PredictionCandidates:
         assert self.training_args
         assert self._model
 
-        num_stem_poss = get_num_tokens(self.metadata)
+        num_stem_poss = get_num_tokens(self.metadata_handle)
         stem_width = min(16, num_stem_poss)
 
         tokenized_premises, hyp_features, \
@@ -365,7 +504,7 @@ class FeaturesPolyargPredictor(
             goal_mask, \
             word_features, vec_features = \
             sample_fpa(extract_dataloader_args(self.training_args),
-                       self.metadata,
+                       self.metadata_handle,
                        context.relevant_lemmas,
                        context.prev_tactics,
                        context.hypotheses,
@@ -375,7 +514,7 @@ class FeaturesPolyargPredictor(
             self._model, stem_width,
             LongTensor(word_features), FloatTensor(vec_features),
             [encode_fpa_stem(extract_dataloader_args(self.training_args),
-                             self.metadata, stem) for stem in blacklist])
+                             self.metadata_handle, stem) for stem in blacklist])
 
         goal_arg_values = self.goal_token_scores(
             self._model, self.training_args,
@@ -390,19 +529,23 @@ class FeaturesPolyargPredictor(
         else:
             total_scores = goal_arg_values
 
-        final_probs, predicted_stem_idxs, predicted_arg_idxs = \
-            self.predict_args(total_scores, stem_certainties, stem_idxs)
-
-        result = list(zip(list(final_probs), list(predicted_stem_idxs),
-                          list(predicted_arg_idxs)))
-        return result
+        log_probs = self.arg_log_probs_batch(total_scores, stem_certainties)
+        probs, stems, args = top_args(log_probs, stem_idxs, first_chunk_size)
+        return PredictionCandidates(
+            log_probs[0], stem_idxs[0],
+            list(zip(probs[0].tolist(), stems[0].tolist(), args[0].tolist())))
 
     def getAllPredictionIdxs_batch(self, contexts: List[TacticContext],
-                                   verbosity:int = 0) -> List[List[Tuple[float, int, int]]]:
+                                   verbosity:int = 0,
+                                   blacklist: Optional[List[str]] = None,
+                                   first_chunk_size: int = 32) \
+                                   -> List[PredictionCandidates]:
         assert self.training_args
         assert self._model
+        if blacklist is None:
+            blacklist = []
 
-        num_stem_poss = get_num_indices(self.metadata)[1]
+        num_stem_poss = get_num_indices(self.metadata_handle)
         stem_width = min(self.training_args.max_beam_width, num_stem_poss)
 
         tokenized_premises_batch, premise_features_batch, \
@@ -410,55 +553,49 @@ class FeaturesPolyargPredictor(
             goal_mask, \
             word_features, vec_features = \
             sample_fpa_batch(extract_dataloader_args(self.training_args),
-                             self.metadata,
+                             self.metadata_handle,
                              [context_py2r(context)
                               for context in contexts])
 
         _, stem_certainties_batch, stem_idxs_batch = self.predict_stems(
             self._model, stem_width, LongTensor(word_features), FloatTensor(vec_features),
-            [])
+            [encode_fpa_stem(extract_dataloader_args(self.training_args),
+                             self.metadata_handle, stem) for stem in blacklist])
 
         goal_arg_values_batch = self.goal_token_scores(
             self._model, self.training_args,
             stem_idxs_batch, LongTensor(tokenized_goal_batch),
             maybe_cuda(torch.BoolTensor(goal_mask)))
 
-        idxs_batch = []
-
-        for (stem_certainties, stem_idxs,
-             goal_arg_values, tokenized_goal,
-             tokenized_premises,
-             premise_features) in \
-            tqdm(zip(stem_certainties_batch, stem_idxs_batch,
-                     goal_arg_values_batch, tokenized_goal_batch,
-                     tokenized_premises_batch, premise_features_batch),
-                 desc="Assessing hyp args and decoding indices",
-                 total=len(contexts),
-                 disable=verbosity <= 1):
-            if len(tokenized_premises) > 0:
-                premise_arg_values = self.hyp_name_scores(
-                    stem_idxs,
-                    tokenized_goal,
-                    tokenized_premises,
-                    premise_features)
-                total_scores = torch.cat((goal_arg_values.unsqueeze(0),
-                                          premise_arg_values),
-                                         dim=2)
-            else:
-                total_scores = goal_arg_values.unsqueeze(0)
+        if any(len(tokenized_premises) > 0
+               for tokenized_premises in tokenized_premises_batch):
+            premise_arg_values_batch = self.hyp_name_scores_batch(
+                stem_idxs_batch, tokenized_goal_batch,
+                tokenized_premises_batch, premise_features_batch)
+            total_scores_batch = torch.cat((goal_arg_values_batch,
+                                            premise_arg_values_batch),
+                                           dim=2)
+        else:
+            total_scores_batch = goal_arg_values_batch
 
-            probs, stems, args = self.predict_args(
-                total_scores, stem_certainties, stem_idxs)
-            idxs_batch.append(list(zip(list(probs), list(stems), list(args))))
+        log_probs_batch = self.arg_log_probs_batch(total_scores_batch,
+                                                   stem_certainties_batch)
+        probs_batch, stems_batch, args_batch = top_args(
+            log_probs_batch, stem_idxs_batch, first_chunk_size)
 
-        return idxs_batch
+        return [PredictionCandidates(log_probs, stem_idxs,
+                                     list(zip(probs, stems, args)))
+                for log_probs, stem_idxs, probs, stems, args
+                in zip(log_probs_batch, stem_idxs_batch,
+                       probs_batch.tolist(), stems_batch.tolist(),
+                       args_batch.tolist())]
 
     def decodeNonDuplicatePredictions(
             self, context: TacticContext,
-            all_idxs: List[Tuple[float, int, int]],
+            all_idxs: PredictionCandidates,
             k: int) -> List[Prediction]:
         assert self.training_args
-        num_stem_poss = get_num_tokens(self.metadata)
+        num_stem_poss = get_num_tokens(self.metadata_handle)
         stem_width = min(self.training_args.max_beam_width, num_stem_poss)
 
         if self.training_args.lemma_args:
@@ -466,29 +603,36 @@ class FeaturesPolyargPredictor(
         else:
             all_hyps = context.hypotheses
 
-        prediction_strs: List[str] = []
-        prediction_probs: List[float] = []
-        next_i = 0
+        predictions: List[Prediction] = []
+        seen_strs: Set[str] = set()
+        num_considered = 0
         num_valid_probs = (1 + len(all_hyps) +
                            len(get_fpa_words(context.goal))) * stem_width
-        while len(prediction_strs) < k and next_i < num_valid_probs:
-            next_pred_str = decode_fpa_result(
-                extract_dataloader_args(self.training_args),
-                self.metadata,
-                all_hyps, context.goal,
-                all_idxs[next_i][1],
-                all_idxs[next_i][2])
-            # next_pred_str = ""
-            if next_pred_str not in prediction_strs:
-                prediction_strs.append(next_pred_str)
-                prediction_probs.append(math.exp(all_idxs[next_i][0]))
-            next_i += 1
-
-        predictions = [Prediction(s, prob) for s, prob in
-                       zip(prediction_strs, prediction_probs)]
+        for chunk in all_idxs.chunks():
+            chunk = chunk[:num_valid_probs - num_considered]
+            pred_strs = self.decode_chunk(all_hyps, context.goal, chunk)
+            for (log_prob, _, _), pred_str in zip(chunk, pred_strs):
+                if pred_str in seen_strs:
+                    continue
+                seen_strs.add(pred_str)
+                predictions.append(Prediction(pred_str, math.exp(log_prob)))
+                if len(predictions) >= k:
+                    return predictions
+            num_considered += len(chunk)
+            if num_considered >= num_valid_probs:
+                break
 
         return predictions
 
+    def decode_chunk(self, hyps: List[str], goal: str,
+                     chunk: List[Tuple[float, int, int]]) -> List[str]:
+        assert self.training_args
+        dataloader_args = extract_dataloader_args(self.training_args)
+        return decode_fpa_results(dataloader_args, self.metadata_handle,
+                                  hyps, goal,
+                                  [(stem_idx, arg_idx)
+                                   for _, stem_idx, arg_idx in chunk])
+
     def predictKTactics(self, context: TacticContext, k: int,
                         blacklist: Optional[List[str]] = None) -> List[Prediction]:
         assert self.training_args
@@ -502,7 +646,8 @@ class FeaturesPolyargPredictor(
                     "Item {stem} in blacklist isn't a tactic stem!"
 
         with torch.no_grad():
-            all_predictions = self.getAllPredictionIdxs(context, blacklist)
+            all_predictions = self.getAllPredictionIdxs(context, blacklist,
+                                                        first_chunk_size=2 * k)
 
         predictions = self.decodeNonDuplicatePredictions(
             context, all_predictions, k)
@@ -514,7 +659,7 @@ class FeaturesPolyargPredictor(
         assert self.training_args
         assert self._model
 
-        self.metadata, num_stem_poss = get_num_indices(self.metadata)
+        num_stem_poss = get_num_indices(self.metadata_handle)
         stem_width = min(self.training_args.max_beam_width, num_stem_poss)
 
         tokenized_premises, hyp_features, \
@@ -522,7 +667,7 @@ class FeaturesPolyargPredictor(
             goal_mask, \
             word_features, vec_features = \
             sample_fpa(extract_dataloader_args(self.training_args),
-                       self.metadata,
+                       self.metadata_handle,
                        context.relevant_lemmas,
                        context.prev_tactics,
                        context.hypotheses,
@@ -530,8 +675,12 @@ class FeaturesPolyargPredictor(
 
         prediction_stem, prediction_args = \
             coq_serapy.split_tactic(prediction)
-        prediction_stem_idx = encode_fpa_stem(extract_dataloader_args(self.training_args),
-                                              self.metadata, prediction_stem)
+        [(prediction_stem_idx, prediction_arg_idx)] = encode_fpa_actions(
+            extract_dataloader_args(self.training_args),
+            self.metadata_handle,
+            context.hypotheses + context.relevant_lemmas,
+            context.goal,
+            [(prediction_stem, prediction_args)])
         assert prediction_stem_idx < num_stem_poss
         stem_distributions = self._model.stem_classifier(
             maybe_cuda(torch.LongTensor(word_features)),
@@ -552,12 +701,6 @@ class FeaturesPolyargPredictor(
 
         prediction_stem_idx_idx = list(merged_stem_idxs[0]).index(
             prediction_stem_idx)
-        prediction_arg_idx = encode_fpa_arg(
-            extract_dataloader_args(self.training_args),
-            self.metadata,
-            context.hypotheses + context.relevant_lemmas,
-            context.goal,
-            prediction_args)
         assert prediction_arg_idx is not None, \
             (prediction, prediction_args, context.goal,
              [coq_serapy.get_var_term_in_hyp(hyp) for hyp
@@ -643,47 +786,177 @@ class FeaturesPolyargPredictor(
                         tokenized_premises: List[List[int]],
                         premise_features: List[List[float]]
                         ) -> torch.FloatTensor:
-        assert self._model
         assert len(stem_idxs.size()) == 1
-        stem_width = stem_idxs.size()[0]
-        num_hyps = len(tokenized_premises)
-        encoded_goals = self._model.goal_encoder(LongTensor([tokenized_goal]))
-        hyp_arg_values = self.runHypModel(stem_idxs.unsqueeze(0),
-                                          encoded_goals,
-                                          LongTensor([tokenized_premises]),
-                                          FloatTensor([premise_features]))
-        assert hyp_arg_values.size() == torch.Size([1, stem_width, num_hyps])
+        return self.hyp_name_scores_batch(stem_idxs.unsqueeze(0),
+                                          [tokenized_goal],
+                                          [tokenized_premises],
+                                          [premise_features])
+
+    def hyp_name_scores_batch(self,
+                              stem_idxs_batch: torch.LongTensor,
+                              tokenized_goals_batch: List[List[int]],
+                              tokenized_premises_batch: List[List[List[int]]],
+                              premise_features_batch: List[List[List[float]]]
+                              ) -> torch.FloatTensor:
+        assert self._model
+        assert self.training_args
+        batch_size = stem_idxs_batch.size()[0]
+        stem_width = stem_idxs_batch.size()[1]
+        max_hyps = max(len(tokenized_premises) for tokenized_premises
+                       in tokenized_premises_batch)
+        hidden_size = self.training_args.hidden_size
+        features_size = hypFeaturesSize()
+
+        # Pad every context out to the same number of hypotheses, and gather
+        # the (context, hypothesis) pairs that actually exist, so the
+        # hypothesis model runs once over every pair and stem in the batch.
+        # Padding scores -inf, so it sorts after every real argument.
+        padded_features = FloatTensor(
+            [premise_features +
+             [[0.] * features_size] * (max_hyps - len(premise_features))
+             for premise_features in premise_features_batch])
+        hyp_mask = maybe_cuda(torch.BoolTensor(
+            [[True] * len(tokenized_premises) +
+             [False] * (max_hyps - len(tokenized_premises))
+             for tokenized_premises in tokenized_premises_batch]))
+        context_idxs, hyp_idxs = hyp_mask.nonzero(as_tuple=True)
+        num_pairs = context_idxs.size()[0]
+        hyp_arg_values = maybe_cuda(torch.full(
+            (batch_size, max_hyps, stem_width), -float("Inf")))
+        if num_pairs == 0:
+            return hyp_arg_values.permute(0, 2, 1)
+
+        hyp_model = self._model.hyp_model
+        hyp_encoder = hyp_model.arg_encoder
+        # The GRU starts from a hidden state that depends on the stem and the
+        # goal, so compute one for each context and stem...
+        encodings = self.encode_goals(tokenized_goals_batch)
+        encoded_goals = torch.stack([encodings[tuple(tokenized_goal)]
+                                     for tokenized_goal
+                                     in tokenized_goals_batch])
+        initial_hidden = hyp_encoder.initial_hidden(
+            stem_idxs_batch.contiguous().view(batch_size * stem_width),
+            encoded_goals.view(batch_size, 1, hidden_size)
+            .expand(-1, stem_width, -1).contiguous()
+            .view(batch_size * stem_width, hidden_size))
+        # ...and run it over the cached inputs of each distinct hypothesis,
+        # with one row for each (context, hypothesis, stem), in that order.
+        pair_keys = [tuple(tokenized_premises_batch[context_idx][hyp_idx])
+                     for context_idx, hyp_idx
+                     in zip(context_idxs.tolist(), hyp_idxs.tolist())]
+        hyp_inputs = self.encode_hyp_inputs(pair_keys)
+        unique_keys = list(hyp_inputs.keys())
+        key_idxs = {key: idx for idx, key in enumerate(unique_keys)}
+        pair_hyp_idxs = LongTensor([key_idxs[key] for key in pair_keys])
+        stem_offsets = maybe_cuda(torch.arange(stem_width)).repeat(num_pairs)
+        encoded = hyp_encoder.encode_hyp_inputs(
+            initial_hidden.index_select(
+                0, (context_idxs * stem_width)
+                .repeat_interleave(stem_width) + stem_offsets),
+            torch.stack([hyp_inputs[key] for key in unique_keys]),
+            pair_hyp_idxs.repeat_interleave(stem_width))
+        pair_values = hyp_model.score_encoded(
+            encoded,
+            padded_features[context_idxs, hyp_idxs]
+            .repeat_interleave(stem_width, dim=0))\
+            .view(num_pairs, stem_width)
+
+        hyp_arg_values[context_idxs, hyp_idxs] = pair_values
+        hyp_arg_values = hyp_arg_values.permute(0, 2, 1)
+        assert hyp_arg_values.size() == torch.Size(
+            [batch_size, stem_width, max_hyps])
         return hyp_arg_values
 
+    def encode_goals(self, tokenized_goals: List[List[int]]) \
+            -> Dict[Tuple[int, ...], torch.FloatTensor]:
+        assert self._model
+        return self._encode_cached(self._goal_encodings,
+                                   self.encoding_cache_size,
+                                   self._model.goal_encoder,
+                                   tokenized_goals)
+
+    def encode_hyp_inputs(self, tokenized_hyps: List[Tuple[int, ...]]) \
+            -> Dict[Tuple[int, ...], torch.FloatTensor]:
+        assert self._model
+        return self._encode_cached(self._hyp_inputs,
+                                   self.hyp_inputs_cache_size,
+                                   self._model.hyp_model.arg_encoder
+                                   .hyp_inputs,
+                                   tokenized_hyps)
+
+    def _encode_cached(self,
+                       cache: 'OrderedDict[Tuple[int, ...], torch.FloatTensor]',
+                       max_size: int,
+                       encode: Callable[[torch.LongTensor], torch.FloatTensor],
+                       token_lists: Sequence[Sequence[int]]) \
+            -> Dict[Tuple[int, ...], torch.FloatTensor]:
+        """
+        Encodes each distinct token list, going through the model only for
+        the ones that aren't in the cache yet.
+        """
+        encoded: Dict[Tuple[int, ...], torch.FloatTensor] = {}
+        new_token_lists: List[Sequence[int]] = []
+        for tokens in token_lists:
+            key = tuple(tokens)
+            cached = cache.get(key)
+            if cached is not None:
+                cache.move_to_end(key)
+                encoded[key] = cached
+            elif key not in encoded:
+                new_token_lists.append(tokens)
+                encoded[key] = None # type: ignore
+        if len(new_token_lists) > 0:
+            new_encodings = encode(LongTensor(
+                [list(tokens) for tokens in new_token_lists]))
+            for tokens, encoding in zip(new_token_lists, new_encodings):
+                key = tuple(tokens)
+                encoded[key] = encoding.detach()
+                cache[key] = encoding.detach()
+            while len(cache) > max_size:
+                cache.popitem(last=False)
+        return encoded
+
     def predict_args(self,
                      total_scores: torch.FloatTensor,
                      stem_certainties: torch.FloatTensor,
                      stem_idxs: torch.LongTensor
                      ) -> Tuple[torch.FloatTensor, torch.LongTensor,
                                 torch.LongTensor]:
+        assert total_scores.size()[0] == 1
+        prediction_probs, predicted_stem_idxs, predicted_arg_idxs = \
+            self.predict_args_batch(total_scores, stem_certainties, stem_idxs)
+        return prediction_probs[0], predicted_stem_idxs[0], \
+            predicted_arg_idxs[0]
+
+    def predict_args_batch(self,
+                           total_scores: torch.FloatTensor,
+                           stem_certainties: torch.FloatTensor,
+                           stem_idxs: torch.LongTensor
+                           ) -> Tuple[torch.FloatTensor, torch.LongTensor,
+                                      torch.LongTensor]:
+        batch_size = total_scores.size()[0]
+        stem_width = total_scores.size()[1]
+        num_probs_per_stem = total_scores.size()[2]
+        prediction_probs, predicted_stem_idxs, predicted_arg_idxs = top_args(
+            self.arg_log_probs_batch(total_scores, stem_certainties),
+            stem_idxs)
+        assert prediction_probs.size() == torch.Size(
+            [batch_size, stem_width * num_probs_per_stem])
+        return prediction_probs, predicted_stem_idxs, predicted_arg_idxs
+
+    def arg_log_probs_batch(self,
+                            total_scores: torch.FloatTensor,
+                            stem_certainties: torch.FloatTensor
+                            ) -> torch.FloatTensor:
         batch_size = total_scores.size()[0]
-        assert batch_size == 1
         stem_width = total_scores.size()[1]
         num_probs_per_stem = total_scores.size()[2]
-        all_prob_batches = self._softmax(
+        return self._softmax(
             (total_scores +
              stem_certainties.view(batch_size, stem_width, 1)
              .expand(-1, -1, num_probs_per_stem))
             .contiguous()
             .view(batch_size, stem_width * num_probs_per_stem))
-        prediction_probs, arg_idxs = all_prob_batches.sort(descending=True)
-        assert prediction_probs.size() == torch.Size(
-            [batch_size, stem_width * num_probs_per_stem])
-        assert arg_idxs.size() == torch.Size(
-            [batch_size, stem_width * num_probs_per_stem])
-        predicted_stem_keys = torch.div(arg_idxs, num_probs_per_stem,
-                                        rounding_mode="floor")
-        predicted_stem_idxs = stem_idxs.view(stem_width)\
-                                       .index_select(
-                                           0, predicted_stem_keys.squeeze(
-                                               dim=0))
-        predicted_arg_idxs = arg_idxs % num_probs_per_stem
-        return prediction_probs[0], predicted_stem_idxs, predicted_arg_idxs[0]
 
     def predictKTacticsWithLoss(self, in_data: TacticContext, k: int, correct: str) -> \
             Tuple[List[Prediction], float]:
@@ -695,40 +968,6 @@ class FeaturesPolyargPredictor(
             Tuple[List[List[Prediction]], float]:
         return self.predictKTactics_batch(in_datas, k), 0
 
-    def runHypModel(self, stem_idxs: torch.LongTensor, encoded_goals: torch.FloatTensor,
-                    hyps_batch: torch.LongTensor, hypfeatures_batch: torch.FloatTensor):
-        assert self._model
-        assert self.training_args
-        batch_size = encoded_goals.size()[0]
-        assert batch_size == 1
-        num_hyps = hyps_batch.size()[1]
-        beam_width = stem_idxs.size()[1]
-        if hypfeatures_batch.size()[1] == 0:
-            return maybe_cuda(torch.zeros(batch_size, beam_width, 0))
-        features_size = hypfeatures_batch.size()[2]
-        hyp_arg_values = \
-            self._model.hyp_model(stem_idxs.view(batch_size, beam_width, 1)
-                                  .expand(-1, -1, num_hyps).contiguous()
-                                  .view(batch_size * beam_width * num_hyps),
-                                  encoded_goals.view(batch_size, 1,
-                                                     self.training_args.hidden_size)
-                                  .expand(-1, beam_width * num_hyps, -1)
-                                  .contiguous()
-                                  .view(batch_size * beam_width * num_hyps,
-                                        self.training_args.hidden_size),
-                                  hyps_batch.view(batch_size, 1, num_hyps,
-                                                  self.training_args.max_length)
-                                  .expand(-1, beam_width, -1, -1).contiguous()
-                                  .view(batch_size * beam_width * num_hyps,
-                                        self.training_args.max_length),
-                                  hypfeatures_batch
-                                  .view(batch_size, 1, num_hyps, features_size)
-                                  .expand(-1, beam_width, -1, -1).contiguous()
-                                  .view(batch_size * beam_width * num_hyps,
-                                        features_size))\
-            .view(batch_size, beam_width, num_hyps)
-        return hyp_arg_values
-
     def getOptions(self) -> List[Tuple[str, str]]:
         assert self.training_args
         assert self.training_loss
@@ -782,6 +1021,15 @@ class FeaturesPolyargPredictor(
         parser.add_argument("--print-tensors", action="store_true")
         parser.add_argument("--load-text-tokens", default=None)
         parser.add_argument("--load-tensors", default=None)
+        parser.add_argument("--tensor-cache-dir", default=None,
+                            help="Directory to cache the encoded training "
+                            "tensors in, so later runs on the same data "
+                            "can skip parsing it. Defaults to the scrape "
+                            "file name plus \".tensors\"")
+        parser.add_argument("--no-tensor-cache", dest="tensor_cache",
+                            action="store_false",
+                            help="Build the training tensors in memory "
+                            "instead of memory-mapping them from the cache")
 
         parser.add_argument("--save-embedding", type=str, default=None)
         parser.add_argument("--save-features-state", type=str, default=None)
@@ -799,48 +1047,19 @@ class FeaturesPolyargPredictor(
             if arg_values.start_from:
                 _, (old_arg_values, unparsed_args,
                     metadata, state) = torch.load(arg_values.start_from)
-                _, data_lists, \
+            else:
+                metadata = None
+            if arg_values.tensor_cache:
+                metadata, tensors, \
                     (word_features_size, vec_features_size) = \
-                    features_polyarg_tensors_with_meta(
-                        extract_dataloader_args(arg_values),
-                        str(arg_values.scrape_file),
-                        metadata)
+                    fpa_tensors_cached(arg_values, metadata)
             else:
-                metadata, data_lists, \
+                metadata, tensors, \
                     (word_features_size, vec_features_size) = \
-                    features_polyarg_tensors(
-                        extract_dataloader_args(arg_values),
-                        str(arg_values.scrape_file))
-        with print_time("Converting data to tensors", guard=arg_values.verbose):
-            unpadded_tokenized_hyp_types, \
-                unpadded_hyp_features, \
-                num_hyps, \
-                tokenized_goals, \
-                goal_masks, \
-                word_features, \
-                vec_features, \
-                tactic_stem_indices, \
-                arg_indices = data_lists
-
-            tensors = [pad_sequence([torch.LongTensor(tokenized_hyps_list)
-                                     for tokenized_hyps_list
-                                     in unpadded_tokenized_hyp_types],
-                                    batch_first=True),
-                       pad_sequence([torch.FloatTensor(hyp_features_vec)
-                                     for hyp_features_vec
-                                     in unpadded_hyp_features],
-                                    batch_first=True),
-                       torch.LongTensor(num_hyps),
-                       torch.LongTensor(tokenized_goals),
-                       torch.ByteTensor(goal_masks),
-                       torch.LongTensor(word_features),
-                       torch.FloatTensor(vec_features),
-                       torch.LongTensor(tactic_stem_indices),
-                       torch.LongTensor(arg_indices)]
-            with open("tensors.pickle", 'wb') as f:
-                torch.save(tensors, f)
-            eprint(tensors, guard=arg_values.print_tensors)
+                    fpa_tensors(arg_values, metadata)
+        eprint(tensors, guard=arg_values.print_tensors)
 
+        metadata_handle = FPAMetadataHandle(metadata)
         with print_time("Building the model", guard=arg_values.verbose):
 
             if arg_values.start_from:
@@ -852,36 +1071,41 @@ class FeaturesPolyargPredictor(
                 model = self._get_model(arg_values,
                                         word_features_size,
                                         vec_features_size,
-                                        get_num_indices(metadata)[1],
-                                        get_num_tokens(metadata))
+                                        get_num_indices(metadata_handle),
+                                        get_num_tokens(metadata_handle))
                 epoch_start = 1
 
         assert model
         assert epoch_start
         return ((metadata, state) for state in optimize_checkpoints(tensors, arg_values, model,
                                                                     lambda batch_tensors, model:
-                                                                    self._getBatchPredictionLoss(arg_values, metadata,
+                                                                    self._getBatchPredictionLoss(arg_values, metadata_handle,
                                                                                                  batch_tensors,
-                                                                                                 model), epoch_start))
+                                                                                                 model), epoch_start,
+                                                                    sample_lengths=tensors[2].tolist(),
+                                                                    collate_fn=fpa_collate))
 
     def load_saved_state(self,
                          args: Namespace,
                          unparsed_args: List[str],
                          metadata: Any,
                          state: NeuralPredictorState) -> None:
+        metadata_handle = FPAMetadataHandle(metadata)
         model = maybe_cuda(self._get_model(args,
                                            get_word_feature_vocab_sizes(
-                                               metadata),
-                                           get_vec_features_size(metadata),
-                                           get_num_indices(metadata)[1],
-                                           get_num_tokens(metadata)))
+                                               metadata_handle),
+                                           get_vec_features_size(metadata_handle),
+                                           get_num_indices(metadata_handle),
+                                           get_num_tokens(metadata_handle)))
         model.load_state_dict(state.weights)
         self._model = model
+        self.clear_encoding_cache()
         self.training_loss = state.loss
         self.num_epochs = state.epoch
         self.training_args = args
         self.unparsed_args = unparsed_args
         self.metadata = metadata
+        self.metadata_handle = metadata_handle
 
     def _get_model(self, arg_values: Namespace,
                    wordf_sizes: List[int],
@@ -902,7 +1126,7 @@ class FeaturesPolyargPredictor(
                         hypFeaturesSize(), arg_values.hidden_size))
 
     def _getBatchPredictionLoss(self, arg_values: Namespace,
-                                metadata,
+                                metadata_handle: FPAMetadataHandle,
                                 batch: Sequence[torch.Tensor],
                                 model: FeaturesPolyArgModel) -> torch.FloatTensor:
         tokenized_hyp_types_batch, hyp_features_batch, num_hyps_batch, \
@@ -916,7 +1140,7 @@ class FeaturesPolyargPredictor(
                  batch)
         batch_size = tokenized_goals_batch.size()[0]
         goal_size = tokenized_goals_batch.size()[1]
-        num_stem_poss = get_num_indices(metadata)[1]
+        num_stem_poss = get_num_indices(metadata_handle)
         stem_width = min(arg_values.max_beam_width, num_stem_poss)
         stemDistributions, predictedProbs, predictedStemIdxs = \
           self.predict_stems(model, stem_width, word_features_batch,
@@ -1011,6 +1235,7 @@ class FeaturesPolyargPredictor(
         self._model.share_memory()
     def to_device(self, device) -> None:
         self._model.to(device=device)
+        self.clear_encoding_cache()
 
 
 def hypFeaturesSize() -> int:
@@ -1036,6 +1261,133 @@ def extract_dataloader_args(args: argparse.Namespace) -> DataloaderArgs:
     return dargs
 
 
+FPA_TENSOR_CACHE_VERSION = 1
+FPA_TENSOR_NAMES = ["tokenized_hyp_types", "hyp_features", "num_hyps",
+                    "tokenized_goals", "goal_masks", "word_features",
+                    "vec_features", "tactic_stem_indices", "arg_indices"]
+
+
+def fpa_tensors(arg_values: Namespace, metadata: Optional[Any]) \
+        -> Tuple[Any, List[torch.Tensor], Tuple[List[int], int]]:
+    if metadata is not None:
+        metadata, data_lists, sizes = features_polyarg_tensors_with_meta(
+            extract_dataloader_args(arg_values),
+            str(arg_values.scrape_file),
+            metadata)
+    else:
+        metadata, data_lists, sizes = features_polyarg_tensors(
+            extract_dataloader_args(arg_values),
+            str(arg_values.scrape_file))
+    with print_time("Converting data to tensors", guard=arg_values.verbose):
+        unpadded_tokenized_hyp_types, \
+            unpadded_hyp_features, \
+            num_hyps, \
+            tokenized_goals, \
+            goal_masks, \
+            word_features, \
+            vec_features, \
+            tactic_stem_indices, \
+            arg_indices = data_lists
+
+        tensors = [pad_sequence([torch.LongTensor(tokenized_hyps_list)
+                                 for tokenized_hyps_list
+                                 in unpadded_tokenized_hyp_types],
+                                batch_first=True),
+                   pad_sequence([torch.FloatTensor(hyp_features_vec)
+                                 for hyp_features_vec
+                                 in unpadded_hyp_features],
+                                batch_first=True),
+                   torch.LongTensor(num_hyps),
+                   torch.LongTensor(tokenized_goals),
+                   torch.ByteTensor(goal_masks),
+                   torch.LongTensor(word_features),
+                   torch.FloatTensor(vec_features),
+                   torch.LongTensor(tactic_stem_indices),
+                   torch.LongTensor(arg_indices)]
+    return metadata, tensors, sizes
+
+
+def fpa_collate(samples: List[Tuple[torch.Tensor, ...]]) -> List[torch.Tensor]:
+    """
+    Stack a batch of samples, trimming the hypothesis padding down to the
+    most hypotheses of any sample in the batch. Hypothesis arguments are
+    indexed after the goal tokens, so trimming the end of the hypothesis
+    dimension doesn't change any argument indices. Goals are left at
+    max_length: the goal models run their GRUs over the padding up to the
+    EOS token, so trimming it would change their outputs.
+    """
+    tokenized_hyp_types, hyp_features, num_hyps, *rest = \
+        default_collate(samples)
+    max_hyps = max(int(num_hyps.max()), 1)
+    return [tokenized_hyp_types[:, :max_hyps].contiguous(),
+            hyp_features[:, :max_hyps].contiguous(),
+            num_hyps, *rest]
+
+
+def fpa_tensor_cache_key(arg_values: Namespace,
+                         metadata: Optional[Any]) -> str:
+    key_parts = {
+        "version": FPA_TENSOR_CACHE_VERSION,
+        "scrape_file": util.hash_file(str(arg_values.scrape_file)),
+        "args": {field: getattr(arg_values, field) for field in
+                 ["max_tuples", "max_length", "num_keywords",
+                  "max_string_distance", "max_premises",
+                  "num_relevance_samples", "context_filter"]},
+        "files": {field: util.hash_file(getattr(arg_values, field))
+                  for field in ["load_tokens", "load_embedding",
+                                "load_features_state"]
+                  if getattr(arg_values, field)},
+        "metadata": hashlib.sha1(pickle.dumps(metadata)).hexdigest()
+                    if metadata is not None else None,
+    }
+    return hashlib.sha1(json.dumps(key_parts, sort_keys=True)
+                        .encode("utf-8")).hexdigest()
+
+
+def fpa_tensors_cached(arg_values: Namespace, metadata: Optional[Any]) \
+        -> Tuple[Any, List[torch.Tensor], Tuple[List[int], int]]:
+    """
+    Load the training tensors from the cache directory, encoding the scrape
+    file into it first if this data and these arguments haven't been seen
+    before. The tensors are memory-mapped (copy-on-write) from .npy files, so
+    loading them doesn't copy the dataset into memory.
+    """
+    if arg_values.tensor_cache_dir:
+        cache_root = Path(arg_values.tensor_cache_dir)
+    else:
+        cache_root = Path(str(arg_values.scrape_file) + ".tensors")
+    cache_dir = cache_root / fpa_tensor_cache_key(arg_values, metadata)
+    # The embedding and features state are only written out while encoding,
+    # so saving them means encoding again even if the entry is there.
+    must_encode = arg_values.save_embedding or arg_values.save_features_state
+    if must_encode or not (cache_dir / "metadata.pickle").exists():
+        tmp_dir = cache_dir.with_name(f"{cache_dir.name}.tmp-{os.getpid()}")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        new_metadata, sizes = features_polyarg_tensors_to_npy(
+            extract_dataloader_args(arg_values),
+            str(arg_values.scrape_file),
+            metadata, str(tmp_dir))
+        with (tmp_dir / "metadata.pickle").open('wb') as f:
+            pickle.dump((FPA_TENSOR_CACHE_VERSION, new_metadata, sizes), f)
+        if must_encode and cache_dir.exists():
+            shutil.rmtree(cache_dir)
+        try:
+            tmp_dir.rename(cache_dir)
+        except OSError:
+            # Another run filled in the same cache entry first.
+            shutil.rmtree(tmp_dir)
+    else:
+        eprint(f"Loading cached tensors from {cache_dir}",
+               guard=arg_values.verbose)
+    with (cache_dir / "metadata.pickle").open('rb') as f:
+        version, metadata, sizes = pickle.load(f)
+    assert version == FPA_TENSOR_CACHE_VERSION
+    tensors = [torch.from_numpy(np.load(cache_dir / f"{name}.npy",
+                                        mmap_mode="c"))
+               for name in FPA_TENSOR_NAMES]
+    return metadata, tensors, sizes
+
+
 def context_py2r(py_context: TacticContext) -> dataloader.TacticContext:
     return dataloader.TacticContext(
         py_context.relevant_lemmas, py_context.prev_tactics,
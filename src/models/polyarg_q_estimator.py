@@ -23,7 +23,7 @@ import argparse
 import sys
 from tqdm import tqdm
 from typing import (Dict, List, Tuple, cast, BinaryIO, TypeVar, Any,
-                    Optional, Sequence)
+                    Optional, Sequence, Iterable)
 
 import torch
 import torch.nn as nn
@@ -39,17 +39,17 @@ from util import maybe_cuda, eprint
 from coq_serapy.contexts import TacticContext
 from models.q_estimator import QEstimator
 from models.components import WordFeaturesEncoder, DNNScorer
-from models.features_polyarg_predictor import FeaturesPolyargPredictor
-from dataloader import (sample_context_features,
+from models.features_polyarg_predictor import (FeaturesPolyargPredictor,
+                                               context_py2r)
+from dataloader import (sample_contexts_features,
                         get_vec_features_size,
                         get_word_feature_vocab_sizes,
-                        encode_fpa_stem,
-                        encode_fpa_arg,
+                        encode_fpa_actions,
                         get_num_indices,
                         get_num_tokens,
-                        get_premise_features,
+                        get_premises_features,
                         get_premise_features_size,
-                        tokenize)
+                        tokenize_batch)
 
 PolyargQMetadata = Tuple[Dict[str, int], Dict[str, int]]
 
@@ -60,11 +60,11 @@ class PolyargQEstimator(QEstimator):
             -> None:
         self.predictor = fpa_predictor
         self.model = PolyargQModel(
-            get_vec_features_size(fpa_predictor.metadata) +
+            get_vec_features_size(fpa_predictor.metadata_handle) +
             self.action_vec_features_size() +
             1,  # The extra 1 is for the certainty feature
             self.action_word_features_sizes() +
-            get_word_feature_vocab_sizes(fpa_predictor.metadata),
+            get_word_feature_vocab_sizes(fpa_predictor.metadata_handle),
             128, 2)
         self.optimizer = optim.SGD(self.model.parameters(), learning_rate)
         self.adjuster = scheduler.StepLR(self.optimizer, batch_step,
@@ -76,6 +76,10 @@ class PolyargQEstimator(QEstimator):
     def fpa_metadata(self):
         return self.predictor.metadata
 
+    @property
+    def fpa_metadata_handle(self):
+        return self.predictor.metadata_handle
+
     @property
     def dataloader_args(self):
         return self.predictor.dataloader_args
@@ -83,51 +87,61 @@ class PolyargQEstimator(QEstimator):
     def __call__(self, inputs: List[Tuple[TacticContext, str, float]],
                  progress: bool = False) \
             -> List[float]:
-        state_word_features_batch, state_vec_features_batch \
-            = zip(*[self._features(state, certainty) for
-                    (state, action, certainty) in inputs])
+        word_features_batch, vec_features_batch = \
+            self._input_tensors(inputs, progress=progress)
         with torch.no_grad():
-            encoded_actions_batch = [self._encode_action(state, action)
-                                     for (state, action, certainty) in
-                                     tqdm(inputs, desc="Encoding actions",
-                                          disable=not progress)]
-        all_vec_features_batch = [torch.cat((maybe_cuda(action_vec),
-                                             maybe_cuda(torch.FloatTensor(svf))),
-                                            dim=0).unsqueeze(0)
-                                  for (_, action_vec), svf in
-                                  zip(encoded_actions_batch,
-                                      state_vec_features_batch)]
-        all_word_features_batch = [action_words + swf
-                                   for (action_words, _), swf in
-                                   zip(encoded_actions_batch,
-                                       state_word_features_batch)]
-        with torch.no_grad():
-            output = self.model(torch.LongTensor(all_word_features_batch),
-                                torch.cat(all_vec_features_batch, dim=0))
-        for item in output:
-            assert item == item, (output,
-                                  all_word_features_batch,
-                                  all_vec_features_batch)
+            output = self.model(word_features_batch, vec_features_batch)
+        assert not torch.any(torch.isnan(output)), \
+            (output, word_features_batch, vec_features_batch)
         return list(output)
 
     def get_input_tensors(self,
                           samples: List[Tuple[TacticContext, str,
                                               float, float]]) \
             -> List[torch.Tensor]:
-        state_word_features, state_vec_features = zip(
-            *[self._features(state, certainty)
-              for state, _, certainty, _ in samples])
-        encoded_actions = [self._encode_action(state, action)
-                           for state, action, _, _ in samples]
-        all_vec_features = [torch.cat((maybe_cuda(action_vec),
-                                       maybe_cuda(torch.FloatTensor(svf))),
-                                       dim=0).unsqueeze(0)
-                            for (_, action_vec), svf in
-                            zip(encoded_actions, state_vec_features)]
-        all_word_features = [action_words + swf for (action_words, _), swf in
-                             zip(encoded_actions, state_word_features)]
-        return [torch.LongTensor(all_word_features),
-                torch.cat(all_vec_features, dim=0)]
+        return list(self._input_tensors(
+            [(state, action, certainty)
+             for state, action, certainty, _ in samples]))
+
+    def _input_tensors(self, inputs: Sequence[Tuple[TacticContext, str, float]],
+                       progress: bool = False) \
+            -> Tuple[torch.LongTensor, torch.FloatTensor]:
+        # Many queries share a state (one per predicted action), so each
+        # distinct context is featurized only once, and its features are
+        # gathered out for every query that uses it.
+        context_idxs: Dict[Tuple[Tuple[str, ...], Tuple[str, ...],
+                                 Tuple[str, ...], str], int] = {}
+        unique_contexts: List[TacticContext] = []
+        query_context_idxs: List[int] = []
+        for context, _, _ in inputs:
+            key = (tuple(context.relevant_lemmas), tuple(context.prev_tactics),
+                   tuple(context.hypotheses), context.goal)
+            if key not in context_idxs:
+                context_idxs[key] = len(unique_contexts)
+                unique_contexts.append(context)
+            query_context_idxs.append(context_idxs[key])
+        context_word_features, context_vec_features = \
+            sample_contexts_features(self.dataloader_args,
+                                     self.fpa_metadata_handle,
+                                     [context_py2r(context)
+                                      for context in unique_contexts])
+        action_word_features, action_vec_features = self._encode_actions(
+            unique_contexts,
+            [(context_idx, action) for context_idx, (_, action, _)
+             in zip(query_context_idxs, inputs)],
+            progress=progress)
+        query_context_idxs_tensor = torch.LongTensor(query_context_idxs)
+        word_features = torch.cat(
+            (action_word_features,
+             torch.LongTensor(context_word_features)[query_context_idxs_tensor]),
+            dim=1)
+        vec_features = torch.cat(
+            (action_vec_features,
+             torch.FloatTensor(context_vec_features)[query_context_idxs_tensor],
+             torch.FloatTensor([certainty for _, _, certainty in inputs])
+             .unsqueeze(1)),
+            dim=1)
+        return word_features, vec_features
 
     def train(self, samples: List[Tuple[TacticContext, str, float, float]],
               batch_size: Optional[int] = None,
@@ -169,85 +183,131 @@ class PolyargQEstimator(QEstimator):
                        guard=show_loss and epoch % 10 == 0
                        and idx == len(batches) - 1)
 
-    def _features(self, context: TacticContext, certainty: float) \
-            -> Tuple[List[int], List[float]]:
-        cword_feats, cvec_feats = \
-            sample_context_features(self.dataloader_args,
-                                    self.fpa_metadata,
-                                    context.relevant_lemmas,
-                                    context.prev_tactics,
-                                    context.hypotheses,
-                                    context.goal)
-        return cword_feats, cvec_feats + [certainty]
-
     def action_vec_features_size(self) -> int:
         premise_features_size = get_premise_features_size(
             self.dataloader_args,
-            self.fpa_metadata)
+            self.fpa_metadata_handle)
         return 128 + premise_features_size
 
     def action_word_features_sizes(self) -> List[int]:
-        self.predictor.metadata, num_indices = get_num_indices(self.fpa_metadata)
+        num_indices = get_num_indices(self.fpa_metadata_handle)
         return [num_indices, 3]
 
-    def _encode_action(self, context: TacticContext, action: str) \
-            -> Tuple[List[int], torch.FloatTensor]:
-        stem, argument = serapi_instance.split_tactic(action)
-        stem_idx = encode_fpa_stem(self.dataloader_args,
-                                   self.fpa_metadata,
-                                   stem)
-        all_prems = context.hypotheses + context.relevant_lemmas
-        arg_idx = encode_fpa_arg(self.dataloader_args,
-                                 self.fpa_metadata,
-                                 all_prems,
-                                 context.goal,
-                                 argument.strip())
-        assert arg_idx is not None, (action, argument.strip(), context.goal)
-
-        tokenized_goal = tokenize(self.dataloader_args,
-                                  self.fpa_metadata,
-                                  context.goal)
+    def _encode_actions(self, contexts: List[TacticContext],
+                        actions: List[Tuple[int, str]],
+                        progress: bool = False) \
+            -> Tuple[torch.LongTensor, torch.FloatTensor]:
+        """
+        Encode each (context index, action) pair as the word features
+        [stem index, argument type] and a vector of the encoded argument
+        followed by its premise features. The dataloader is called once per
+        context, and the argument encoders run once for the whole batch.
+        """
+        max_length = self.dataloader_args.max_length
         premise_features_size = get_premise_features_size(
             self.dataloader_args,
-            self.fpa_metadata)
-        if arg_idx == 0:
-            # No arg
-            arg_type_idx = 0
-            encoded_arg = torch.zeros(128 + premise_features_size)
-        elif arg_idx <= self.dataloader_args.max_length:
-            # Goal token arg
-            arg_type_idx = 1
-            encoded_arg = maybe_cuda(torch.cat((
-                self.predictor.goal_token_encoder(
-                    torch.LongTensor([stem_idx]),
-                    torch.LongTensor([tokenized_goal])
-                ).squeeze(0)[arg_idx].to(device=torch.device("cpu")),
-               torch.zeros(premise_features_size)),
-                                    dim=0))
-        else:
-            # Hyp arg
-            arg_type_idx = 2
-            arg_hyp = all_prems[
-                arg_idx - (self.dataloader_args.max_length + 1)]
-            entire_encoded_goal = self.predictor.entire_goal_encoder(
-                torch.LongTensor([tokenized_goal]))
-            tokenized_arg_hyp = tokenize(
+            self.fpa_metadata_handle)
+        actions_by_context: List[List[Tuple[int, str]]] = [[] for _ in contexts]
+        for row, (context_idx, action) in enumerate(actions):
+            actions_by_context[context_idx].append((row, action))
+
+        word_features: List[List[int]] = [[] for _ in actions]
+        vec_features = torch.zeros(len(actions), 128 + premise_features_size)
+        tokenized_goals: List[List[int]] = []
+        goal_arg_rows: List[int] = []
+        goal_arg_stems: List[int] = []
+        goal_arg_goals: List[int] = []
+        goal_arg_idxs: List[int] = []
+        hyp_arg_rows: List[int] = []
+        hyp_arg_stems: List[int] = []
+        hyp_arg_goals: List[int] = []
+        hyp_arg_tokens: List[List[int]] = []
+        hyp_arg_features: List[List[float]] = []
+        for context, context_actions in tqdm(zip(contexts, actions_by_context),
+                                             total=len(contexts),
+                                             desc="Encoding actions",
+                                             disable=not progress):
+            if not context_actions:
+                continue
+            split_actions = [serapi_instance.split_tactic(action)
+                             for _, action in context_actions]
+            all_prems = context.hypotheses + context.relevant_lemmas
+            encoded_idxs = encode_fpa_actions(self.dataloader_args,
+                                              self.fpa_metadata_handle,
+                                              all_prems,
+                                              context.goal,
+                                              [(stem, argument.strip())
+                                               for stem, argument in split_actions])
+            for (_, action), (_, argument), (_, arg_idx) in \
+                    zip(context_actions, split_actions, encoded_idxs):
+                assert arg_idx is not None, (action, argument.strip(),
+                                             context.goal)
+
+            hyp_idxs = sorted({arg_idx - (max_length + 1)
+                               for _, arg_idx in encoded_idxs
+                               if arg_idx is not None and arg_idx > max_length})
+            arg_hyps = [all_prems[hyp_idx] for hyp_idx in hyp_idxs]
+            tokenized_terms = tokenize_batch(
+                self.dataloader_args,
+                self.fpa_metadata_handle,
+                [context.goal] + [serapi_instance.get_hyp_type(arg_hyp)
+                                  for arg_hyp in arg_hyps])
+            goal_slot = len(tokenized_goals)
+            tokenized_goals.append(tokenized_terms[0])
+            tokenized_arg_hyps = dict(zip(hyp_idxs, tokenized_terms[1:]))
+            arg_hyp_features = dict(zip(hyp_idxs, get_premises_features(
                 self.dataloader_args,
-                self.fpa_metadata,
-                serapi_instance.get_hyp_type(arg_hyp))
-            encoded_arg = maybe_cuda(torch.cat((
-                self.predictor.hyp_encoder(
-                    torch.LongTensor([stem_idx]),
-                    entire_encoded_goal,
-                    torch.LongTensor([tokenized_arg_hyp])).to(device=torch.device("cpu")),
-                torch.FloatTensor(get_premise_features(
-                    self.dataloader_args,
-                    self.fpa_metadata,
-                    context.goal,
-                    arg_hyp))),
-                                     dim=0))
-
-        return [stem_idx, arg_type_idx], encoded_arg
+                self.fpa_metadata_handle,
+                context.goal,
+                arg_hyps)))
+
+            for (row, _), (stem_idx, arg_idx) in zip(context_actions,
+                                                     encoded_idxs):
+                assert arg_idx is not None
+                if arg_idx == 0:
+                    # No arg
+                    arg_type_idx = 0
+                elif arg_idx <= max_length:
+                    # Goal token arg
+                    arg_type_idx = 1
+                    goal_arg_rows.append(row)
+                    goal_arg_stems.append(stem_idx)
+                    goal_arg_goals.append(goal_slot)
+                    goal_arg_idxs.append(arg_idx)
+                else:
+                    # Hyp arg
+                    arg_type_idx = 2
+                    hyp_idx = arg_idx - (max_length + 1)
+                    hyp_arg_rows.append(row)
+                    hyp_arg_stems.append(stem_idx)
+                    hyp_arg_goals.append(goal_slot)
+                    hyp_arg_tokens.append(tokenized_arg_hyps[hyp_idx])
+                    hyp_arg_features.append(arg_hyp_features[hyp_idx])
+                word_features[row] = [stem_idx, arg_type_idx]
+
+        goals_tensor = torch.LongTensor(tokenized_goals)
+        with torch.no_grad():
+            if goal_arg_rows:
+                encoded_goal_tokens = self.predictor.goal_token_encoder(
+                    torch.LongTensor(goal_arg_stems),
+                    goals_tensor[torch.LongTensor(goal_arg_goals)])\
+                    .to(device=torch.device("cpu"))
+                vec_features[torch.LongTensor(goal_arg_rows), :128] = \
+                    encoded_goal_tokens[torch.arange(len(goal_arg_rows)),
+                                        torch.LongTensor(goal_arg_idxs)]
+            if hyp_arg_rows:
+                encoded_goals = self.predictor.entire_goal_encoder(
+                    goals_tensor)
+                hyp_rows = torch.LongTensor(hyp_arg_rows)
+                vec_features[hyp_rows, :128] = self.predictor.hyp_encoder(
+                    torch.LongTensor(hyp_arg_stems),
+                    encoded_goals[maybe_cuda(torch.LongTensor(hyp_arg_goals))],
+                    torch.LongTensor(hyp_arg_tokens))\
+                    .to(device=torch.device("cpu"))
+                vec_features[hyp_rows, 128:] = \
+                    torch.FloatTensor(hyp_arg_features)
+
+        return torch.LongTensor(word_features), vec_features
 
     def save_weights(self, filename: Path2, args: argparse.Namespace) -> None:
         with cast(BinaryIO, filename.open('wb')) as f:
@@ -30,6 +30,8 @@ from coq_serapy.contexts import TacticContext
 
 
 class QEstimator(metaclass=ABCMeta):
+    model: torch.nn.Module
+
     @abstractmethod
     def __call__(self, inputs: List[Tuple[TacticContext, str, float]]) \
             -> List[float]:
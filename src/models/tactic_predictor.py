@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
 from typing import (Dict, List, Union, Tuple, Iterable, NamedTuple,
-                    Sequence, Any, Optional, cast, BinaryIO)
+                    Sequence, Any, Optional, Iterator, cast, BinaryIO)
 from coq_serapy.contexts import ScrapedTactic, TacticContext
 from abc import ABCMeta, abstractmethod
 import argparse
+import hashlib
+import json
+import pickle
+from collections import OrderedDict
+from pathlib import Path
+from util import FileLock
 from data import (Dataset, RawDataset, ScrapedTactic, get_text_data,
                   TokenizedDataset, DatasetMetadata, stemmify_data,
                   tactic_substitutions, EmbeddedSample,
@@ -17,12 +23,113 @@ class Prediction(NamedTuple):
     prediction : str
     certainty : float
 
+class PredictionCache:
+    """
+    An LRU cache of predictions, keyed on a stable hash of the (truncated)
+    context being predicted on, the number of predictions asked for, and
+    the blacklist. Can be saved to and loaded from disk so that it survives
+    between runs; saved caches are only loaded back for the same model.
+    """
+    _entries : "OrderedDict[str, List[Prediction]]"
+    max_size : int
+    cache_file : Optional[Path]
+    model_id : str
+    hits : int
+    misses : int
+
+    def __init__(self, max_size : int, cache_file : Optional[Path] = None,
+                 model_id : str = "") -> None:
+        self._entries = OrderedDict()
+        self.max_size = max_size
+        self.cache_file = cache_file
+        self.model_id = model_id
+        self.hits = 0
+        self.misses = 0
+        if cache_file is not None and cache_file.exists():
+            self.load()
+
+    @staticmethod
+    def key(context : TacticContext, k : int,
+            blacklist : Optional[List[str]]) -> str:
+        return hashlib.sha1(json.dumps(
+            [context.relevant_lemmas, context.prev_tactics,
+             context.hypotheses, context.goal, k,
+             sorted(blacklist) if blacklist else []]).encode()).hexdigest()
+
+    def get(self, key : str) -> Optional[List[Prediction]]:
+        predictions = self._entries.get(key)
+        if predictions is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return list(predictions)
+
+    def put(self, key : str, predictions : List[Prediction]) -> None:
+        self._entries[key] = list(predictions)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def summary(self) -> str:
+        return (f"Prediction cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hit_rate:.1%} hit rate), {len(self._entries)} entries")
+
+    def load(self) -> None:
+        assert self.cache_file
+        with self.cache_file.open('rb') as f, FileLock(f, exclusive=False):
+            model_id, entries = pickle.load(f)
+        if model_id != self.model_id:
+            return
+        for key, predictions in entries:
+            self.put(key, [Prediction(*p) for p in predictions])
+
+    def save(self) -> None:
+        if self.cache_file is None:
+            return
+        # Other workers may be saving to the same file, so merge what they
+        # saved with our own entries, preferring ours.
+        with self.cache_file.open('a+b') as f, FileLock(f):
+            f.seek(0)
+            try:
+                model_id, entries = pickle.load(f)
+            except EOFError:
+                model_id, entries = self.model_id, []
+            merged: "OrderedDict[str, List[Prediction]]" = OrderedDict()
+            if model_id == self.model_id:
+                merged.update(entries)
+            merged.update(self._entries)
+            f.seek(0)
+            f.truncate()
+            pickle.dump((self.model_id,
+                         [(key, [tuple(p) for p in preds]) for key, preds
+                          in list(merged.items())[-self.max_size:]]),
+                        f)
+
 class TacticPredictor(metaclass=ABCMeta):
     training_args : Optional[argparse.Namespace]
     unparsed_args : List[str]
+    prediction_cache : Optional[PredictionCache] = None
     def __init__(self) -> None:
         pass
 
+    def predictKTactics_cached(self, in_data : TacticContext, k : int,
+                               blacklist: Optional[List[str]] = None) \
+        -> List[Prediction]:
+        if self.prediction_cache is None:
+            return self.predictKTactics(in_data, k, blacklist)
+        key = PredictionCache.key(in_data, k, blacklist)
+        predictions = self.prediction_cache.get(key)
+        if predictions is None:
+            predictions = self.predictKTactics(in_data, k, blacklist)
+            self.prediction_cache.put(key, predictions)
+        return predictions
+
     @abstractmethod
     def getOptions(self) -> List[Tuple[str, str]]: pass
 
@@ -464,13 +571,47 @@ def save_checkpoints(predictor_name : str,
             print("=> Saving checkpoint at epoch {}".format(epoch))
             torch.save((predictor_name, (arg_values, sys.argv, metadata, predictor_state)), f)
 
+class BucketedBatchSampler(data.Sampler):
+    """
+    Yields batches of indices whose samples have similar lengths, so that
+    per-batch padding stays small. The indices are shuffled and split into
+    shards of shard_size samples; each shard is sorted by length, cut into
+    batches, and its batches shuffled before moving on to the next shard.
+    Since one shard is read at a time, memory-mapped data only needs about a
+    shard's worth of pages resident at once.
+    """
+    def __init__(self, indices : Sequence[int], lengths : Sequence[int],
+                 batch_size : int, shard_size : int) -> None:
+        self.indices = list(indices)
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shard_size = max(shard_size, batch_size)
+    def __iter__(self) -> Iterator[List[int]]:
+        indices = list(self.indices)
+        random.shuffle(indices)
+        for shard_start in range(0, len(indices), self.shard_size):
+            shard = sorted(indices[shard_start:shard_start+self.shard_size],
+                           key=lambda idx: self.lengths[idx])
+            batches = [shard[batch_start:batch_start+self.batch_size]
+                       for batch_start in range(0, len(shard) - self.batch_size + 1,
+                                                self.batch_size)]
+            random.shuffle(batches)
+            yield from batches
+    def __len__(self) -> int:
+        return sum((min(self.shard_size, len(self.indices) - shard_start)
+                    // self.batch_size)
+                   for shard_start in range(0, len(self.indices), self.shard_size))
+
 def optimize_checkpoints(data_tensors : List[torch.Tensor],
                          arg_values : Namespace,
                          model : ModelType,
                          batchLoss :
                          Callable[[Sequence[torch.Tensor], ModelType],
                                   Tuple[torch.FloatTensor, torch.FloatTensor]],
-                         epoch_start : int = 1) \
+                         epoch_start : int = 1,
+                         sample_lengths : Optional[Sequence[int]] = None,
+                         collate_fn : Optional[Callable[[List[Tuple[torch.Tensor, ...]]],
+                                                        List[torch.Tensor]]] = None) \
     -> Iterable[NeuralPredictorState]:
     split_ratio = 0.05
     dataset_size = data_tensors[0].size()[0]
@@ -480,20 +621,38 @@ def optimize_checkpoints(data_tensors : List[torch.Tensor],
     split = int((dataset_size * split_ratio) / arg_values.batch_size) * arg_values.batch_size
     np.random.shuffle(indices)
     train_indices, val_indices = indices[split:], indices[:split]
-    train_sampler = SubsetRandomSampler(train_indices)
-    valid_sampler = SubsetRandomSampler(val_indices)
     valid_batch_size = arg_values.batch_size // 2
-    dataloader = data.DataLoader(data.TensorDataset(*data_tensors),
-                                 sampler=train_sampler,
-                                 batch_size=arg_values.batch_size, num_workers=0,
-                                 pin_memory=True, drop_last=True)
-    dataloader_valid = data.DataLoader(data.TensorDataset(*data_tensors),
-                                       sampler=valid_sampler,
-                                       batch_size=valid_batch_size, num_workers=0,
-                                       pin_memory=True, drop_last=True)
-    # Drop the last batch in the count
-    num_batches = int((dataset_size - split) / arg_values.batch_size)
-    num_batches_valid = int(split / valid_batch_size)
+    loader_args : Dict[str, Any] = dict(num_workers=arg_values.num_data_workers,
+                                        pin_memory=True, collate_fn=collate_fn)
+    if arg_values.num_data_workers > 0:
+        loader_args["persistent_workers"] = True
+    if sample_lengths is not None:
+        # Batch samples of similar lengths together, so that collate_fn
+        # only has to pad to the longest sample in each batch.
+        dataloader = data.DataLoader(
+            data.TensorDataset(*data_tensors),
+            batch_sampler=BucketedBatchSampler(train_indices, sample_lengths,
+                                               arg_values.batch_size,
+                                               arg_values.shard_size),
+            **loader_args)
+        dataloader_valid = data.DataLoader(
+            data.TensorDataset(*data_tensors),
+            batch_sampler=BucketedBatchSampler(val_indices, sample_lengths,
+                                               valid_batch_size,
+                                               arg_values.shard_size),
+            **loader_args)
+    else:
+        dataloader = data.DataLoader(data.TensorDataset(*data_tensors),
+                                     sampler=SubsetRandomSampler(train_indices),
+                                     batch_size=arg_values.batch_size,
+                                     drop_last=True, **loader_args)
+        dataloader_valid = data.DataLoader(data.TensorDataset(*data_tensors),
+                                           sampler=SubsetRandomSampler(val_indices),
+                                           batch_size=valid_batch_size,
+                                           drop_last=True, **loader_args)
+    # Partial batches are dropped, so they aren't in the count
+    num_batches = len(dataloader)
+    num_batches_valid = len(dataloader_valid)
     dataset_size = num_batches * arg_values.batch_size
     assert dataset_size > 0
     print("Initializing model...")
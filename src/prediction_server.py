@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+import argparse
+import multiprocessing
+import multiprocessing.synchronize
+import queue
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import torch
+
+from coq_serapy.contexts import TacticContext
+from models.tactic_predictor import Prediction, TacticPredictor
+from models.features_polyarg_predictor import FeaturesPolyargPredictor
+import util
+from util import eprint
+
+
+# How long clients wait for a response before checking whether the server
+# is still running.
+SERVER_POLL_INTERVAL = 1.0
+
+
+class PredictionServerError(Exception):
+    pass
+
+
+class PredictionRequest(NamedTuple):
+    worker_idx: int
+    request_id: int
+    context: TacticContext
+    k: int
+    blacklist: Tuple[str, ...]
+
+
+def prediction_server(args: argparse.Namespace,
+                      requests: 'multiprocessing.Queue[Optional[PredictionRequest]]',
+                      responses: 'List[multiprocessing.Queue[Tuple[int, List[Prediction]]]]',
+                      device: str,
+                      stopped: multiprocessing.synchronize.Event) -> None:
+    try:
+        serve_predictions(args, requests, responses, device)
+    finally:
+        # Tell the clients not to wait for answers that aren't coming
+        stopped.set()
+
+
+def serve_predictions(args: argparse.Namespace,
+                      requests: 'multiprocessing.Queue[Optional[PredictionRequest]]',
+                      responses: 'List[multiprocessing.Queue[Tuple[int, List[Prediction]]]]',
+                      device: str) -> None:
+    # Imported here to avoid a circular import, since the search worker
+    # creates the clients for this server.
+    from search_worker import get_predictor
+    if util.use_cuda:
+        torch.cuda.set_device(device) # type: ignore
+    util.cuda_device = device
+    predictor = get_predictor(args)
+    assert isinstance(predictor, FeaturesPolyargPredictor), \
+        "The prediction server only supports the polyarg predictor"
+
+    num_batches = 0
+    num_requests = 0
+    stopping = False
+    while not stopping:
+        first_request = requests.get()
+        if first_request is None:
+            break
+        batch = [first_request]
+        # Wait a little while for other workers to send requests, so we can
+        # run them all through the model together.
+        deadline = time.time() + args.prediction_server_timeout
+        while len(batch) < args.prediction_server_batch_size:
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                break
+            try:
+                next_request = requests.get(timeout=time_left)
+            except queue.Empty:
+                break
+            if next_request is None:
+                stopping = True
+                break
+            batch.append(next_request)
+
+        request_groups: Dict[Tuple[int, Tuple[str, ...]],
+                             List[PredictionRequest]] = {}
+        for request in batch:
+            request_groups.setdefault((request.k, request.blacklist),
+                                      []).append(request)
+        for (k, blacklist), group in request_groups.items():
+            prediction_lists = predictor.predictKTactics_batch(
+                [request.context for request in group], k,
+                blacklist=list(blacklist) if blacklist else None)
+            for request, predictions in zip(group, prediction_lists):
+                responses[request.worker_idx].put((request.request_id,
+                                                   predictions))
+        num_batches += 1
+        num_requests += len(batch)
+    eprint(f"Prediction server answered {num_requests} requests "
+           f"in {num_batches} batches",
+           guard=args.verbose >= 1)
+
+
+def get_while_server_running(q: 'multiprocessing.Queue[Any]',
+                             server: multiprocessing.Process,
+                             stopped: multiprocessing.synchronize.Event) -> Any:
+    """
+    Gets the next item from a queue that the prediction server's clients
+    put to, raising if the server dies first. This catches the server being
+    killed outright too, which its clients can't see from their end.
+    """
+    while True:
+        try:
+            return q.get(timeout=SERVER_POLL_INTERVAL)
+        except queue.Empty:
+            if not server.is_alive():
+                stopped.set()
+                raise PredictionServerError(
+                    f"Prediction server exited with code {server.exitcode}")
+
+
+class RemotePredictor(TacticPredictor):
+    """
+    A predictor that sends its contexts to a prediction server process
+    instead of running a model itself, so that workers on the same machine
+    can share one copy of the model and have their requests batched
+    together.
+    """
+    def __init__(self, worker_idx: int,
+                 requests: 'multiprocessing.Queue[Optional[PredictionRequest]]',
+                 responses: 'multiprocessing.Queue[Tuple[int, List[Prediction]]]',
+                 server_stopped: multiprocessing.synchronize.Event) -> None:
+        self.worker_idx = worker_idx
+        self._requests = requests
+        self._responses = responses
+        self._server_stopped = server_stopped
+        self._next_request_id = 0
+
+    def getOptions(self) -> List[Tuple[str, str]]:
+        return [("predictor", "remote")]
+
+    def predictKTactics_batch(self, contexts: List[TacticContext], k: int,
+                              verbosity: int = 0,
+                              blacklist: Optional[List[str]] = None) \
+                              -> List[List[Prediction]]:
+        request_ids = []
+        for context in contexts:
+            request_ids.append(self._next_request_id)
+            self._requests.put(PredictionRequest(
+                self.worker_idx, self._next_request_id, context, k,
+                tuple(blacklist) if blacklist else ()))
+            self._next_request_id += 1
+        results: Dict[int, List[Prediction]] = {}
+        while len(results) < len(request_ids):
+            try:
+                request_id, predictions = self._responses.get(
+                    timeout=SERVER_POLL_INTERVAL)
+            except queue.Empty:
+                if self._server_stopped.is_set():
+                    raise PredictionServerError(
+                        "Prediction server stopped before answering")
+                continue
+            results[request_id] = predictions
+        return [results[request_id] for request_id in request_ids]
+
+    def predictKTactics(self, in_data: TacticContext, k: int,
+                        blacklist: Optional[List[str]] = None) \
+                        -> List[Prediction]:
+        return self.predictKTactics_batch([in_data], k,
+                                          blacklist=blacklist)[0]
+
+    def predictKTacticsWithLoss(self, in_data: TacticContext, k: int,
+                                correct: str) -> \
+                                Tuple[List[Prediction], float]:
+        return self.predictKTactics(in_data, k), 0
+
+    def predictKTacticsWithLoss_batch(self,
+                                      in_data: List[TacticContext],
+                                      k: int, correct: List[str]) -> \
+                                      Tuple[List[List[Prediction]], float]:
+        return self.predictKTactics_batch(in_data, k), 0
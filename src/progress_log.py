@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A log of progress events for cluster search runs. Each worker thread
+# appends one JSON object per line to events.log in the output directory:
+#
+#   {"time": ..., "worker": w, "thread": t, "event": "start"}
+#   {"time": ..., "worker": w, "thread": t, "event": "job_start", "job": [...]}
+#   {"time": ..., "worker": w, "thread": t, "event": "heartbeat",
+#    "job_elapsed": ...}
+#   {"time": ..., "worker": w, "thread": t, "event": "job_done", "job": [...]}
+#   {"time": ..., "worker": w, "thread": t, "event": "exit"}
+#
+# The coordinator tails the log, reading only what was appended since its
+# last poll, and treats a thread that hasn't logged anything for a while as
+# crashed. Heartbeats come from a separate thread, so a worker stuck inside
+# a job keeps sending them; they say how long the current job has been
+# running (by the worker's clock, so clock skew between nodes doesn't
+# matter), so that the coordinator can also flag jobs that are taking far
+# longer than they should.
+
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from search_worker import ReportJob
+from util import FileLock
+
+EVENTS_FILE = "events.log"
+
+ThreadId = Tuple[int, int]
+
+
+def events_path(output_dir: Path) -> Path:
+    return output_dir / EVENTS_FILE
+
+
+class ProgressLog:
+    def __init__(self, output_dir: Path, workerid: int, threadid: int,
+                 heartbeat_interval: float) -> None:
+        self.path = events_path(output_dir)
+        self.workerid = workerid
+        self.threadid = threadid
+        self.heartbeat_interval = heartbeat_interval
+        self._stop = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._job_start_time: Optional[float] = None
+
+    def __enter__(self) -> 'ProgressLog':
+        self.log("start")
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat,
+                                                  daemon=True)
+        self._heartbeat_thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self._stop.set()
+        if type is None:
+            self.log("exit")
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(self.heartbeat_interval):
+            self.log("heartbeat")
+
+    def log(self, event: str, job: Optional[ReportJob] = None) -> None:
+        now = time.time()
+        if event == "job_start":
+            self._job_start_time = now
+        elif event == "job_done":
+            self._job_start_time = None
+        entry: Dict[str, object] = {"time": now, "worker": self.workerid,
+                                    "thread": self.threadid, "event": event}
+        if job is not None:
+            entry["job"] = job
+        job_start_time = self._job_start_time
+        if event == "heartbeat" and job_start_time is not None:
+            entry["job_elapsed"] = now - job_start_time
+        with self.path.open('a') as f, FileLock(f):
+            f.write(json.dumps(entry) + "\n")
+
+
+class ThreadStatus:
+    def __init__(self, last_seen: float) -> None:
+        self.last_seen = last_seen
+        self.current_job: Optional[ReportJob] = None
+        # When the current job started, by our clock
+        self.job_start_time: Optional[float] = None
+        self.exited = False
+
+
+class ProgressMonitor:
+    def __init__(self, output_dir: Path,
+                 jobs_done: Optional[Set[ReportJob]] = None) -> None:
+        self.path = events_path(output_dir)
+        self.offset = 0
+        self.threads: Dict[ThreadId, ThreadStatus] = {}
+        self.workers_started: Set[int] = set()
+        self.jobs_done: Set[ReportJob] = \
+            jobs_done if jobs_done is not None else set()
+        self.last_event_time = time.time()
+
+    def poll(self) -> int:
+        """
+        Reads the events logged since the last poll, and returns how many
+        more jobs are done.
+        """
+        num_done_before = len(self.jobs_done)
+        try:
+            with self.path.open('rb') as f:
+                f.seek(self.offset)
+                new_bytes = f.read()
+        except FileNotFoundError:
+            return 0
+        # Leave any partly written last line for the next poll.
+        complete_length = new_bytes.rfind(b"\n") + 1
+        self.offset += complete_length
+        # Events are timed by when they're read rather than by the clocks
+        # on the workers' nodes, which might not agree with ours.
+        now = time.time()
+        for line in new_bytes[:complete_length].decode('utf-8').splitlines():
+            entry = json.loads(line)
+            thread_id = (entry["worker"], entry["thread"])
+            status = self.threads.setdefault(thread_id, ThreadStatus(now))
+            status.last_seen = now
+            self.last_event_time = now
+            event = entry["event"]
+            if event == "start":
+                self.workers_started.add(entry["worker"])
+            elif event == "job_start":
+                status.current_job = ReportJob(*entry["job"])
+                status.job_start_time = now
+            elif event == "heartbeat" and "job_elapsed" in entry:
+                status.job_start_time = now - entry["job_elapsed"]
+            elif event == "job_done":
+                status.current_job = None
+                status.job_start_time = None
+                self.jobs_done.add(ReportJob(*entry["job"]))
+            elif event == "exit":
+                status.exited = True
+        return len(self.jobs_done) - num_done_before
+
+    def add_done_jobs(self, jobs: Iterable[ReportJob]) -> int:
+        """
+        Marks jobs found done some other way, such as in the results files,
+        and returns how many of them weren't already known to be done. A
+        worker can be killed after writing its result but before logging
+        job_done, so the log alone can miss finished jobs.
+        """
+        num_done_before = len(self.jobs_done)
+        self.jobs_done.update(jobs)
+        for status in self.threads.values():
+            if status.current_job in self.jobs_done:
+                status.current_job = None
+                status.job_start_time = None
+        return len(self.jobs_done) - num_done_before
+
+    def stalled_threads(self, timeout: float) -> List[ThreadId]:
+        now = time.time()
+        return [thread_id for thread_id, status in self.threads.items()
+                if not status.exited and now - status.last_seen > timeout]
+
+    def overdue_jobs(self, max_job_time: float) \
+            -> List[Tuple[ThreadId, ReportJob, float]]:
+        """
+        Returns the jobs that have been running for longer than
+        max_job_time seconds, with their threads and how long they've run.
+        """
+        now = time.time()
+        return [(thread_id, status.current_job, now - status.job_start_time)
+                for thread_id, status in self.threads.items()
+                if not status.exited and status.current_job is not None and
+                status.job_start_time is not None and
+                now - status.job_start_time > max_job_time]
+
+    def num_threads_running(self, timeout: float) -> int:
+        return len([status for status in self.threads.values()
+                    if not status.exited]) - \
+            len(self.stalled_threads(timeout))
@@ -33,11 +33,13 @@ import multiprocessing
 import math
 import sys
 import functools
+import shutil
+from dataclasses import replace
 from queue import Queue
 import queue
 from typing import (List, Tuple, Iterator, Optional,
                     cast, TYPE_CHECKING,
-                    TypeVar)
+                    TypeVar, Any)
 if TYPE_CHECKING:
     from multiprocessing.sharedctypes import _Value
     Value = _Value
@@ -66,6 +68,7 @@ from util import eprint, print_time, unwrap, progn, safe_abbrev
 
 from rgraph import (LabeledTransition,
                     ReinforceGraph, assignApproximateQScores)
+from replay_store import ReplayStore
 
 
 serapi_instance.set_parseSexpOneLevel_fn(util.parseSexpOneLevel)
@@ -139,6 +142,12 @@ def main() -> None:
     parser.add_argument("--train-every-max", default=2048, type=int)
     parser.add_argument("--epochs-per-batch", default=32, type=int)
     parser.add_argument("--show-loss", action='store_true')
+    parser.add_argument("--sample-batch-size", default=32, type=int,
+                        help="Number of transitions each actor collects "
+                        "before sending them to the learner")
+    parser.add_argument("--save-every", default=16, type=int,
+                        help="Number of training steps between saving "
+                        "the weights to disk")
 
     args = parser.parse_args()
 
@@ -157,15 +166,83 @@ def main() -> None:
 
 Job = Tuple[Path2, str, str]
 Demonstration = List[str]
+SampleBatch = Tuple[int, List[LabeledTransition]]
+
+
+class WeightsBroadcast:
+    """
+    The learner's latest Q model weights, in shared memory, with a version
+    number that goes up every time they're published. Actors keep their own
+    copy of the model and pull new weights between episodes, so they never
+    see a model the learner is halfway through updating.
+    """
+    def __init__(self, ctxt: Any, estimator: QEstimator) -> None:
+        self._weights = {name: tensor.detach().cpu().clone().share_memory_()
+                         for name, tensor
+                         in estimator.model.state_dict().items()}
+        self._version = ctxt.Value('i', 0)
+        self._lock = ctxt.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version.value
+
+    def publish(self, estimator: QEstimator) -> int:
+        with self._lock:
+            for name, tensor in estimator.model.state_dict().items():
+                self._weights[name].copy_(tensor)
+            self._version.value += 1
+            return self._version.value
+
+    def pull(self, estimator: QEstimator, have_version: int,
+             timeout: Optional[float] = None) -> int:
+        """
+        Loads the latest weights into estimator, unless it already has them,
+        and returns their version. If the lock can't be taken within
+        timeout seconds, leaves the estimator alone and returns
+        have_version.
+        """
+        if self._version.value == have_version:
+            return have_version
+        if not self._lock.acquire(timeout=timeout):
+            return have_version
+        try:
+            estimator.model.load_state_dict(self._weights)
+            return self._version.value
+        finally:
+            self._lock.release()
+
+
+class TransitionSender:
+    """
+    Collects an actor's transitions and sends them to the learner in
+    batches, tagged with the version of the weights that picked them.
+    """
+    def __init__(self, samples: Queue[SampleBatch], batch_size: int) -> None:
+        self._samples = samples
+        self._batch_size = batch_size
+        self._pending: List[LabeledTransition] = []
+        self.weights_version = 0
+
+    def put(self, transition: LabeledTransition) -> None:
+        # The graph node links to the actor's whole search graph, which the
+        # learner doesn't need.
+        self._pending.append(replace(transition, graph_node=None))
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._pending:
+            self._samples.put((self.weights_version, self._pending))
+            self._pending = []
 
 
 def reinforce_multithreaded(args: argparse.Namespace) -> None:
 
-    def resume(resume_file: Path2,
-               jobs_in_files: List[Job],
+    def resume(jobs_in_files: List[Job],
                weights: Path2,
                q_estimator: QEstimator) -> \
-      Tuple[List[LabeledTransition],
+      Tuple[List[Job],
             List[Job],
             List[Tuple[str, ReinforceGraph]]]:
         eprint("Looks like there was a session in progress for these weights! "
@@ -194,30 +271,11 @@ def reinforce_multithreaded(args: argparse.Namespace) -> None:
                 graphs_done.append((graphpath, graph))
         jobs_todo = [job for job in jobs_in_files
                      if job not in already_done]
-
-        replay_memory = []
-        if len(jobs_todo) > 0:
-            with resume_file.open('r') as f:
-                num_samples = sum(1 for _ in f)
-            if num_samples > args.buffer_max_size:
-                samples_to_use = random.sample(range(num_samples),
-                                               args.buffer_max_size)
-            else:
-                samples_to_use = None
-            with resume_file.open('r') as f:
-                for (idx, line) in enumerate(f, start=1):
-                    if num_samples > args.buffer_max_size and \
-                      idx not in samples_to_use:
-                        continue
-                    try:
-                        replay_memory.append(LabeledTransition.from_dict(
-                            json.loads(line)))
-                    except json.decoder.JSONDecodeError:
-                        eprint(f"Problem loading line {idx}: {line}")
-                        raise
-        else:
+        # The replay memory itself is reloaded from its store by the
+        # training worker.
+        if len(jobs_todo) == 0:
             eprint("Warning: no jobs left to do")
-        return replay_memory, jobs_todo, already_done, graphs_done
+        return jobs_todo, already_done, graphs_done
 
     # Load the predictor
     predictor = cast(features_polyarg_predictor.
@@ -272,11 +330,10 @@ def reinforce_multithreaded(args: argparse.Namespace) -> None:
     else:
         all_jobs = jobs_in_files
 
-    resume_file = args.out_weights.with_suffix('.tmp')
-    if resume_file.exists():
-        replay_memory, jobs_todo, already_done, graphs_done = \
-            resume(resume_file,
-                   all_jobs,
+    replay_path = args.out_weights.with_suffix('.replay')
+    if replay_path.exists():
+        jobs_todo, already_done, graphs_done = \
+            resume(all_jobs,
                    args.out_weights,
                    q_estimator)
     else:
@@ -306,25 +363,23 @@ def reinforce_multithreaded(args: argparse.Namespace) -> None:
                               predictor.dataloader_args,
                               args.scrape_file, args.buffer_min_size * 3))
         already_done = []
-        with args.out_weights.with_suffix('.tmp').open('w') as f:
-            for sample in replay_memory:
-                f.write(json.dumps(sample.to_dict()))
-                f.write("\n")
+        replay_store = ReplayStore(str(replay_path))
+        for sample in replay_memory:
+            replay_store.insert(sample)
+        replay_store.flush()
+        replay_store.close()
         with args.out_weights.with_suffix('.done').open('w'):
             pass
 
     q_estimator.save_weights(args.out_weights, args)
     if args.num_episodes == 0:
-        args.out_weights.with_suffix('.tmp').unlink()
+        shutil.rmtree(str(replay_path))
         args.out_weights.with_suffix('.done').unlink()
         return
 
     jobs: Queue[Tuple[Job, Optional[Demonstration]]] = ctxt.Queue()
     done: Queue[Tuple[Job, Tuple[str, ReinforceGraph]]] = ctxt.Queue()
-    samples: Queue[LabeledTransition] = ctxt.Queue()
-
-    for sample in replay_memory:
-        samples.put(sample)
+    samples: Queue[SampleBatch] = ctxt.Queue()
 
     all_jobs_and_dems: List[Tuple[Job, Optional[Demonstration]]]
     if args.demonstrate_from:
@@ -339,11 +394,24 @@ def reinforce_multithreaded(args: argparse.Namespace) -> None:
         for job in all_jobs_and_dems:
             jobs.put(job)
 
-        q_estimator.share_memory()
+        # Every process gets its own copy of the estimator; the learner
+        # publishes its weights to the actors through the broadcast.
+        weights = WeightsBroadcast(ctxt, q_estimator)
+
+        def save_and_exit(signum: int, frame: Any) -> None:
+            # The learner might have been killed while holding the
+            # broadcast lock, so don't wait on it forever.
+            if weights.pull(q_estimator, -1, timeout=10) == -1:
+                eprint("Couldn't get the latest weights from the learner, "
+                       "not saving them")
+            else:
+                q_estimator.save_weights(args.out_weights, args)  # type: ignore
+            exit()
+        signal.signal(signal.SIGINT, save_and_exit)
 
         training_worker = ctxt.Process(
             target=reinforce_training_worker,
-            args=(args, len(replay_memory), q_estimator, predictor, samples))
+            args=(args, q_estimator, predictor, samples, weights))
         workers = [ctxt.Process(
             target=reinforce_worker,
             args=(widx,
@@ -351,6 +419,7 @@ def reinforce_multithreaded(args: argparse.Namespace) -> None:
                   predictor,
                   q_estimator,
                   samples,
+                  weights,
                   jobs,
                   done))
                    for widx in range(min(args.num_threads, len(all_jobs)))]
@@ -374,14 +443,18 @@ def reinforce_multithreaded(args: argparse.Namespace) -> None:
                     f.write("\n")
         for worker in workers:
             worker.kill()
+        # Pull the final weights before stopping the learner, so it can't
+        # be stopped while holding the broadcast lock.
+        weights.pull(q_estimator, -1)
         training_worker.kill()
+        q_estimator.save_weights(args.out_weights, args)
 
     for graphpath, graph in tqdm(graphs_done, desc="Drawing graphs"):
         assignApproximateQScores(graph, args.max_term_length, predictor,
                                  q_estimator)
         graph.draw(graphpath)
 
-    args.out_weights.with_suffix('.tmp').unlink()
+    shutil.rmtree(str(replay_path))
     args.out_weights.with_suffix('.done').unlink()
 
 
@@ -389,7 +462,8 @@ def reinforce_worker(worker_idx: int,
                      args: argparse.Namespace,
                      estimator: QEstimator,
                      predictor: TacticPredictor,
-                     samples: Queue[LabeledTransition],
+                     sample_queue: Queue[SampleBatch],
+                     weights: WeightsBroadcast,
                      jobs: Queue[Tuple[Job, Optional[Demonstration]]],
                      done: Queue[Tuple[Job,
                                        Optional[Tuple[str,
@@ -400,6 +474,7 @@ def reinforce_worker(worker_idx: int,
         util.cuda_device = f"cuda:{args.gpu}"
     sys.setrecursionlimit(100000)
     failing_lemma = ""
+    samples = TransitionSender(sample_queue, args.sample_batch_size)
 
     try:
         (next_file, next_module, next_lemma), demonstration = jobs.get_nowait()
@@ -443,6 +518,7 @@ def reinforce_worker(worker_idx: int,
                                                         estimator, predictor,
                                                         worker_idx,
                                                         samples,
+                                                        weights,
                                                         next_lemma,
                                                         next_module,
                                                         demonstration)
@@ -552,7 +628,8 @@ def reinforce_lemma_multithreaded(
         predictor: TacticPredictor,
         estimator: QEstimator,
         worker_idx: int,
-        samples: Queue[LabeledTransition],
+        samples: TransitionSender,
+        weights: WeightsBroadcast,
         lemma_statement: str,
         _module_prefix: str,
         demonstration: Optional[Demonstration]) -> Tuple[str, ReinforceGraph]:
@@ -562,6 +639,8 @@ def reinforce_lemma_multithreaded(
     lemma_memory = []
     for i in trange(args.num_episodes, disable=(not args.progress),
                     leave=False, position=worker_idx + 1):
+        samples.weights_version = weights.pull(estimator,
+                                               samples.weights_version)
         cur_node = graph.start_node
         proof_contexts_seen = [unwrap(coq.proof_context)]
         episode_memory: List[LabeledTransition] = []
@@ -708,6 +787,7 @@ def reinforce_lemma_multithreaded(
                 -25)
             samples.put(transition)
             episode_memory.append(transition)
+        samples.flush()
 
         # Clean up episode
         if lemma_name:
@@ -729,27 +809,39 @@ def reinforce_lemma_multithreaded(
 
 
 def reinforce_training_worker(args: argparse.Namespace,
-                              initial_buffer_size: int,
                               q_estimator: QEstimator,
                               predictor: TacticPredictor,
-                              samples: Queue[LabeledTransition]):
+                              samples: Queue[SampleBatch],
+                              weights: WeightsBroadcast):
     if util.use_cuda:
         torch.cuda.set_device(args.gpu)
         util.cuda_device = f"cuda:{args.gpu}"
+    memory = ReplayStore(str(args.out_weights.with_suffix('.replay')))
+    # Samples already in the store count as retrieved, so that training
+    # starts right away on a big enough initial (or resumed) memory.
     last_trained_at = 0
-    samples_retrieved = 0
-    memory: List[LabeledTransition] = []
+    samples_retrieved = len(memory)
+    weights_version = weights.version
+    num_steps = 0
+    # How many versions behind the published weights each received sample
+    # was picked with, since the last training step.
+    staleness: List[int] = []
+
+    def receive(sample_batch: SampleBatch) -> None:
+        nonlocal samples_retrieved
+        sample_version, transitions = sample_batch
+        for transition in transitions:
+            memory.insert(transition)
+        samples_retrieved += len(transitions)
+        staleness.extend([weights_version - sample_version] * len(transitions))
+
     while True:
         if samples_retrieved - last_trained_at < args.train_every_min:
-            next_sample = samples.get()
-            memory.append(next_sample)
-            samples_retrieved += 1
+            receive(samples.get())
             continue
         else:
             try:
-                next_sample = samples.get(timeout=.01)
-                memory.append(next_sample)
-                samples_retrieved += 1
+                receive(samples.get(timeout=.01))
                 if samples_retrieved - last_trained_at > args.train_every_max:
                     eprint("Forcing training", guard=args.verbose >= 2)
                 else:
@@ -757,12 +849,11 @@ def reinforce_training_worker(args: argparse.Namespace,
             except queue.Empty:
                 pass
         if len(memory) > args.buffer_max_size:
-            memory = random.sample(memory, args.buffer_max_size -
-                                   args.train_every_max)
-            # del memory[0:args.train_every_max+1]
+            memory.evict_random(len(memory) - (args.buffer_max_size -
+                                               args.train_every_max))
         if samples_retrieved - last_trained_at >= args.train_every_min:
             last_trained_at = samples_retrieved
-            transition_samples = sample_batch(memory, args.batch_size)
+            transition_samples = memory.sample(args.batch_size)
             with print_time("Assigning scores", guard=args.verbose >= 2):
                 training_samples = normalize_batch_size(
                     assign_scores(args,
@@ -775,11 +866,23 @@ def reinforce_training_worker(args: argparse.Namespace,
                 q_estimator.train(training_samples,
                                   show_loss=args.show_loss,
                                   num_epochs=args.epochs_per_batch)
-            q_estimator.save_weights(args.out_weights, args)
-            with args.out_weights.with_suffix('.tmp').open('w') as f:
-                for sample in memory:
-                    f.write(json.dumps(sample.to_dict()))
-                    f.write("\n")
+            weights_version = weights.publish(q_estimator)
+            num_steps += 1
+            if args.verbose >= 1:
+                try:
+                    queued = f"{samples.qsize()} sample batches queued; "
+                except NotImplementedError:
+                    # Queue.qsize isn't implemented on macOS
+                    queued = ""
+                eprint(f"Published weights version {weights_version}; "
+                       + queued +
+                       f"sample staleness mean "
+                       f"{sum(staleness) / max(len(staleness), 1):.2f}, "
+                       f"max {max(staleness, default=0)}")
+            staleness = []
+            if num_steps % args.save_every == 0:
+                q_estimator.save_weights(args.out_weights, args)
+            memory.flush()
 
     pass
 
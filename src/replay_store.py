@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# An on-disk replay memory for reinforce. Instead of rewriting the whole
+# memory after every training step, insertions and evictions are appended
+# to a log of segment files in a directory:
+#
+#   segment-000000.bin, segment-000001.bin, ...
+#
+# Each record is a header packed as RECORD_HEADER (the record kind, a
+# sample id, and the payload length), followed by the payload, which for
+# insertions is the zlib-compressed pickle of the transition. When a segment
+# grows past segment_size bytes a new one is started, and when the log holds
+# many more records than there are live samples, the live samples are
+# written to a fresh snapshot segment (starting with a CLEAR record) and the
+# older segments are deleted.
+
+import pickle
+import random
+import shutil
+import struct
+import zlib
+from dataclasses import replace
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Union
+
+from rgraph import LabeledTransition
+
+RECORD_INSERT = 0
+RECORD_EVICT = 1
+RECORD_CLEAR = 2
+RECORD_HEADER = struct.Struct("<BQI")
+
+
+class ReplayStore:
+    """
+    A replay memory that keeps its samples in a list, for constant time
+    random sampling and eviction, and logs every change to disk so it can be
+    reloaded after a restart.
+    """
+    def __init__(self, path: Union[str, Path],
+                 segment_size: int = 64 * 1024 * 1024) -> None:
+        self.path = Path(path)
+        self.segment_size = segment_size
+        self.samples: List[LabeledTransition] = []
+        self._sample_ids: List[int] = []
+        self._positions: Dict[int, int] = {}
+        self._next_id = 0
+        self._num_records = 0
+        self._segment: Optional[BinaryIO] = None
+        self._segment_idx = 0
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def _segment_paths(self) -> List[Path]:
+        return sorted(self.path.glob("segment-*.bin"))
+
+    def _segment_path(self, idx: int) -> Path:
+        return self.path / f"segment-{idx:06d}.bin"
+
+    def _load(self) -> None:
+        segment_paths = self._segment_paths()
+        for segment_path in segment_paths:
+            with segment_path.open('rb') as f:
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    kind, sample_id, length = RECORD_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length:
+                        # A write was interrupted, so the rest of this
+                        # segment never made it to disk.
+                        break
+                    self._num_records += 1
+                    if kind == RECORD_INSERT:
+                        self._add(sample_id,
+                                  pickle.loads(zlib.decompress(payload)))
+                    elif kind == RECORD_EVICT:
+                        self._remove(sample_id)
+                    else:
+                        assert kind == RECORD_CLEAR, \
+                            f"Unknown replay record kind {kind}"
+                        self._clear()
+        if segment_paths:
+            self._segment_idx = int(segment_paths[-1].stem.split("-")[1]) + 1
+
+    def _add(self, sample_id: int, sample: LabeledTransition) -> None:
+        self._positions[sample_id] = len(self.samples)
+        self.samples.append(sample)
+        self._sample_ids.append(sample_id)
+        self._next_id = max(self._next_id, sample_id + 1)
+
+    def _remove(self, sample_id: int) -> None:
+        # Swap the last sample into the removed one's place, so removal
+        # doesn't shift the list.
+        pos = self._positions.pop(sample_id)
+        last_sample = self.samples.pop()
+        last_id = self._sample_ids.pop()
+        if last_id != sample_id:
+            self.samples[pos] = last_sample
+            self._sample_ids[pos] = last_id
+            self._positions[last_id] = pos
+
+    def _clear(self) -> None:
+        self.samples = []
+        self._sample_ids = []
+        self._positions = {}
+
+    def _write_record(self, f: BinaryIO, kind: int, sample_id: int,
+                      payload: bytes = b"") -> None:
+        f.write(RECORD_HEADER.pack(kind, sample_id, len(payload)))
+        f.write(payload)
+        self._num_records += 1
+
+    def _current_segment(self) -> BinaryIO:
+        if self._segment is not None and \
+           self._segment.tell() >= self.segment_size:
+            self._segment.close()
+            self._segment = None
+            self._segment_idx += 1
+        if self._segment is None:
+            self._segment = self._segment_path(self._segment_idx).open('ab')
+        return self._segment
+
+    def insert(self, sample: LabeledTransition) -> None:
+        # The graph node links to the rest of the search graph, which
+        # isn't part of the sample.
+        sample = replace(sample, graph_node=None)
+        sample_id = self._next_id
+        self._add(sample_id, sample)
+        self._write_record(self._current_segment(), RECORD_INSERT, sample_id,
+                           zlib.compress(pickle.dumps(
+                               sample, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def evict_random(self, num_samples: int) -> None:
+        segment = self._current_segment()
+        for _ in range(min(num_samples, len(self.samples))):
+            sample_id = self._sample_ids[random.randrange(len(self.samples))]
+            self._remove(sample_id)
+            self._write_record(segment, RECORD_EVICT, sample_id)
+
+    def sample(self, k: int) -> List[LabeledTransition]:
+        if k >= len(self.samples):
+            return list(self.samples)
+        return random.sample(self.samples, k)
+
+    def flush(self) -> None:
+        if self._segment is not None:
+            self._segment.flush()
+        if self._num_records > 4 * max(len(self.samples), 1024):
+            self.compact()
+
+    def compact(self) -> None:
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        old_segments = self._segment_paths()
+        snapshot_path = self._segment_path(self._segment_idx)
+        tmp_path = snapshot_path.with_suffix(".tmp")
+        self._num_records = 0
+        with tmp_path.open('wb') as f:
+            self._write_record(f, RECORD_CLEAR, 0)
+            for sample_id, sample in zip(self._sample_ids, self.samples):
+                self._write_record(f, RECORD_INSERT, sample_id,
+                                   zlib.compress(pickle.dumps(
+                                       sample,
+                                       protocol=pickle.HIGHEST_PROTOCOL)))
+        tmp_path.rename(snapshot_path)
+        # The snapshot starts with a CLEAR record, so if we're interrupted
+        # before these are deleted, loading still ends up with the same
+        # samples.
+        for segment_path in old_segments:
+            if segment_path != snapshot_path:
+                segment_path.unlink()
+        self._segment_idx += 1
+
+    def close(self) -> None:
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def delete(self) -> None:
+        self.close()
+        shutil.rmtree(self.path)
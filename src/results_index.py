@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# An index of the jobs that are done in a search output directory. The
+# -proofs.txt files are only ever appended to, so the index remembers how far
+# into each file it has read, and each update only reads the lines written
+# since. It's saved to results-index.json in the output directory, so that
+# resuming a run doesn't have to re-read the results from before either.
+#
+# Only the job at the start of each line is parsed; the search result after
+# it is skipped over.
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from search_worker import ReportJob, project_dicts_from_args
+import util
+from util import eprint, unwrap, FileLock
+
+RESULTS_INDEX_FILE = "results-index.json"
+RESULTS_INDEX_VERSION = 2
+# How many bytes before the read offset to remember, to notice when a
+# proofs file has been replaced rather than appended to.
+TAIL_LENGTH = 64
+
+_decoder = json.JSONDecoder()
+
+
+def proofs_file_path(output_dir: Path, project_dict: Dict, filename: str) \
+        -> Path:
+    return (output_dir / project_dict["project_name"] /
+            (util.safe_abbrev(Path(filename),
+                              [Path(filename) for filename in
+                               project_dict["test_files"]])
+             + "-proofs.txt"))
+
+
+def parse_job(line: str) -> ReportJob:
+    # Lines look like [[project, file, module, lemma], {...result...}]
+    assert line.startswith("["), f"Bad proofs file line {line[:100]}"
+    job, _ = _decoder.raw_decode(line, 1)
+    return ReportJob(*job)
+
+
+class IndexedFile:
+    def __init__(self, offset: int = 0, tail: str = "",
+                 jobs: Optional[List[ReportJob]] = None,
+                 num_lines: Optional[int] = None) -> None:
+        self.offset = offset
+        # The bytes just before offset, as latin-1 so they fit in json
+        self.tail = tail
+        self.jobs = jobs if jobs is not None else []
+        self.jobs_set = set(self.jobs)
+        # Lines read so far, including blank and duplicate ones, for
+        # pointing at bad lines
+        self.num_lines = num_lines if num_lines is not None else len(self.jobs)
+
+
+class ResultsIndex:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.output_dir: Path = args.output_dir
+        self.proofs_files: List[Tuple[Path, str]] = \
+            [(proofs_file_path(self.output_dir, project_dict, filename),
+              filename)
+             for project_dict in project_dicts_from_args(args)
+             for filename in project_dict["test_files"]]
+        self.files: Dict[Path, IndexedFile] = {}
+        self.done_jobs: Set[ReportJob] = set()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.done_jobs)
+
+    def __contains__(self, job: ReportJob) -> bool:
+        return job in self.done_jobs
+
+    @property
+    def index_path(self) -> Path:
+        return self.output_dir / RESULTS_INDEX_FILE
+
+    def jobs(self) -> List[ReportJob]:
+        return [job for proofs_file, _ in self.proofs_files
+                if proofs_file in self.files
+                for job in self.files[proofs_file].jobs]
+
+    def _load(self) -> None:
+        try:
+            with self.index_path.open('r') as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return
+        if index.get("version") != RESULTS_INDEX_VERSION:
+            return
+        known_files = {proofs_file for proofs_file, _ in self.proofs_files}
+        for path_str, entry in index["files"].items():
+            proofs_file = Path(path_str)
+            if proofs_file not in known_files:
+                continue
+            indexed = IndexedFile(entry["offset"], entry["tail"],
+                                  [ReportJob(*job) for job in entry["jobs"]],
+                                  entry["num_lines"])
+            self.files[proofs_file] = indexed
+            self.done_jobs.update(indexed.jobs)
+
+    def save(self) -> None:
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with tmp_path.open('w') as f:
+            json.dump({"version": RESULTS_INDEX_VERSION,
+                       "files": {str(proofs_file): {"offset": indexed.offset,
+                                                    "tail": indexed.tail,
+                                                    "jobs": indexed.jobs,
+                                                    "num_lines":
+                                                    indexed.num_lines}
+                                 for proofs_file, indexed
+                                 in self.files.items()}}, f)
+        tmp_path.replace(self.index_path)
+
+    def _forget(self, proofs_file: Path) -> None:
+        indexed = self.files.pop(proofs_file, None)
+        if indexed is not None:
+            self.done_jobs.difference_update(indexed.jobs)
+
+    def _read_new_bytes(self, proofs_file: Path, indexed: IndexedFile) \
+            -> Optional[bytes]:
+        backoff_amount = 0.001
+        while True:
+            try:
+                with proofs_file.open('rb') as f, \
+                     FileLock(f, exclusive=False):
+                    tail_start = max(0, indexed.offset - TAIL_LENGTH)
+                    f.seek(tail_start)
+                    tail = f.read(indexed.offset - tail_start)
+                    if tail.decode('latin-1') != indexed.tail:
+                        return None
+                    return f.read()
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                eprint("Error reading proofs files "
+                       "(OSError, probably a temporary cluster filesystem "
+                       f"problem). Trying again in {backoff_amount} "
+                       f"seconds.\n{e}")
+                time.sleep(backoff_amount)
+                backoff_amount *= 2
+
+    def update(self) -> int:
+        """
+        Reads whatever has been appended to the proofs files since the last
+        update, and returns how many more jobs are done.
+        """
+        num_done_before = len(self.done_jobs)
+        for proofs_file, filename in self.proofs_files:
+            if not self._update_file(proofs_file, filename):
+                self._remove_duplicates(proofs_file)
+                self._forget(proofs_file)
+                no_duplicates = self._update_file(proofs_file, filename)
+                assert no_duplicates, \
+                    f"Still found duplicate jobs in {proofs_file} after " \
+                    "removing them"
+        return len(self.done_jobs) - num_done_before
+
+    def _update_file(self, proofs_file: Path, filename: str) -> bool:
+        """
+        Returns False if the file had duplicate jobs in it.
+        """
+        indexed = self.files.get(proofs_file, IndexedFile())
+        try:
+            new_bytes = self._read_new_bytes(proofs_file, indexed)
+            if new_bytes is None:
+                # The file was replaced, so start it over.
+                self._forget(proofs_file)
+                indexed = IndexedFile()
+                new_bytes = unwrap(self._read_new_bytes(proofs_file, indexed))
+        except FileNotFoundError:
+            self._forget(proofs_file)
+            return True
+        # Leave any partly written last line for the next update.
+        complete_length = new_bytes.rfind(b"\n") + 1
+        no_duplicates = True
+        for line in new_bytes[:complete_length].decode('utf-8').splitlines():
+            indexed.num_lines += 1
+            if not line.strip():
+                continue
+            try:
+                job = parse_job(line)
+            except json.decoder.JSONDecodeError:
+                print(f"On line {indexed.num_lines} in file {proofs_file}")
+                raise
+            assert Path(job.filename) == Path(filename), \
+                f"Job found in file {filename} doesn't match it's " \
+                f"filename {filename}. {job.filename}"
+            if job in indexed.jobs_set:
+                eprint(f"In file {proofs_file} found duplicate job {job}. "
+                       "Automatically removing it...")
+                no_duplicates = False
+                continue
+            assert job not in self.done_jobs, \
+                f"Already found job {job} in another file!"
+            indexed.jobs.append(job)
+            indexed.jobs_set.add(job)
+            self.done_jobs.add(job)
+        indexed.offset += complete_length
+        indexed.tail = (indexed.tail.encode('latin-1') +
+                        new_bytes[:complete_length])[-TAIL_LENGTH:]\
+            .decode('latin-1')
+        self.files[proofs_file] = indexed
+        return no_duplicates
+
+    def _remove_duplicates(self, proofs_file: Path) -> None:
+        with proofs_file.open('r+') as f, FileLock(f):
+            seen: Set[ReportJob] = set()
+            lines = []
+            for line in f:
+                if not line.strip():
+                    continue
+                job = parse_job(line)
+                if job not in seen:
+                    seen.add(job)
+                    lines.append(line)
+            f.seek(0)
+            f.truncate()
+            f.writelines(lines)
@@ -33,6 +33,7 @@ import os.path
 import linearize_semicolons
 import coq_serapy as serapi_instance
 
+from compact_scrape import CompactScrapeWriter, copy_scrape, index_path
 from util import eprint, mybarfmt
 
 from typing import TextIO, List, Tuple, Optional
@@ -69,6 +70,9 @@ def main():
     parser.add_argument("--sertop-flags", default=None, type=str)
     parser.add_argument("--text-encoding", default='utf-8', type=str)
     parser.add_argument("--split", choices=["train", "test", "all"], default="all")
+    parser.add_argument("--compact", action='store_true',
+                        help="Write the combined output in the compact "
+                        "scrape format, with an index next to it")
     parser.add_argument('inputs', nargs="+", help="proof file name(s) (*.v)")
     args = parser.parse_args()
 
@@ -94,6 +98,7 @@ def main():
             tasks)
         with (open(args.output, 'w') if args.output
               else contextlib.nullcontext(sys.stdout)) as out:
+            compact_writer = CompactScrapeWriter(out) if args.compact else None
             for idx, scrape_result_file in enumerate(scrape_result_files,
                                                      start=1):
                 if scrape_result_file is None:
@@ -104,8 +109,13 @@ def main():
                         eprint("Finished file {} of {}"
                                .format(idx, len(file_jobs)))
                     with open(scrape_result_file, 'r') as f:
-                        for line in f:
-                            out.write(line)
+                        if compact_writer:
+                            copy_scrape(f, compact_writer)
+                        else:
+                            for line in f:
+                                out.write(line)
+        if compact_writer and args.output:
+            compact_writer.write_index(index_path(args.output))
 
 
 def scrape_file(coqargs: List[str], args: argparse.Namespace, all_file_jobs: List[str],
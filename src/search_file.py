@@ -42,7 +42,7 @@ from typing import (List, Tuple, NamedTuple, Optional, Dict,
                     Union, Callable, cast, IO, TypeVar,
                     Any, Iterator, Iterable)
 
-from models.tactic_predictor import TacticPredictor
+from models.tactic_predictor import TacticPredictor, Prediction
 import coq_serapy as serapi_instance
 
 from util import eprint, FileLock
@@ -50,6 +50,10 @@ import search_report
 from predict_tactic import static_predictors
 from search_results import SearchResult
 from search_worker import ReportJob, Worker, get_files_jobs, get_predictor, project_dicts_from_args
+from prediction_server import (PredictionRequest, RemotePredictor,
+                               prediction_server, get_while_server_running)
+from job_costs import JobCostModel
+from results_index import ResultsIndex, RESULTS_INDEX_FILE
 import util
 
 from tqdm import tqdm
@@ -110,6 +114,9 @@ def add_args_to_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("--search-depth", type=int, default=6)
     parser.add_argument("--max-steps", type=int, default=None)
     parser.add_argument("--beam-width", type=int, default=16)
+    parser.add_argument("--frontier-batch-size", type=int, default=1,
+                        help="Number of frontier nodes to predict on at "
+                        "once in best-first/astar search")
     parser.add_argument("--hard-depth-limit", dest="hard_depth_limit",
                         type=int, default=100)
     parser.add_argument("--max-subgoals", type=int, default=16)
@@ -168,7 +175,29 @@ def add_args_to_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("--search-prefix", type=str, default=None)
     parser.add_argument("--no-set-switch", dest="set_switch", action='store_false')
     parser.add_argument("--blacklist-tactic", action="append", dest="blacklisted_tactics")
+    parser.add_argument("--prediction-server", action='store_true',
+                        help="Load the model once in a separate process, and "
+                        "batch together the predictions of all workers")
+    parser.add_argument("--prediction-server-batch-size", type=int, default=32)
+    parser.add_argument("--prediction-server-timeout", type=float, default=0.01,
+                        help="Seconds the prediction server waits to fill "
+                        "a batch")
+    parser.add_argument("--prediction-cache-size", type=int, default=8192,
+                        help="Number of contexts to remember predictions for "
+                        "in each worker. 0 disables the cache")
+    parser.add_argument("--prediction-cache-file", type=Path, default=None,
+                        help="Save predictions to this file, and load them "
+                        "in later runs with the same weights")
+    parser.add_argument("--no-transposition-table", dest="transposition_table",
+                        action='store_false',
+                        help="Don't skip proof states that were already "
+                        "reached from another branch of the search")
     parser.add_argument("--log-explored-states", type=Path, default=None)
+    parser.add_argument("--cost-history", type=Path, action='append',
+                        default=[],
+                        help="Output directory of an earlier run, to estimate "
+                        "job costs from so the slowest jobs start first. "
+                        "Can be given more than once")
 
 def parse_arguments(args_list: List[str]) -> Tuple[argparse.Namespace,
                                                    List[str],
@@ -205,15 +234,24 @@ def search_file_worker_profiled(
                     globals(), locals(), 'searchstats-{}'.format(worker_idx))
 
 def search_file_worker(args: argparse.Namespace,
-                       jobs: 'multiprocessing.Queue[ReportJob]',
+                       jobs: 'multiprocessing.Queue[List[ReportJob]]',
                        done:
                        'multiprocessing.Queue['
                        '  Tuple[ReportJob, SearchResult]]',
                        worker_idx: int,
-                       device: str) -> None:
+                       device: str,
+                       prediction_channels: Optional[Tuple[
+                           'multiprocessing.Queue[Optional[PredictionRequest]]',
+                           'multiprocessing.Queue[Tuple[int, List[Prediction]]]',
+                           'multiprocessing.synchronize.Event']]
+                       = None) -> None:
     sys.setrecursionlimit(100000)
 
-    predictor = get_predictor(args)
+    predictor: TacticPredictor
+    if prediction_channels is not None:
+        predictor = RemotePredictor(worker_idx, *prediction_channels)
+    else:
+        predictor = get_predictor(args)
 
     # util.use_cuda = False
     if util.use_cuda:
@@ -238,72 +276,18 @@ def search_file_worker(args: argparse.Namespace,
     with Worker(args, worker_idx, predictor, switch_dict) as worker:
         while True:
             try:
-                next_job = jobs.get_nowait()
+                next_file_jobs = jobs.get_nowait()
             except queue.Empty:
                 return
-            solution = worker.run_job(next_job, restart=not args.hardfail)
-            done.put((next_job, solution))
+            for next_job in next_file_jobs:
+                solution = worker.run_job(next_job, restart=not args.hardfail)
+                done.put((next_job, solution))
 
 def get_already_done_jobs(args: argparse.Namespace) -> List[ReportJob]:
-    already_done_jobs: List[ReportJob] = []
-
-    project_dicts = project_dicts_from_args(args)
-    for project_dict in project_dicts:
-        for filename in project_dict["test_files"]:
-            fixing_duplicates = False
-            file_jobs: List[Tuple[ReportJob, Any]] = []
-            proofs_file = (args.output_dir / project_dict["project_name"] /
-                           (util.safe_abbrev(Path(filename),
-                                             [Path(filename) for filename in
-                                              project_dict["test_files"]])
-                            + "-proofs.txt"))
-            try:
-                file_lines = None
-                backoff_amount = 0.001
-                while file_lines is None:
-                    try:
-                        with proofs_file.open('r') as f, FileLock(f, exclusive=False):
-                            file_lines = list(f)
-                    except FileNotFoundError:
-                        raise
-                    except OSError as e:
-                        eprint("Error reading proofs files "
-                               "(OSError, probably a temporary cluster filesystem problem). "
-                               f"Trying again in {backoff_amount} seconds.\n{e}")
-                        time.sleep(backoff_amount)
-                        backoff_amount *= 2
-                for idx, line in enumerate(file_lines):
-                    try:
-                        (job_project, job_file, job_module, job_lemma), sol = json.loads(line)
-                    except json.decoder.JSONDecodeError:
-                        print(f"On line {idx} in file {proofs_file}")
-                        raise
-                    assert Path(job_file) == Path(filename), f"Job found in file {filename} " \
-                        f"doesn't match it's filename {filename}. {job_file}"
-                    loaded_job = ReportJob(job_project, job_file, job_module, job_lemma)
-                    if loaded_job in [job for job, sol in file_jobs]:
-                        eprint(f"In project {project_dict['project_name']} "
-                               f"file {filename} "
-                               f"found duplicate job {loaded_job}. "
-                               f"Automatically removing it...")
-                        fixing_duplicates = True
-                    else:
-                        assert loaded_job not in already_done_jobs, \
-                          f"Already found job {loaded_job} in another file!"
-                        file_jobs.append((loaded_job, sol))
-                already_done_jobs.extend([job for job, sol in file_jobs])
-                if fixing_duplicates:
-                    with proofs_file.open('w') as f, FileLock(f):
-                        for job, sol in file_jobs:
-                            print(json.dumps((job, sol)), file=f)
-            except FileNotFoundError:
-                pass
-
-            if len(set(already_done_jobs)) < len(already_done_jobs):
-                eprint(f"After adding file {filename} from project {project_dict['project_name']}, there are duplicates in the solution!")
-                sys.exit(1)
-
-    return already_done_jobs
+    index = ResultsIndex(args)
+    index.update()
+    index.save()
+    return index.jobs()
 
 def get_all_jobs(args: argparse.Namespace) -> List[ReportJob]:
     project_dicts = project_dicts_from_args(args)
@@ -325,6 +309,35 @@ def remove_already_done_jobs(args: argparse.Namespace) -> None:
                 os.remove(proofs_file)
             except FileNotFoundError:
                 pass
+    try:
+        os.remove(args.output_dir / RESULTS_INDEX_FILE)
+    except FileNotFoundError:
+        pass
+
+def group_jobs_by_file(jobs: List[ReportJob], num_groups: int) \
+        -> List[List[ReportJob]]:
+    """
+    Groups jobs so that each worker can run all the jobs for a file, in
+    order, without reloading it. If there are fewer files than workers, the
+    biggest files are split into contiguous runs of jobs so that every worker
+    still has something to do.
+    """
+    groups: List[List[ReportJob]] = []
+    for job in jobs:
+        if len(groups) > 0 and \
+           (groups[-1][0].project_dir, groups[-1][0].filename) == \
+           (job.project_dir, job.filename):
+            groups[-1].append(job)
+        else:
+            groups.append([job])
+    while len(groups) < num_groups:
+        largest_idx = max(range(len(groups)), key=lambda idx: len(groups[idx]))
+        largest = groups[largest_idx]
+        if len(largest) < 2:
+            break
+        groups[largest_idx:largest_idx+1] = [largest[:len(largest)//2],
+                                             largest[len(largest)//2:]]
+    return groups
 
 def search_file_multithreaded(args: argparse.Namespace) -> None:
     global start_time
@@ -332,9 +345,14 @@ def search_file_multithreaded(args: argparse.Namespace) -> None:
     start_time = datetime.now()
     all_jobs = get_all_jobs(args)
     assert len(all_jobs) > 0, "No jobs found! Maybe you passed a bad proof parameter?"
+    # Load the history before removing old results, in case it's the same
+    # directory.
+    cost_model = JobCostModel.from_output_dirs(args.cost_history,
+                                              args.verbose)
     if args.resume:
+        all_jobs_set = set(all_jobs)
         solved_jobs = [job for job in get_already_done_jobs(args)
-                       if job in all_jobs]
+                       if job in all_jobs_set]
         try:
             with open(args.output_dir / "time_so_far.txt", 'r') as f:
                 time_taken = util.read_time_taken(f.read())
@@ -345,7 +363,8 @@ def search_file_multithreaded(args: argparse.Namespace) -> None:
     else:
         remove_already_done_jobs(args)
         solved_jobs = []
-    todo_jobs = [job for job in all_jobs if job not in solved_jobs]
+    solved_jobs_set = set(solved_jobs)
+    todo_jobs = [job for job in all_jobs if job not in solved_jobs_set]
     assert len(todo_jobs) == len(all_jobs) - len(solved_jobs),\
       f"{len(todo_jobs)} != {len(all_jobs)} - {len(solved_jobs)}"
     if args.just_print_jobs:
@@ -353,17 +372,18 @@ def search_file_multithreaded(args: argparse.Namespace) -> None:
             print(job)
         sys.exit(0)
     with multiprocessing.Manager() as manager:
-        jobs: multiprocessing.Queue[ReportJob] = multiprocessing.Queue()
+        jobs: multiprocessing.Queue[List[ReportJob]] = multiprocessing.Queue()
         done: multiprocessing.Queue[
             Tuple[ReportJob, SearchResult]
         ] = multiprocessing.Queue()
 
-
-        for job in todo_jobs:
-            jobs.put(job)
-
         num_threads = min(args.num_threads,
                           len(todo_jobs))
+
+        cost_model.write_predictions(args.output_dir, todo_jobs)
+        for file_jobs in cost_model.order_groups(
+                group_jobs_by_file(todo_jobs, num_threads), num_threads):
+            jobs.put(file_jobs)
         if util.use_cuda:
             if args.gpus:
                 gpu_list = args.gpus.split(",")
@@ -374,12 +394,29 @@ def search_file_multithreaded(args: argparse.Namespace) -> None:
         else:
             assert args.gpus is None, "Passed --gpus flag, but CUDA is not supported!"
             worker_devices = ["cpu"]
+        if args.prediction_server:
+            prediction_requests: multiprocessing.Queue[
+                Optional[PredictionRequest]] = multiprocessing.Queue()
+            prediction_responses: List[multiprocessing.Queue[
+                Tuple[int, List[Prediction]]]] = \
+                [multiprocessing.Queue() for _ in range(num_threads)]
+            server_stopped = multiprocessing.Event()
+            server = multiprocessing.Process(
+                target=prediction_server,
+                args=(args, prediction_requests, prediction_responses,
+                      worker_devices[0], server_stopped))
+            server.start()
         # This cast appears to be needed due to a buggy type stub on
         # multiprocessing.Manager()
         workers = [multiprocessing.Process(target=search_file_worker,
                                            args=(args,
                                                  jobs, done, widx,
-                                                 worker_devices[widx % len(worker_devices)]))
+                                                 worker_devices[widx % len(worker_devices)],
+                                                 (prediction_requests,
+                                                  prediction_responses[widx],
+                                                  server_stopped)
+                                                 if args.prediction_server
+                                                 else None))
                    for widx in range(num_threads)]
         for worker in workers:
             worker.start()
@@ -391,7 +428,12 @@ def search_file_multithreaded(args: argparse.Namespace) -> None:
                 bar.update(n=num_already_done)
                 bar.refresh()
                 for _ in range(len(todo_jobs)):
-                    (done_project, done_file, done_module, done_lemma), sol = done.get()
+                    if args.prediction_server:
+                        done_job = get_while_server_running(done, server,
+                                                            server_stopped)
+                    else:
+                        done_job = done.get()
+                    (done_project, done_file, done_module, done_lemma), sol = done_job
                     if args.splits_file:
                         with args.splits_file.open('r') as splits_f:
                             project_dicts = json.loads(splits_f.read())
@@ -413,6 +455,9 @@ def search_file_multithreaded(args: argparse.Namespace) -> None:
 
             for worker in workers:
                 worker.join()
+            if args.prediction_server:
+                prediction_requests.put(None)
+                server.join()
     time_taken = datetime.now() - start_time
     write_time(args)
     if args.generate_report:
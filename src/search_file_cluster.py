@@ -32,15 +32,19 @@ import functools
 import re
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import List, NamedTuple, Dict, Any
-from threading import Thread
+from typing import List, NamedTuple, Dict, Any, Callable, Set, TextIO, Tuple
+from threading import Thread, Event
 
 from tqdm import tqdm
 
 
 from search_file import (add_args_to_parser,
                          get_already_done_jobs, remove_already_done_jobs,
-                         project_dicts_from_args, format_arg_value)
+                         project_dicts_from_args, format_arg_value,
+                         group_jobs_by_file)
+from job_costs import JobCostModel
+from results_index import ResultsIndex
+from progress_log import ProgressMonitor, events_path
 from search_worker import ReportJob
 import util
 
@@ -59,6 +63,9 @@ def main(arg_list: List[str]) -> None:
     arg_parser.add_argument("--worker-timeout", default="6:00:00")
     arg_parser.add_argument("-p", "--partition", default="defq")
     arg_parser.add_argument("--mem", default="2G")
+    arg_parser.add_argument("--heartbeat-interval", default=60, type=float,
+                            help="Seconds between worker heartbeats. Workers "
+                            "that miss five in a row are reported as crashed")
 
     args = arg_parser.parse_args(arg_list)
     if args.filenames[0].suffix == ".json":
@@ -83,6 +90,10 @@ def main(arg_list: List[str]) -> None:
                 shutil.copyfile(srcpath, destpath)
 
     start_time = datetime.now()
+    # Load the history before removing old results, in case it's the same
+    # directory.
+    cost_model = JobCostModel.from_output_dirs(args.cost_history,
+                                              args.verbose)
     if args.resume:
         solved_jobs = get_already_done_jobs(args)
         try:
@@ -106,8 +117,10 @@ def main(arg_list: List[str]) -> None:
                 if job not in solved_jobs:
                     print(job)
             sys.exit(0)
-        setup_jobsstate(args.output_dir, jobs, solved_jobs)
-        dispatch_workers(args, min(args.num_workers, len(jobs) - len(solved_jobs)), arg_list)
+        num_workers = min(args.num_workers, len(jobs) - len(solved_jobs))
+        setup_jobsstate(args.output_dir, jobs, solved_jobs, cost_model,
+                        num_workers * args.num_threads)
+        dispatch_workers(args, num_workers, arg_list)
         with util.sighandler_context(signal.SIGINT, functools.partial(interrupt_early, args)):
             show_progress(args)
         cancel_workers(args)
@@ -195,12 +208,11 @@ def get_all_jobs_cluster(args: argparse.Namespace) -> None:
                               "file-scanner-%a.out"),
                     f"--array=0-{num_job_workers}",
                     f"{cur_dir}/job_getting_worker.sh"] + worker_args)
-    threads = [Thread(target=follow_and_print, args=
-        (str(args.output_dir / args.workers_output_dir / f"file-scanner-{idx}.out"),))
-        for idx in range(num_job_workers)]
-    for t in threads:
-        t.daemon = True
-        t.start()
+    stop_follows = Event()
+    follow_thread = Thread(target=follow_and_print, args=(
+        [str(args.output_dir / args.workers_output_dir / f"file-scanner-{idx}.out")
+         for idx in range(num_job_workers)], stop_follows), daemon=True)
+    follow_thread.start()
 
     with tqdm(desc="Getting jobs", total=len(projfiles), dynamic_ncols=True) as bar:
         num_files_scanned = 0
@@ -210,26 +222,40 @@ def get_all_jobs_cluster(args: argparse.Namespace) -> None:
             bar.update(new_files_scanned - num_files_scanned)
             num_files_scanned = new_files_scanned
             time.sleep(0.2)
-    close_follows = True
+    stop_follows.set()
+    follow_thread.join()
 
     os.rename(args.output_dir / "all_jobs.txt.partial",
               args.output_dir / "all_jobs.txt")
 
 
 def setup_jobsstate(output_dir: Path, all_jobs: List[ReportJob],
-                    solved_jobs: List[ReportJob]) -> None:
-    with (output_dir / "taken.txt").open("w") as f:
+                    solved_jobs: List[ReportJob], cost_model: JobCostModel,
+                    num_shards: int) -> None:
+    # Workers claim jobs by their line number in jobs.txt, so claims from a
+    # previous run don't carry over.
+    shutil.rmtree(output_dir / "claims", ignore_errors=True)
+    (output_dir / "claims").mkdir()
+    with events_path(output_dir).open("w"):
         pass
+    solved_jobs_set = set(solved_jobs)
+    todo_jobs = [job for job in all_jobs if job not in solved_jobs_set]
+    num_shards = min(num_shards, len(todo_jobs))
+    cost_model.write_predictions(output_dir, todo_jobs)
+    shards = cost_model.assign_shards(
+        group_jobs_by_file(todo_jobs, num_shards), num_shards)
+    shard_bounds = [0]
     with (output_dir / "jobs.txt").open("w") as f:
-        for job in all_jobs:
-            if job not in solved_jobs:
+        for shard in shards:
+            for job in shard:
                 print(json.dumps(job), file=f)
+            shard_bounds.append(shard_bounds[-1] + len(shard))
         print("", end="", flush=True, file=f)
+    with (output_dir / "job_shards.json").open("w") as f:
+        json.dump(shard_bounds, f)
 def dispatch_workers(args: argparse.Namespace, num_workers: int, rest_args: List[str]) -> None:
     with (args.output_dir / "num_workers_dispatched.txt").open("w") as f:
         print(num_workers, file=f)
-    with (args.output_dir / "workers_scheduled.txt").open("w") as f:
-        pass
     cur_dir = os.path.realpath(os.path.dirname(__file__))
     num_workers_left = num_workers
     # For some reason it looks like the maximum job size array is 1001 for
@@ -273,126 +299,157 @@ def show_progress(args: argparse.Namespace) -> None:
         all_jobs = [ReportJob(*json.loads(l)) for l in f]
     with (args.output_dir / "num_workers_dispatched.txt").open('r') as f:
         num_workers_total = int(f.read())
-    with (args.output_dir / "workers_scheduled.txt").open('r') as f:
-        workers_scheduled = list(f)
-    jobs_done = get_already_done_jobs(args)
-    num_workers_alive = 0
-    crashed_workers: List[int] = []
+    # Jobs finished in earlier runs come from the results index, and jobs
+    # finished in this one from the workers' event log.
+    results_index = ResultsIndex(args)
+    results_index.update()
+    monitor = ProgressMonitor(args.output_dir, set(results_index.done_jobs))
+    heartbeat_timeout = args.heartbeat_interval * 5
+    # Searches stop themselves after max_proof_time, so a job that's still
+    # going well after that is probably stuck in coq.
+    max_job_time = args.max_proof_time * 2 + heartbeat_timeout
+    stalled_reported: Set[Tuple[int, int]] = set()
+    overdue_reported: Set[ReportJob] = set()
+    last_queue_check = time.time()
 
-    with tqdm(desc="Jobs finished", total=len(all_jobs), initial=len(jobs_done), dynamic_ncols=True) as bar, \
-         tqdm(desc="Workers scheduled", total=num_workers_total, initial=len(workers_scheduled), dynamic_ncols=True) as wbar:
-        while len(jobs_done) < len(all_jobs):
-            new_workers_alive = [int(wid) for wid in
-                                 subprocess.check_output(
-                                   f"squeue -r -u$USER -h -n proverbot9001-worker-{args.output_dir} -o%K",
-                                   shell=True, text=True).strip().split("\n")
-                                 if wid != ""]
-            time.sleep(0.2)
-            new_jobs_done = get_already_done_jobs(args)
-            bar.update(len(new_jobs_done) - len(jobs_done))
-            jobs_done = new_jobs_done
+    with tqdm(desc="Jobs finished", total=len(all_jobs), initial=len(monitor.jobs_done), dynamic_ncols=True) as bar, \
+         tqdm(desc="Workers started", total=num_workers_total, dynamic_ncols=True) as wbar:
+        while len(monitor.jobs_done) < len(all_jobs):
+            time.sleep(1)
+            bar.update(monitor.poll())
+            wbar.update(len(monitor.workers_started) - wbar.n)
 
             # Check for newly crashed workers
-            for worker_id in range(num_workers_total):
-                # Skip any living worker
-                if worker_id in new_workers_alive:
+            for worker_id, thread_id in monitor.stalled_threads(heartbeat_timeout):
+                if (worker_id, thread_id) in stalled_reported:
                     continue
-                # Skip any worker for which we've already reported a crash
-                if worker_id in crashed_workers:
+                stalled_reported.add((worker_id, thread_id))
+                left_behind = monitor.threads[(worker_id, thread_id)].current_job
+                util.eprint(f"Worker {worker_id} thread {thread_id} stopped responding!"
+                            + (f" Left behind job {left_behind}" if left_behind else ""))
+            for (worker_id, thread_id), job, time_running in \
+                    monitor.overdue_jobs(max_job_time):
+                if job in overdue_reported:
                     continue
-                # Skip any worker that hasn't started yet, and get the jobs taken by workers that did.
-                try:
-                    with (args.output_dir / f"worker-{worker_id}-taken.txt").open('r') as f:
-                        taken_by_worker = [ReportJob(*json.loads(l)) for l in f]
-                except FileNotFoundError:
-                    continue
-                jobs_left_behind = 0
-                for job in all_jobs:
-                    if job not in jobs_done and job in taken_by_worker:
-                        jobs_left_behind += 1
-                if jobs_left_behind > 0:
-                    util.eprint(f"Worker {worker_id} crashed! Left behind {jobs_left_behind} unfinished jobs")
-                    crashed_workers.append(worker_id)
-            if len(new_workers_alive) == 0:
-                time.sleep(1)
-                if len(jobs_done) < len(all_jobs):
+                overdue_reported.add(job)
+                util.eprint(f"Worker {worker_id} thread {thread_id} has been "
+                            f"running job {job} for {time_running:.0f} "
+                            "seconds, it might be stuck")
+            # If no worker has been heard from in a while, ask the scheduler
+            # whether any are still waiting to start before giving up.
+            if monitor.num_threads_running(heartbeat_timeout) == 0 and \
+               time.time() - monitor.last_event_time > heartbeat_timeout and \
+               time.time() - last_queue_check > heartbeat_timeout:
+                last_queue_check = time.time()
+                workers_queued = subprocess.check_output(
+                    f"squeue -r -u$USER -h -n proverbot9001-worker-{args.output_dir} -o%K",
+                    shell=True, text=True).strip()
+                if workers_queued == "":
+                    # Workers killed between writing a result and logging
+                    # it leave the job missing from the log, so check the
+                    # results files before giving up.
+                    results_index.update()
+                    bar.update(monitor.add_done_jobs(results_index.done_jobs))
+                    if len(monitor.jobs_done) >= len(all_jobs):
+                        break
                     util.eprint("All workers exited, but jobs aren't done!")
                     write_time(args)
                     sys.exit(1)
-            with (args.output_dir / "workers_scheduled.txt").open('r') as f:
-                new_workers_scheduled = list(f)
-            wbar.update(len(new_workers_scheduled) - len(workers_scheduled))
-            workers_scheduled = new_workers_scheduled
 
-def follow_and_print(filename: str) -> None:
-    global close_follows
-    close_follows = False
-    while not Path(filename).exists():
-        time.sleep(0.1)
-    with open(filename, 'r') as f:
-        while True:
-            line = f.readline()
-            if "UserWarning: TorchScript" in line or "warnings.warn" in line:
-                continue
-            if line.strip() != "":
-                print(line, end="")
-            if close_follows:
-                break
-            time.sleep(0.01)
+def follow_files(filenames: List[str], handle_line: Callable[[int, str], None],
+                 stop: Event) -> None:
+    """
+    Calls handle_line with the index of the file and the line, for each
+    line written to any of the given files, until stop is set. All the
+    files are followed from one thread, and when there's nothing new it
+    waits a little longer each time, up to a second.
+    """
+    files: Dict[int, TextIO] = {}
+    partial_lines: Dict[int, str] = {}
+    delay = 0.01
+    try:
+        while not stop.is_set():
+            got_line = False
+            for idx, filename in enumerate(filenames):
+                if idx not in files:
+                    try:
+                        files[idx] = open(filename, 'r')
+                    except FileNotFoundError:
+                        continue
+                while True:
+                    line = files[idx].readline()
+                    if line == "":
+                        break
+                    line = partial_lines.pop(idx, "") + line
+                    if not line.endswith("\n"):
+                        partial_lines[idx] = line
+                        break
+                    handle_line(idx, line)
+                    got_line = True
+            if got_line:
+                delay = 0.01
+            else:
+                stop.wait(delay)
+                delay = min(delay * 2, 1.0)
+    finally:
+        for f in files.values():
+            f.close()
 
-close_follows: bool
+def is_warning_line(line: str) -> bool:
+    return "UserWarning: TorchScript" in line or "warnings.warn" in line
 
-def follow_with_progress(filename: str, bar: tqdm, bar_prompt: str ="Report Files") -> None:
-    global close_follows
-    close_follows = False
-    progress = 0
-    set_total = False
-    while not Path(filename).exists():
-        time.sleep(0.1)
-    with open(filename, 'r') as f:
-        while True:
-            line = f.readline()
-            if "UserWarning: TorchScript" in line or "warnings.warn" in line:
-                continue
-            if bar_prompt + ":" in line:
-                new_progress = int(re.match(".*(\d+)/\d+", line).group(1))
-                if not set_total:
-                    total = int(re.match(".*\d+/(\d+)", line).group(1))
-                    bar.total = total
-                    bar.refresh()
-                    set_total = True
-                if new_progress > progress:
-                    bar.update(new_progress - progress)
-                    progress = new_progress
-                continue
-            if line.strip() != "":
-                bar.write(line, end="")
-            if close_follows:
-                break
-            time.sleep(0.01)
+def follow_and_print(filenames: List[str], stop: Event) -> None:
+    def print_line(idx: int, line: str) -> None:
+        if not is_warning_line(line) and line.strip() != "":
+            print(line, end="")
+    follow_files(filenames, print_line, stop)
+
+def follow_with_progress(filenames: List[str], bars: List[tqdm], stop: Event,
+                         bar_prompt: str ="Report Files") -> None:
+    progress = [0] * len(filenames)
+    def update_bar(idx: int, line: str) -> None:
+        bar = bars[idx]
+        if is_warning_line(line):
+            return
+        if bar_prompt + ":" in line:
+            counts = re.findall(r"(\d+)/(\d+)", line)
+            if not counts:
+                return
+            new_progress, total = map(int, counts[-1])
+            if bar.total != total:
+                bar.total = total
+                bar.refresh()
+            if new_progress > progress[idx]:
+                bar.update(new_progress - progress[idx])
+                progress[idx] = new_progress
+            return
+        if line.strip() != "":
+            bar.write(line, end="")
+    follow_files(filenames, update_bar, stop)
 
 def show_report_progress(report_dir: Path, project_dicts: List[Dict[str, Any]], output_files: List[str]) -> None:
-    test_projects_total = len([d for d in project_dicts if len(d["test_files"]) > 0])
-    num_projects_done = 0
-    with tqdm(desc="Project reports generated", total=test_projects_total) as bar:
+    test_project_dicts = [d for d in project_dicts if len(d["test_files"]) > 0]
+    index_files = [report_dir / d["project_name"] / "index.html"
+                   for d in test_project_dicts]
+    stop_follows = Event()
+    with tqdm(desc="Project reports generated", total=len(test_project_dicts)) as bar:
         bars = [tqdm(desc=(project_dict["project_name"]
                      if len(project_dicts) > 1 else "Report") + " files")
-                for idx, (project_dict, _)
-                in enumerate(zip(project_dicts, output_files))]
-        threads = [Thread(target=follow_with_progress, args=(filename,bar)) for filename, bar in zip(output_files, bars)]
-        for t in threads:
-            t.daemon = True
-            t.start()
-        while num_projects_done < test_projects_total:
-            new_projects_done = int(subprocess.check_output(
-                f"find {report_dir} -wholename '*/index.html' | wc -l",
-                shell=True, text=True))
+                for project_dict in test_project_dicts]
+        follow_thread = Thread(target=follow_with_progress,
+                               args=(output_files, bars, stop_follows),
+                               daemon=True)
+        follow_thread.start()
+        num_projects_done = 0
+        while num_projects_done < len(test_project_dicts):
+            new_projects_done = len([f for f in index_files if f.exists()])
             bar.update(new_projects_done - num_projects_done)
             num_projects_done = new_projects_done
-            time.sleep(0.2)
+            time.sleep(1)
+        stop_follows.set()
+        follow_thread.join()
         for bar in bars:
             bar.close()
-        close_follows = True
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -22,16 +22,18 @@
 
 import argparse
 import json
+import os
 import sys
 import multiprocessing
 from os import environ
-from typing import List
+from typing import List, Iterator
 
 from pathlib import Path
 import torch
 
 from search_file import (add_args_to_parser, get_predictor, Worker, project_dicts_from_args)
 from models.tactic_predictor import TacticPredictor
+from progress_log import ProgressLog
 import util
 from util import eprint, FileLock
 
@@ -49,9 +51,8 @@ def main(arg_list: List[str]) -> None:
     arg_parser.add_argument("--worker-timeout", default="6:00:00")
     arg_parser.add_argument("-p", "--partition", default="defq")
     arg_parser.add_argument("--mem", default="2G")
+    arg_parser.add_argument("--heartbeat-interval", default=60, type=float)
     args = arg_parser.parse_args(arg_list)
-    with (args.output_dir / "workers_scheduled.txt").open('a') as f, FileLock(f):
-        print(workerid, file=f)
     if args.filenames[0].suffix == ".json":
         assert args.splits_file == None
         assert len(args.filenames) == 1
@@ -80,6 +81,12 @@ def main(arg_list: List[str]) -> None:
     eprint(f"Finished worker {workerid}")
 
 def run_worker(args: argparse.Namespace, threadid: int, workerid: int) -> None:
+    with ProgressLog(args.output_dir, workerid, threadid,
+                     args.heartbeat_interval) as progress:
+        run_worker_jobs(args, threadid, workerid, progress)
+
+def run_worker_jobs(args: argparse.Namespace, threadid: int, workerid: int,
+                    progress: ProgressLog) -> None:
     with (args.output_dir / "jobs.txt").open('r') as f:
         all_jobs = [json.loads(line) for line in f]
     
@@ -91,27 +98,20 @@ def run_worker(args: argparse.Namespace, threadid: int, workerid: int) -> None:
                         for item in project_dicts}
     else:
         switch_dict = None
-    worker_taken_file = args.output_dir / f"worker-{workerid}-taken.txt"
-    with worker_taken_file.open("w"):
-        pass
+    if len(all_jobs) == 0:
+        eprint(f"Finished thread {threadid}")
+        return
+    with (args.output_dir / "job_shards.json").open('r') as f:
+        shard_bounds = json.load(f)
+    own_shard = (workerid * args.num_threads + threadid) % \
+        (len(shard_bounds) - 1)
 
     with Worker(args, threadid, predictor, switch_dict) as worker:
-        while True:
-            with (args.output_dir / "taken.txt").open('r+') as f, FileLock(f):
-                taken_jobs = [json.loads(line) for line in f]
-                current_job = None
-                for job in all_jobs:
-                    if job not in taken_jobs:
-                        current_job = job
-                        break
-                if current_job:
-                    print(json.dumps(current_job), file=f, flush=True)
-                    with worker_taken_file.open("a") as f:
-                        print(json.dumps(current_job), file=f, flush=True)
-                    eprint(f"Starting job {current_job}")
-                else:
-                    eprint(f"Finished thread {threadid}")
-                    break
+        for job_idx in claim_jobs(args.output_dir / "claims", shard_bounds,
+                                  own_shard):
+            current_job = all_jobs[job_idx]
+            progress.log("job_start", current_job)
+            eprint(f"Starting job {current_job}")
             solution = worker.run_job(current_job)
             job_project, job_file, _, _ = current_job
             project_dict = [d for d in project_dicts if d["project_name"] == job_project][0]
@@ -122,6 +122,55 @@ def run_worker(args: argparse.Namespace, threadid: int, workerid: int) -> None:
                   ).open('a') as f, FileLock(f):
                 eprint(f"Finished job {current_job}")
                 print(json.dumps((current_job, solution.to_dict())), file=f)
+            progress.log("job_done", current_job)
+        eprint(f"Finished thread {threadid}")
+
+def claim_job(claims_dir: Path, job_idx: int) -> bool:
+    # Creating the claim file with O_EXCL is atomic, even on NFS, so
+    # exactly one thread gets each job without anyone holding a lock.
+    try:
+        fd = os.open(claims_dir / str(job_idx),
+                     os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    return True
+
+def claim_jobs(claims_dir: Path, shard_bounds: List[int],
+               own_shard: int) -> Iterator[int]:
+    """
+    Yields the indices of the jobs this thread claims, one at a time.
+
+    The jobs are split into contiguous shards, one per thread, with shard i
+    running from shard_bounds[i] to shard_bounds[i+1]. A thread
+    works through its own shard from the front, and then steals from the
+    other shards from the back, moving on to the next shard as soon as it
+    finds a job that's already claimed. That way threads only contend
+    where they meet, and the jobs a thread runs mostly stay in the same
+    file.
+
+    A thief that dies part way through a shard leaves a claimed job in
+    front of the ones it hadn't reached yet, and the other thieves stop
+    there. So once there's nothing left to steal, the thread makes a last
+    pass over every shard, claiming whatever nobody has.
+    """
+    num_shards = len(shard_bounds) - 1
+    def shard_jobs(shard: int) -> range:
+        return range(shard_bounds[shard], shard_bounds[shard + 1])
+    for job_idx in shard_jobs(own_shard):
+        if claim_job(claims_dir, job_idx):
+            yield job_idx
+    for offset in range(1, num_shards):
+        for job_idx in reversed(shard_jobs((own_shard + offset) % num_shards)):
+            if not claim_job(claims_dir, job_idx):
+                break
+            yield job_idx
+    # Listing the claims once saves trying to create every claim file again
+    claimed = set(os.listdir(claims_dir))
+    for offset in range(1, num_shards):
+        for job_idx in shard_jobs((own_shard + offset) % num_shards):
+            if str(job_idx) not in claimed and claim_job(claims_dir, job_idx):
+                yield job_idx
 
 if __name__ == "__main__":
     main(sys.argv[1:])
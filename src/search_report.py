@@ -27,6 +27,7 @@ import re
 import datetime
 import itertools
 import json
+import multiprocessing
 import subprocess
 from pathlib import Path
 from shutil import copyfile
@@ -64,67 +65,150 @@ Line = Callable[..., None]
 
 unnamed_goal_number: int = 0
 
-def generate_report(args: argparse.Namespace, predictor: TacticPredictor,
-                    project_dicts: List[Dict[str, Any]], time_taken: datetime.timedelta) -> None:
-    base = Path(os.path.dirname(os.path.abspath(__file__)))
+# The arguments that change what goes into a file's report. Only these are
+# part of the report stamp, so that rerunning with different flags for the
+# search itself (like --resume or --num-threads) doesn't redo every report.
+REPORT_ARGS = ["search_width", "search_depth", "max_print_term",
+               "max_print_hyps", "max_print_subgoals"]
 
+def generate_report(args: argparse.Namespace, predictor: TacticPredictor,
+                    project_dicts: List[Dict[str, Any]], time_taken: datetime.timedelta,
+                    force: bool = False) -> None:
     if not args.output_dir.exists():
         os.makedirs(str(args.output_dir))
-    for project_dict in tqdm([project_dict for project_dict in project_dicts
-                              if len(project_dict["test_files"]) > 0],
-                             desc="Report Projects"):
-        generate_project_report(args, predictor, project_dict, time_taken)
+    project_dicts = [project_dict for project_dict in project_dicts
+                     if len(project_dict["test_files"]) > 0]
+    project_stats = generate_files_reports(args, predictor, project_dicts, force)
+    for project_dict in tqdm(project_dicts, desc="Report Projects"):
+        produce_index(args, predictor,
+                      args.output_dir / project_dict["project_name"],
+                      project_stats[project_dict["project_name"]], time_taken)
     if len(project_dicts) > 1:
         multi_project_report.multi_project_index(args.output_dir)
 
 def generate_project_report(args: argparse.Namespace, predictor: TacticPredictor,
-                            project_dict: Dict[str, Any], time_taken: datetime.timedelta) \
-                            -> None:
+                            project_dict: Dict[str, Any], time_taken: datetime.timedelta,
+                            force: bool = False) -> None:
+    project_stats = generate_files_reports(args, predictor, [project_dict], force)
+    produce_index(args, predictor,
+                  args.output_dir / project_dict["project_name"],
+                  project_stats[project_dict["project_name"]], time_taken)
+
+def generate_files_reports(args: argparse.Namespace, predictor: TacticPredictor,
+                           project_dicts: List[Dict[str, Any]], force: bool) \
+                           -> Dict[str, List[ReportStats]]:
+    """
+    Writes the report files for every test file in the given projects,
+    spread over args.num_threads processes, and returns the stats of each
+    project's files, in order.
+    """
     base = Path(os.path.dirname(os.path.abspath(__file__)))
     model_name = dict(predictor.getOptions())["predictor"]
-    stats: List[ReportStats] = []
-    for filename in [details_css, details_javascript]:
-        destpath = args.output_dir / project_dict["project_name"] / filename
-        if not destpath.exists():
-            srcpath = base.parent / 'reports' / filename
-            copyfile(srcpath, destpath)
-    for filename in tqdm(project_dict["test_files"], desc="Report Files", leave=False):
-        file_solutions = []
-        output_file_prefix = args.output_dir / project_dict["project_name"] / \
-              (safe_abbrev(Path(filename),
-                                [Path(path) for path in
-                                 project_dict["test_files"]]))
-        source_file = args.prelude / project_dict["project_name"] / filename
+    for project_dict in project_dicts:
+        for filename in [details_css, details_javascript]:
+            destpath = args.output_dir / project_dict["project_name"] / filename
+            if not destpath.exists():
+                srcpath = base.parent / 'reports' / filename
+                copyfile(srcpath, destpath)
+    file_args = [(args, project_dict, filename, model_name, force)
+                 for project_dict in project_dicts
+                 for filename in project_dict["test_files"]]
+    file_stats: Dict[Tuple[str, str], ReportStats] = {}
+    num_threads = max(1, min(args.num_threads, len(file_args)))
+    with tqdm(total=len(file_args), desc="Report Files", leave=False) as bar:
+        if num_threads == 1:
+            results: Iterable[Tuple[str, str, ReportStats]] = \
+                map(generate_file_report_star, file_args)
+            for project_name, filename, stats in results:
+                file_stats[(project_name, filename)] = stats
+                bar.update()
+        else:
+            # This can be called at the end of a search, with CUDA and tqdm
+            # threads running, which forked processes can't safely inherit.
+            with multiprocessing.get_context("spawn").Pool(num_threads) as pool:
+                for project_name, filename, stats in \
+                        pool.imap_unordered(generate_file_report_star, file_args):
+                    file_stats[(project_name, filename)] = stats
+                    bar.update()
+    return {project_dict["project_name"]:
+            [file_stats[(project_dict["project_name"], filename)]
+             for filename in project_dict["test_files"]]
+            for project_dict in project_dicts}
+
+def generate_file_report_star(file_args: Tuple[argparse.Namespace, Dict[str, Any],
+                                               str, str, bool]) \
+                              -> Tuple[str, str, ReportStats]:
+    _, project_dict, filename, _, _ = file_args
+    return (project_dict["project_name"], filename,
+            generate_file_report(*file_args))
+
+def file_stamp(path: Path) -> Optional[List[int]]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def generate_file_report(args: argparse.Namespace, project_dict: Dict[str, Any],
+                         filename: str, model_name: str, force: bool) \
+                         -> ReportStats:
+    output_file_prefix = args.output_dir / project_dict["project_name"] / \
+          (safe_abbrev(Path(filename),
+                            [Path(path) for path in
+                             project_dict["test_files"]]))
+    source_file = args.prelude / project_dict["project_name"] / filename
+    proofs_path = Path(str(output_file_prefix) + "-proofs.txt")
+    if not proofs_path.exists():
+        lemmas = get_file_jobs(args, project_dict["project_name"], filename)
+        assert len(lemmas) == 0, lemmas
+        return ReportStats(filename, 0, 0, 0)
+
+    # The report for a file only depends on its proofs, its scrape, and the
+    # REPORT_ARGS, so if none of those have changed since the last report,
+    # reuse it.
+    stamp_path = Path(str(output_file_prefix) + "-report-stamp.json")
+    stamp = {"proofs": file_stamp(proofs_path),
+             "scrape": file_stamp(source_file.with_suffix(".v.scrape")),
+             "model": model_name,
+             "args": {k: str(getattr(args, k)) for k in REPORT_ARGS}}
+    if not force and all(output_file_prefix.with_suffix(suffix).exists()
+                         for suffix in [".v", ".html", ".csv"]):
         try:
-            with (Path(str(output_file_prefix) + "-proofs.txt")).open('r') as f:
-                for line in f:
-                    job, sol = json.loads(line)
-                    file_solutions.append((job, SearchResult.from_dict(sol)))
-        except FileNotFoundError:
-            lemmas = get_file_jobs(args, project_dict["project_name"], filename)
-            assert len(lemmas) == 0, lemmas
-            stats.append(ReportStats(filename, 0, 0, 0))
-            continue
-        for (sol_project, sol_filename, _, _), _ in file_solutions:
-            assert sol_project == project_dict["project_name"], \
-              (sol_project, project_dict["project_name"])
-            assert Path(sol_filename) == Path(filename), \
-              (Path(sol_filename), Path(filename))
-        blocks = blocks_from_scrape_and_sols(
-            source_file,
-            [(lemma_stmt, module_name, sol)
-            for (project, filename, module_name, lemma_stmt), sol
-            in file_solutions])
-
-        write_solution_vfile(args, output_file_prefix.with_suffix(".v"),
-                             model_name, blocks)
-        write_html(args, output_file_prefix.with_suffix(".html"),
-                   Path(filename), blocks)
-        write_csv(args, output_file_prefix.with_suffix(".csv"), blocks)
-        stats.append(stats_from_blocks(blocks, str(filename)))
-    produce_index(args, predictor,
-                  args.output_dir / project_dict["project_name"],
-                  stats, time_taken)
+            with stamp_path.open('r') as f:
+                old_stamp = json.load(f)
+            if old_stamp["inputs"] == stamp:
+                return ReportStats(*old_stamp["stats"])
+        except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError):
+            pass
+
+    file_solutions = []
+    with proofs_path.open('r') as f:
+        for line in f:
+            job, sol = json.loads(line)
+            file_solutions.append((job, SearchResult.from_dict(sol)))
+    for (sol_project, sol_filename, _, _), _ in file_solutions:
+        assert sol_project == project_dict["project_name"], \
+          (sol_project, project_dict["project_name"])
+        assert Path(sol_filename) == Path(filename), \
+          (Path(sol_filename), Path(filename))
+    blocks = blocks_from_scrape_and_sols(
+        source_file,
+        [(lemma_stmt, module_name, sol)
+        for (project, filename, module_name, lemma_stmt), sol
+        in file_solutions])
+
+    write_solution_vfile(args, output_file_prefix.with_suffix(".v"),
+                         model_name, blocks)
+    write_html(args, output_file_prefix.with_suffix(".html"),
+               Path(filename), blocks)
+    write_csv(args, output_file_prefix.with_suffix(".csv"), blocks)
+    stats = stats_from_blocks(blocks, str(filename))
+    with stamp_path.open('w') as f:
+        json.dump({"inputs": stamp, "stats": list(stats)}, f)
+    return stats
+
+def normalize_statement(lemma_stmt: str) -> str:
+    return coq_serapy.kill_comments(lemma_stmt).strip()
 
 def blocks_from_scrape_and_sols(
         src_filename: Path,
@@ -134,13 +218,12 @@ def blocks_from_scrape_and_sols(
     interactions = scraped_from_file(
         str(src_filename.with_suffix(".v.scrape")))
 
+    results: Dict[Tuple[str, str], SearchResult] = {}
+    for lstmt, lmod, lresult in lemma_statements_done:
+        results.setdefault((lmod, normalize_statement(lstmt)), lresult)
+
     def lookup(module: str, lemma_stmt: str) -> Optional[SearchResult]:
-        for lstmt, lmod, lresult in lemma_statements_done:
-            if (lmod == module and
-                    coq_serapy.kill_comments(lstmt).strip()
-                    == coq_serapy.kill_comments(lemma_stmt).strip()):
-                return lresult
-        return None
+        return results.get((module, normalize_statement(lemma_stmt)))
 
     def generate():
         cur_lemma_stmt = ""
@@ -622,6 +705,9 @@ def main() -> None:
     arg_parser.add_argument("report_dir", type=Path)
     arg_parser.add_argument("-p", "--project", type=str, default=None)
     arg_parser.add_argument("-i", "--project-index-only", action="store_true")
+    arg_parser.add_argument("--force", action="store_true",
+                            help="Regenerate the report for every file, even "
+                            "ones whose results haven't changed")
     top_args = arg_parser.parse_args()
     assert not (top_args.project and top_args.project_index_only)
 
@@ -647,12 +733,13 @@ def main() -> None:
           f"No project matches project name {top_args.project}"
         assert len(matching_project_dicts) == 1, \
           f"Multiple projects match project name {top_args.project}"
-        generate_project_report(args, predictor, matching_project_dicts[0], time_taken)
+        generate_project_report(args, predictor, matching_project_dicts[0], time_taken,
+                                top_args.force)
     elif top_args.project_index_only:
         assert len(project_dicts) > 1
         multi_project_report.multi_project_index(args.output_dir)
     else:
-        generate_report(args, predictor, project_dicts, time_taken)
+        generate_report(args, predictor, project_dicts, time_taken, top_args.force)
 
 if __name__ == "__main__":
     main()
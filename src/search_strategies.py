@@ -7,7 +7,8 @@ import sys
 import pickle
 import heapq
 import math
-from typing import Dict, List, Tuple, Optional, IO, NamedTuple, cast
+from typing import (Dict, List, Tuple, Optional, IO, NamedTuple, Set,
+                    FrozenSet, Union, cast)
 from dataclasses import dataclass, field
 from pathlib import Path
 
@@ -15,10 +16,12 @@ import pygraphviz as pgv
 from tqdm import tqdm, trange
 
 import coq_serapy
-from coq_serapy.contexts import TacticContext, FullContext, ProofContext, truncate_tactic_context
+from coq_serapy.contexts import (TacticContext, FullContext, ProofContext,
+                                 Obligation, truncate_tactic_context)
 import tokenizer
-from models.tactic_predictor import Prediction, TacticPredictor
+from models.tactic_predictor import Prediction, TacticPredictor, PredictionCache
 from models.features_polyarg_predictor import FeaturesPolyargPredictor
+from prediction_server import RemotePredictor
 from search_results import TacticInteraction, SearchResult, SearchStatus
 from util import nostderr, unwrap, eprint, mybarfmt, copyArgs, FileLock
 
@@ -229,6 +232,56 @@ def contextInPath(full_context: ProofContext, path: List[LabeledNode]):
                 for n in path])
 
 
+class TranspositionTable:
+    """
+    Remembers the proof states reached so far while searching a single lemma,
+    across every branch of the search, so that a state reached again from
+    a different branch doesn't have its subtree searched twice.
+
+    States are keyed on a canonical form of their obligations, so lookups are
+    a single dict access instead of a scan over the search history. Each
+    state stores the best "budget" it has been reached with (remaining
+    depth for DFS, negated path length for the breadth-first strategies);
+    a state reached again with no more budget than before is dominated.
+    """
+    _best_budgets: Dict[Tuple, float]
+    enabled: bool
+    hits: int
+
+    def __init__(self, enabled: bool = True) -> None:
+        self._best_budgets = {}
+        self.enabled = enabled
+        self.hits = 0
+
+    @staticmethod
+    def canonical_key(context: ProofContext) -> Tuple:
+        def obligations_key(obligations: List[Obligation]) -> Tuple:
+            return tuple((tuple(sorted(obl.hypotheses)), obl.goal)
+                         for obl in obligations)
+        return (obligations_key(context.fg_goals),
+                obligations_key(context.bg_goals),
+                obligations_key(context.shelved_goals))
+
+    def check_and_record(self, context: ProofContext, budget: float) -> bool:
+        """
+        Returns True if the state has already been reached with at least this
+        much budget, in which case it shouldn't be expanded again. Otherwise
+        records the new budget for the state and returns False.
+        """
+        if not self.enabled:
+            return False
+        key = self.canonical_key(context)
+        best_budget = self._best_budgets.get(key)
+        if best_budget is not None and best_budget >= budget:
+            self.hits += 1
+            return True
+        self._best_budgets[key] = budget
+        return False
+
+    def __len__(self) -> int:
+        return len(self._best_budgets)
+
+
 def numNodesInTree(branching_factor: int, depth: int):
     assert depth > 0, f"depth is {depth}"
     result = int((branching_factor ** depth - 1) /
@@ -344,6 +397,7 @@ def dfs_proof_search_with_graph(lemma_name: str,
                                 -> SearchResult:
     g = SearchGraph(args.tactics_file, args.tokens_file, lemma_name,
                     args.features_json)
+    transpositions = TranspositionTable(args.transposition_table)
 
     def cleanupSearch(num_stmts: int, msg: Optional[str] = None):
         if msg:
@@ -362,7 +416,7 @@ def dfs_proof_search_with_graph(lemma_name: str,
         full_context_before = FullContext(relevant_lemmas,
                                           coq.prev_tactics,
                                           unwrap(coq.proof_context))
-        predictions = predictor.predictKTactics(
+        predictions = predictor.predictKTactics_cached(
             truncate_tactic_context(full_context_before.as_tcontext(),
                                     args.max_term_length),
                     args.max_attempts,
@@ -441,6 +495,16 @@ def dfs_proof_search_with_graph(lemma_name: str,
                     g.setNodeColor(predictionNode, "orange4")
                     cleanupSearch(num_stmts,
                                   "resulting context has too big a goal")
+                elif transpositions.check_and_record(
+                        context_after,
+                        args.search_depth + new_extra_depth
+                        - len(current_path)):
+                    if not args.count_softfail_predictions:
+                        num_successful_predictions -= 1
+                    g.setNodeColor(predictionNode, "orange3")
+                    cleanupSearch(num_stmts,
+                                  "resulting context was already searched "
+                                  "in another branch")
                 elif len(current_path) < args.search_depth + new_extra_depth \
                         and len(current_path) < args.hard_depth_limit \
                         and (args.max_steps is None or
@@ -535,7 +599,13 @@ def completed_proof(coq: coq_serapy.SerapiInstance) -> bool:
     return False
 
 
-@dataclass
+def goal_fingerprints(context: ProofContext) -> FrozenSet[int]:
+    return frozenset(hash(obl.goal) for obl in context.all_goals)
+
+
+# Nodes are compared by identity, since they're tracked in sets and compared
+# against the frontier, and structural comparison would walk their subtrees.
+@dataclass(eq=False)
 class BFSNode:
     prediction: Prediction
     postfix: List[str]
@@ -545,6 +615,16 @@ class BFSNode:
     previous: Optional["BFSNode"]
     children: List["BFSNode"]
     color: Optional[str]
+    # The context after running this node's prediction and postfix, if it
+    # has been recorded. Lets the frontier be predicted on without first
+    # traversing to each node.
+    context_after: Optional[FullContext]
+    # The number of nodes on the path from the root to this node, inclusive
+    depth: int
+    # Fingerprints of the goals in the context_before of this node and every
+    # node above it (the root has none). Built from the parent's set when the
+    # node is created, so checking the history is a single set lookup.
+    history_fingerprints: FrozenSet[int]
 
     def __init__(self, prediction: Prediction, score: float, time_taken: float,
                  postfix: List[str], context_before: FullContext, previous: Optional["BFSNode"],
@@ -558,9 +638,20 @@ class BFSNode:
         self.children = []
         if self.previous:
             self.previous.children.append(self)
+            self.depth = self.previous.depth + 1
+            self.history_fingerprints = \
+                self.previous.history_fingerprints | \
+                goal_fingerprints(context_before.obligations)
+        else:
+            self.depth = 1
+            self.history_fingerprints = frozenset()
         self.color = color
+        self.context_after = None
         pass
 
+    def history_has_any_goal(self, fingerprints: FrozenSet[int]) -> bool:
+        return not self.history_fingerprints.isdisjoint(fingerprints)
+
     def setNodeColor(self, color: str) -> None:
         assert color
         if self.color != None and self.color != "":
@@ -662,20 +753,33 @@ class BFSNode:
 
 
 def contextInHistory(full_context: ProofContext, node: BFSNode):
+    # A context can only be surjective onto a context that has a goal equal
+    # to each of its goals, so if none of its goals appear anywhere in the
+    # history we can skip the exact check. This is only a filter: a context
+    # with any goal in the history still gets the exact check, whatever
+    # order or duplicates its goals come in.
+    if len(full_context.all_goals) > 0 and \
+       not node.history_has_any_goal(goal_fingerprints(full_context)):
+        return False
     return any([coq_serapy.contextSurjective(full_context,
                                                   n.context_before.obligations)
                 for n in node.path()[1:]])
 
 def get_leaf_descendents(node: BFSNode) -> List[BFSNode]:
-    if len(node.children) == 0:
-        return [node]
-    return [node for nodelist in [get_leaf_descendents(node) for node in node.children]
-            for node in nodelist]
+    leaves = []
+    nodes_to_visit = [node]
+    while len(nodes_to_visit) > 0:
+        next_node = nodes_to_visit.pop()
+        if len(next_node.children) == 0:
+            leaves.append(next_node)
+        else:
+            nodes_to_visit.extend(reversed(next_node.children))
+    return leaves
 
-def get_prunable_nodes(node: BFSNode) -> List[BFSNode]:
+def get_prunable_nodes(node: BFSNode) -> Set[BFSNode]:
     num_closes = len([cmd for cmd in node.postfix if cmd == "}"])
     if num_closes == 0:
-        return []
+        return set()
     num_opens = len([cmd for cmd in node.postfix if cmd == "{"])
     significant_parent = node
     while num_opens < num_closes and significant_parent.previous is not None:
@@ -683,7 +787,7 @@ def get_prunable_nodes(node: BFSNode) -> List[BFSNode]:
         num_closes += len([cmd for cmd in significant_parent.previous.postfix if cmd == "}"])
         significant_parent = significant_parent.previous
 
-    return [leaf for leaf in get_leaf_descendents(significant_parent) if leaf != node]
+    return {leaf for leaf in get_leaf_descendents(significant_parent) if leaf is not node}
 
 def bfs_beam_proof_search(lemma_name: str,
                           module_prefix: str,
@@ -705,6 +809,7 @@ def bfs_beam_proof_search(lemma_name: str,
             john_model = pickle.load(f)
 
     initial_history_len = len(coq.tactic_history.getFullHistory())
+    transpositions = TranspositionTable(args.transposition_table)
     start_node = BFSNode(Prediction(lemma_name, 1.0), 1.0, 0.0, [],
                          FullContext([], [],
                                      ProofContext([], [], [], [])), None)
@@ -742,7 +847,7 @@ def bfs_beam_proof_search(lemma_name: str,
                                                   coq.prev_tactics,
                                                   unwrap(coq.proof_context))
                 num_successful_predictions = 0
-                predictions = predictor.predictKTactics(
+                predictions = predictor.predictKTactics_cached(
                     truncate_tactic_context(full_context_before.as_tcontext(),
                                             args.max_term_length),
                             args.max_attempts,
@@ -773,10 +878,14 @@ def bfs_beam_proof_search(lemma_name: str,
                         prediction_node.setNodeColor("red")
                         continue
                     if contextIsBig(context_after) or \
-                            contextInHistory(context_after, prediction_node):
+                            contextInHistory(context_after, prediction_node) or \
+                            transpositions.check_and_record(
+                                context_after,
+                                -prediction_node.depth):
                         if args.count_softfail_predictions:
                             num_successful_predictions += 1
-                        eprint(f"Prediction in history or too big", guard=args.verbose >= 2)
+                        eprint(f"Prediction in history, already searched, "
+                               "or too big", guard=args.verbose >= 2)
                         prediction_node.setNodeColor("orange")
                         for _ in range(num_stmts):
                             coq.cancel_last()
@@ -853,7 +962,7 @@ def bfs_beam_proof_search(lemma_name: str,
             next_nodes_todo.sort(key=lambda n: n[0].score, reverse=True)
             while len(nodes_todo) < args.beam_width and len(next_nodes_todo) > 0:
                 next_node, subgoal_distance_stack, extra_depth = next_nodes_todo.pop(0)
-                if len(next_node.path()) <= args.search_depth + extra_depth:
+                if next_node.depth <= args.search_depth + extra_depth:
                     nodes_todo.append((next_node, subgoal_distance_stack, extra_depth))
                 else:
                     hasUnexploredNode = True
@@ -870,6 +979,62 @@ class AStarTask:
     node: BFSNode=field(compare=False)
 
 
+def predict_frontier_batch(args: argparse.Namespace,
+                           coq: coq_serapy.SerapiInstance,
+                           relevant_lemmas: List[str],
+                           nodes_todo: List[AStarTask],
+                           initial_history_len: int,
+                           predictor: TacticPredictor) \
+                           -> List[Tuple[AStarTask, List[Prediction]]]:
+    # Only the polyarg predictor (directly or through the prediction server)
+    # can run a batch through the model at once, so fall back to one node at
+    # a time for everything else.
+    if isinstance(predictor, (FeaturesPolyargPredictor, RemotePredictor)):
+        batch_size = args.frontier_batch_size
+    else:
+        batch_size = 1
+    tasks = [heapq.heappop(nodes_todo)
+             for _ in range(min(batch_size, len(nodes_todo)))]
+    contexts: List[TacticContext] = []
+    for task in tasks:
+        if task.node.context_after is None:
+            task.node.traverse_to(coq, initial_history_len)
+            task.node.context_after = FullContext(relevant_lemmas,
+                                                  list(coq.prev_tactics),
+                                                  unwrap(coq.proof_context))
+        contexts.append(truncate_tactic_context(
+            task.node.context_after.as_tcontext(),
+            args.max_term_length))
+    if len(tasks) == 1:
+        prediction_lists = [predictor.predictKTactics_cached(
+            contexts[0], args.max_attempts,
+            blacklist=args.blacklisted_tactics)]
+    else:
+        cache = predictor.prediction_cache
+        prediction_lists_cached: List[Optional[List[Prediction]]]
+        if cache is not None:
+            keys = [PredictionCache.key(context, args.max_attempts,
+                                        args.blacklisted_tactics)
+                    for context in contexts]
+            prediction_lists_cached = [cache.get(key) for key in keys]
+        else:
+            prediction_lists_cached = [None] * len(contexts)
+        uncached_idxs = [idx for idx, preds in enumerate(prediction_lists_cached)
+                         if preds is None]
+        if len(uncached_idxs) > 0:
+            new_prediction_lists = cast(Union[FeaturesPolyargPredictor,
+                                              RemotePredictor], predictor)\
+                .predictKTactics_batch([contexts[idx] for idx in uncached_idxs],
+                                       args.max_attempts,
+                                       blacklist=args.blacklisted_tactics)
+            for idx, preds in zip(uncached_idxs, new_prediction_lists):
+                prediction_lists_cached[idx] = preds
+                if cache is not None:
+                    cache.put(keys[idx], preds)
+        prediction_lists = [unwrap(preds) for preds in prediction_lists_cached]
+    return list(zip(tasks, prediction_lists))
+
+
 def best_first_proof_search(lemma_name: str,
                        module_prefix: Optional[str],
                        relevant_lemmas: List[str],
@@ -885,6 +1050,7 @@ def best_first_proof_search(lemma_name: str,
             john_model = pickle.load(f)
     graph_file = f"{output_dir}/{module_prefix}{lemma_name}.svg"
     initial_history_len = len(coq.tactic_history.getFullHistory())
+    transpositions = TranspositionTable(args.transposition_table)
     start_node = BFSNode(Prediction(lemma_name, 1.0), 1.0, 0.0, [],
                          FullContext([], [],
                                      ProofContext([], [], [], [])), None)
@@ -897,6 +1063,9 @@ def best_first_proof_search(lemma_name: str,
             search_start_node = BFSNode(Prediction(command, 1.0), 1.0, 0.0, [],
                                         full_context_before, search_start_node)
     nodes_todo: List[AStarTask] = [AStarTask(1.0, search_start_node)]
+    # Nodes popped off the frontier in the last batch, along with their
+    # predictions, which haven't been checked in Coq yet.
+    nodes_predicted: List[Tuple[AStarTask, List[Prediction]]] = []
 
     desc_name = lemma_name
     if len(desc_name) > 25:
@@ -906,20 +1075,19 @@ def best_first_proof_search(lemma_name: str,
                        desc=desc_name, disable=(not args.progress),
                        leave=False, position=bar_idx + 1,
                        dynamic_ncols=True, bar_format=mybarfmt):
-        if len(nodes_todo) == 0:
-            break
-        next_node = heapq.heappop(nodes_todo)
+        if len(nodes_predicted) == 0:
+            if len(nodes_todo) == 0:
+                break
+            nodes_predicted = predict_frontier_batch(
+                args, coq, relevant_lemmas, nodes_todo,
+                initial_history_len, predictor)
+        next_node, predictions = nodes_predicted.pop(0)
         next_node.node.traverse_to(coq, initial_history_len)
 
         full_context_before = FullContext(relevant_lemmas,
                                           coq.prev_tactics,
                                           unwrap(coq.proof_context))
         num_successful_predictions = 0
-        predictions = predictor.predictKTactics(
-            truncate_tactic_context(full_context_before.as_tcontext(),
-                                    args.max_term_length),
-            args.max_attempts,
-            blacklist=args.blacklisted_tactics)
 
         for prediction in predictions:
             if num_successful_predictions >= args.search_width:
@@ -945,11 +1113,15 @@ def best_first_proof_search(lemma_name: str,
                     num_successful_predictions += 1
                 prediction_node.setNodeColor("red")
                 continue
-            # Check if we've gone in circles
-            if contextInHistory(context_after, prediction_node):
+            # Check if we've gone in circles, or reached this state from
+            # another branch already
+            if contextInHistory(context_after, prediction_node) or \
+               transpositions.check_and_record(context_after,
+                                               -prediction_node.depth):
                 if args.count_softfail_predictions:
                     num_successful_predictions += 1
-                eprint(f"Prediction in history", guard=args.verbose >= 2)
+                eprint(f"Prediction in history or already searched",
+                       guard=args.verbose >= 2)
                 prediction_node.setNodeColor("orange")
                 for _ in range(num_stmts):
                     coq.cancel_last()
@@ -993,12 +1165,14 @@ def best_first_proof_search(lemma_name: str,
                     h_score /= normcert_score
             if args.search_type == "astar":
                 # Calculate the A* f_score
-                g_score = len(prediction_node.path())
+                g_score = prediction_node.depth
                 score = g_score + h_score
             else:
                 score = h_score
 
             prediction_node.score = score
+            prediction_node.context_after = FullContext(
+                relevant_lemmas, list(coq.prev_tactics), context_after)
 
             # Put our new prediction node in our priority queue
             heapq.heappush(nodes_todo, AStarTask(score, prediction_node))
@@ -1016,10 +1190,13 @@ def best_first_proof_search(lemma_name: str,
                 nodes_todo = [node for node in nodes_todo
                               if node.node not in prunable_nodes]
                 heapq.heapify(nodes_todo)
+                nodes_predicted = [(task, preds) for task, preds
+                                   in nodes_predicted
+                                   if task.node not in prunable_nodes]
                 # Don't run the rest of the predictions at this state
                 break
 
-    hasUnexploredNode = len(nodes_todo) > 0
+    hasUnexploredNode = len(nodes_todo) > 0 or len(nodes_predicted) > 0
     start_node.draw_graph(graph_file)
     if hasUnexploredNode:
         return SearchResult(SearchStatus.INCOMPLETE, relevant_lemmas, None, step)
@@ -6,12 +6,13 @@ import re
 import os
 import traceback
 import json
+import time
 from typing import NamedTuple, Optional, Dict, List, cast, Tuple, Iterable, Iterator, Any
 from pathlib import Path
 
 import coq_serapy
 from coq_serapy.contexts import ProofContext
-from models.tactic_predictor import TacticPredictor
+from models.tactic_predictor import TacticPredictor, PredictionCache
 from search_results import SearchResult, KilledException, SearchStatus, TacticInteraction
 from search_strategies import best_first_proof_search, bfs_beam_proof_search, dfs_proof_search_with_graph, dfs_estimated
 from predict_tactic import (loadPredictorByFile,
@@ -27,6 +28,13 @@ class ReportJob(NamedTuple):
     module_prefix: str
     lemma_statement: str
 
+class LemmaSnapshot(NamedTuple):
+    # The state of a Worker's Coq instance just after a lemma statement,
+    # enough to tell whether cancelling got back to it.
+    history_len: int
+    module_prefix: str
+    context: ProofContext
+
 class Worker:
     args: argparse.Namespace
     widx: int
@@ -40,6 +48,7 @@ class Worker:
     last_program_statement: Optional[str]
     lemmas_encountered: List[ReportJob]
     remaining_commands: List[str]
+    obligation_num: int
     axioms_already_added: bool
 
     def __init__(self, args: argparse.Namespace, worker_idx: int,
@@ -55,7 +64,13 @@ class Worker:
         self.lemmas_encountered: List[ReportJob] = []
         self.remaining_commands: List[str] = []
         self.switch_dict = switch_dict
+        self.obligation_num = 0
         self.axioms_already_added = False
+        if args.prediction_cache_size > 0 and \
+           self.predictor.prediction_cache is None:
+            self.predictor.prediction_cache = PredictionCache(
+                args.prediction_cache_size, args.prediction_cache_file,
+                predictor_id_from_args(args))
 
     def enter_instance(self, filename: str = None) -> None:
         if self.args.backend == 'auto':
@@ -101,6 +116,10 @@ class Worker:
         assert self.coq
         self.coq.kill()
         self.coq = None
+        if self.predictor.prediction_cache is not None:
+            eprint(self.predictor.prediction_cache.summary(),
+                   guard=self.args.verbose >= 1)
+            self.predictor.prediction_cache.save()
 
     def set_switch_from_proj(self) -> None:
         assert self.cur_project
@@ -269,11 +288,10 @@ class Worker:
             # Pop the actual Qed/Defined/Save
             self.remaining_commands.pop(0)
 
-    def run_job(self, job: ReportJob, restart: bool = True) -> SearchResult:
+    def enter_job(self, job: ReportJob, restart: bool) -> None:
         assert self.coq
         self.run_into_job(job, restart, self.args.careful)
         job_project, job_file, job_module, job_lemma = job
-        initial_context: ProofContext = unwrap(self.coq.proof_context)
         if self.args.add_axioms and not self.axioms_already_added:
             self.axioms_already_added = True
             # Cancel the lemma statement so we can run the axiom
@@ -289,10 +307,55 @@ class Worker:
                         eprint(f"Couldn't declare axiom {axiom_name} "
                                f"at this point in the proof")
             self.coq.run_stmt(job_lemma)
+
+    def run_job(self, job: ReportJob, restart: bool = True) -> SearchResult:
+        start_time = time.time()
+        self.enter_job(job, restart)
+        return self.search_job(job, restart)._replace(
+            time_taken=time.time() - start_time)
+
+    def take_lemma_snapshot(self) -> LemmaSnapshot:
+        assert self.coq
+        return LemmaSnapshot(len(self.coq.tactic_history.getFullHistory()),
+                             self.coq.sm_prefix,
+                             unwrap(self.coq.proof_context))
+
+    def rollback_to_snapshot(self, snapshot: LemmaSnapshot) -> bool:
+        """
+        Cancels back to the state a snapshot was taken in, so that
+        recovering from an anomaly doesn't have to restart Coq and replay
+        the file. Returns False if Coq couldn't get back there, in which
+        case it has to be restarted.
+        """
+        assert self.coq
+        try:
+            while len(self.coq.tactic_history.getFullHistory()) > \
+                  snapshot.history_len:
+                self.coq.cancel_last()
+            return len(self.coq.tactic_history.getFullHistory()) == \
+                snapshot.history_len and \
+                self.coq.sm_prefix == snapshot.module_prefix and \
+                self.coq.proof_context == snapshot.context
+        except Exception:
+            # After an anomaly, Coq might fail in any number of ways
+            eprint("Couldn't cancel back to the lemma statement",
+                   guard=self.args.verbose >= 2)
+            return False
+
+    def restart_into_file(self, job_file: str) -> None:
+        self.restart_coq()
+        self.reset_file_state()
+        self.enter_file(job_file)
+
+    def search_job(self, job: ReportJob, restart: bool) -> SearchResult:
+        assert self.coq
+        job_project, job_file, job_module, job_lemma = job
+        initial_context: ProofContext = unwrap(self.coq.proof_context)
         empty_context = ProofContext([], [], [], [])
         context_lemmas = context_lemmas_from_args(self.args, self.coq)
+        snapshot = self.take_lemma_snapshot()
         try:
-            search_status, _, tactic_solution, steps_taken = \
+            search_status, _, tactic_solution, steps_taken, _ = \
               attempt_search(self.args, job_lemma,
                              self.coq.sm_prefix,
                              context_lemmas,
@@ -310,12 +373,17 @@ class Worker:
                     print(f"ANOMALY at {job_file}:{job_lemma}",
                           file=f)
                     traceback.print_exc(file=f)
-            self.restart_coq()
-            self.reset_file_state()
-            self.enter_file(job_file)
+            rolled_back = self.rollback_to_snapshot(snapshot)
             if restart:
-                eprint("Hit an anomaly, restarting job", guard=self.args.verbose >= 2)
-                return self.run_job(job, restart=False)
+                if rolled_back:
+                    eprint("Hit an anomaly, retrying job from the lemma "
+                           "statement", guard=self.args.verbose >= 2)
+                else:
+                    eprint("Hit an anomaly, restarting job",
+                           guard=self.args.verbose >= 2)
+                    self.restart_into_file(job_file)
+                    self.enter_job(job, False)
+                return self.search_job(job, restart=False)
             if self.args.log_hard_anomalies:
                 with self.args.log_hard_anomalies.open('a') as f:
                     print(
@@ -329,6 +397,12 @@ class Worker:
             eprint(f"Skipping job {job_file}:{coq_serapy.lemma_name_from_statement(job_lemma)} "
                    "due to multiple failures",
                    guard=self.args.verbose >= 1)
+            if rolled_back:
+                # Admit the lemma, so the next job in this file carries on
+                # from here.
+                self.finish_job(job)
+            else:
+                self.restart_into_file(job_file)
             return SearchResult(search_status, context_lemmas, solution, 0)
         except Exception:
             eprint(f"FAILED in file {job_file}, lemma {job_lemma}")
@@ -343,14 +417,17 @@ class Worker:
                 + tactic_solution +
                 [TacticInteraction("Qed.", empty_context)])
 
+        self.finish_job(job)
+        return SearchResult(search_status, context_lemmas, solution, steps_taken)
+
+    def finish_job(self, job: ReportJob) -> None:
+        assert self.coq
         while not coq_serapy.ending_proof(self.remaining_commands[0]):
             self.remaining_commands.pop(0)
         # Pop the actual Qed/Defined/Save
         ending_command = self.remaining_commands.pop(0)
-        coq_serapy.admit_proof(self.coq, job_lemma, ending_command)
-
+        coq_serapy.admit_proof(self.coq, job.lemma_statement, ending_command)
         self.lemmas_encountered.append(job)
-        return SearchResult(search_status, context_lemmas, solution, steps_taken)
 
 def get_lemma_declaration_from_name(coq: coq_serapy.SerapiInstance,
                                     lemma_name: str) -> str:
@@ -474,6 +551,12 @@ def get_predictor(args: argparse.Namespace) -> TacticPredictor:
         raise ValueError("Can't load a predictor from given args!")
     return predictor
 
+def predictor_id_from_args(args: argparse.Namespace) -> str:
+    if args.weightsfile:
+        weights_stat = Path(args.weightsfile).stat()
+        return f"{args.weightsfile}:{weights_stat.st_size}:{weights_stat.st_mtime}"
+    return str(args.predictor)
+
 def project_dicts_from_args(args: argparse.Namespace) -> List[Dict[str, Any]]:
     if args.splits_file:
         with Path(args.splits_file).open('r') as f:
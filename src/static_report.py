@@ -18,7 +18,7 @@ from typing import (Any, Union, Optional, Tuple, List, Sequence,
                     cast, TypeVar)
 from pathlib_revised import Path2
 
-from data import file_chunks, filter_data
+from data import read_all_text_data, filter_data
 from context_filter import get_context_filter
 from coq_serapy import get_stem, load_commands_preserve
 import coq_serapy as serapi_instance
@@ -47,20 +47,10 @@ extra_files = details_css + details_javascript + report_css + report_js + ["logo
 
 predictor : TacticPredictor
 
-def read_text_data2_worker__(lines : List[str]) -> MixedDataset:
-    def worker_generator():
-        with io.StringIO("".join(lines)) as f:
-            t = read_tuple(f)
-            while t:
-                yield t
-                t = read_tuple(f)
-    return list(worker_generator())
-
 def read_text_data_singlethreaded(data_path : Path2,
                                   num_threads:Optional[int]=None) -> MixedDataset:
-    line_chunks = file_chunks(data_path, 32768)
     try:
-        yield from itertools.chain.from_iterable((read_text_data2_worker__(chunk) for chunk in line_chunks))
+        yield from read_all_text_data(data_path)
     except:
         print(f"Couldn't parse data in {str(data_path)}")
         raise
@@ -0,0 +1,6 @@
+# The modules under test are imported the same way the scripts in src import
+# each other, so put src on the path.
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
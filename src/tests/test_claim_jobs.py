@@ -0,0 +1,66 @@
+from pathlib import Path
+
+from search_file_cluster_worker import claim_job, claim_jobs
+
+
+def make_claims_dir(tmp_path: Path) -> Path:
+    claims_dir = tmp_path / "claims"
+    claims_dir.mkdir()
+    return claims_dir
+
+
+def test_claim_job_is_exclusive(tmp_path: Path) -> None:
+    claims_dir = make_claims_dir(tmp_path)
+    assert claim_job(claims_dir, 3)
+    assert not claim_job(claims_dir, 3)
+    assert (claims_dir / "3").exists()
+
+
+def test_own_shard_then_steal_from_back(tmp_path: Path) -> None:
+    claims_dir = make_claims_dir(tmp_path)
+    # Shards [0, 3), [3, 5), [5, 6)
+    assert list(claim_jobs(claims_dir, [0, 3, 5, 6], 1)) == \
+        [3, 4, 5, 2, 1, 0]
+
+
+def test_own_shard_skips_claimed_jobs(tmp_path: Path) -> None:
+    claims_dir = make_claims_dir(tmp_path)
+    claim_job(claims_dir, 1)
+    assert list(claim_jobs(claims_dir, [0, 3, 4], 0)) == [0, 2, 3]
+
+
+def test_stealing_stops_at_claimed_job(tmp_path: Path) -> None:
+    claims_dir = make_claims_dir(tmp_path)
+    threads = [claim_jobs(claims_dir, [0, 4, 8], shard) for shard in range(2)]
+    # Thread 0 runs two jobs of its own shard before thread 1 catches up
+    assert next(threads[0]) == 0
+    assert next(threads[0]) == 1
+    assert list(threads[1]) == [4, 5, 6, 7, 3, 2]
+    assert list(threads[0]) == []
+
+
+def test_final_sweep_recovers_jobs_behind_dead_thief(tmp_path: Path) -> None:
+    claims_dir = make_claims_dir(tmp_path)
+    shard_bounds = [0, 4, 5, 6]
+    # The owner of shard 0 never starts, and the first thief to reach it
+    # claims job 3 and then dies.
+    thief = claim_jobs(claims_dir, shard_bounds, 1)
+    assert [next(thief) for _ in range(3)] == [4, 5, 3]
+    assert sorted(claim_jobs(claims_dir, shard_bounds, 2)) == [0, 1, 2]
+
+
+def test_every_job_claimed_once(tmp_path: Path) -> None:
+    claims_dir = make_claims_dir(tmp_path)
+    shard_bounds = [0, 5, 7, 12, 13]
+    threads = [claim_jobs(claims_dir, shard_bounds, shard)
+               for shard in range(4)]
+    claimed = []
+    # Interleave the threads one job at a time
+    while threads:
+        for thread in list(threads):
+            job_idx = next(thread, None)
+            if job_idx is None:
+                threads.remove(thread)
+            else:
+                claimed.append(job_idx)
+    assert sorted(claimed) == list(range(13))
@@ -0,0 +1,143 @@
+import io
+import json
+from pathlib import Path
+from typing import List, Tuple
+
+from coq_serapy.contexts import ScrapedTactic, ProofContext, Obligation
+
+from compact_scrape import (CompactScrapeWriter, copy_scrape, index_path,
+                            is_compact_scrape, read_compact_scrape,
+                            read_compact_index, read_compact_proofs,
+                            COMPACT_SCRAPE_FORMAT, COMPACT_SCRAPE_VERSION)
+
+
+def tactic(prev_tactics: List[str], tac: str, goal: str,
+           hyps: List[str], relevant_lemmas: List[str]) -> ScrapedTactic:
+    return ScrapedTactic(relevant_lemmas, prev_tactics,
+                         ProofContext([Obligation(hyps, goal)], [], [], []),
+                         tac)
+
+
+PROOF = [tactic(["Lemma a : True."], "intros.", "True", [],
+                ["x : nat"]),
+         tactic(["Lemma a : True.", "intros."], "auto.", "True",
+                ["n : nat"], ["x : nat"]),
+         tactic(["Lemma a : True.", "intros.", "auto."], "Qed.", "True",
+                ["n : nat", "m : nat"], ["y : nat"])]
+
+
+def write(commands) -> Tuple[CompactScrapeWriter, str]:
+    out = io.StringIO()
+    writer = CompactScrapeWriter(out)
+    for command in commands:
+        writer.write_command(command)
+    return writer, out.getvalue()
+
+
+def test_writes_deltas() -> None:
+    _, output = write(["Require Import Arith."] + PROOF)
+    lines = [json.loads(line) for line in output.splitlines()]
+    assert lines[0] == {"format": COMPACT_SCRAPE_FORMAT,
+                        "version": COMPACT_SCRAPE_VERSION}
+    assert lines[1] == "Require Import Arith."
+
+    first, second, third = lines[2:]
+    assert first == {"tactic": "intros.", "prev_keep": 0,
+                     "prev_add": ["Lemma a : True."],
+                     "relevant_lemmas": ["x : nat"],
+                     "new_strings": ["True"],
+                     "context": [[[0]], [], [], []]}
+    # Unchanged relevant lemmas and already seen strings are left out
+    assert second == {"tactic": "auto.", "prev_keep": 1,
+                      "prev_add": ["intros."],
+                      "new_strings": ["n : nat"],
+                      "context": [[[0, 1]], [], [], []]}
+    assert third["prev_keep"] == 2
+    assert third["relevant_lemmas"] == ["y : nat"]
+    assert third["new_strings"] == ["m : nat"]
+    assert third["context"] == [[[0, 1, 2]], [], [], []]
+
+
+def test_vernac_starts_a_new_proof() -> None:
+    _, output = write(PROOF[:2] + ["Definition x := 1."] + PROOF[:1])
+    lines = [json.loads(line) for line in output.splitlines()]
+    # After the vernacular, strings are interned from scratch again
+    assert lines[4]["prev_keep"] == 0
+    assert lines[4]["new_strings"] == ["True"]
+    assert lines[4]["relevant_lemmas"] == ["x : nat"]
+
+
+def test_proof_offsets(tmp_path: Path) -> None:
+    writer, output = write(["Require Import Arith."] + PROOF +
+                           ["Definition x := 1."] + PROOF[:2])
+    assert [num_tactics for _, num_tactics in writer.proof_offsets] == [3, 2]
+    data = output.encode("utf-8")
+    for offset, _ in writer.proof_offsets:
+        line = data[offset:data.index(b"\n", offset)]
+        assert json.loads(line)["prev_keep"] == 0
+
+    scrape_path = tmp_path / "a.scrape"
+    writer.write_index(index_path(scrape_path))
+    with (tmp_path / "a.scrape.index").open('r') as f:
+        index = json.load(f)
+    assert index["proofs"] == [list(offset)
+                               for offset in writer.proof_offsets]
+
+
+def test_copy_scrape_matches_writer(tmp_path: Path) -> None:
+    commands = ["Require Import Arith."] + PROOF
+    scrape_path = tmp_path / "a.v.scrape"
+    with scrape_path.open('w') as f:
+        for command in commands:
+            if isinstance(command, ScrapedTactic):
+                print(json.dumps(
+                    {"relevant_lemmas": command.relevant_lemmas,
+                     "prev_tactics": command.prev_tactics,
+                     "context": {
+                         "fg_goals": [{"hypotheses": obl.hypotheses,
+                                       "goal": obl.goal}
+                                      for obl in command.context.fg_goals],
+                         "bg_goals": [], "shelved_goals": [],
+                         "given_up_goals": []},
+                     "tactic": command.tactic}), file=f)
+            else:
+                print(json.dumps(command), file=f)
+    out = io.StringIO()
+    with scrape_path.open('r') as f:
+        copy_scrape(f, CompactScrapeWriter(out))
+    assert out.getvalue() == write(commands)[1]
+
+
+def write_scrape(tmp_path: Path, commands) -> Path:
+    writer, output = write(commands)
+    scrape_path = tmp_path / "a.scrape"
+    scrape_path.write_text(output)
+    writer.write_index(index_path(scrape_path))
+    return scrape_path
+
+
+def test_read_compact_scrape_round_trips(tmp_path: Path) -> None:
+    commands = ["Require Import Arith."] + PROOF + \
+        ["Definition x := 1."] + PROOF[:2]
+    scrape_path = write_scrape(tmp_path, commands)
+    assert is_compact_scrape(scrape_path)
+    assert list(read_compact_scrape(scrape_path)) == commands
+
+
+def test_read_compact_proofs_by_offset(tmp_path: Path) -> None:
+    scrape_path = write_scrape(tmp_path, ["Require Import Arith."] + PROOF +
+                               ["Definition x := 1."] + PROOF[:2])
+    proofs = read_compact_index(scrape_path)
+    assert proofs is not None
+    assert [num_tactics for _, num_tactics in proofs] == [3, 2]
+    assert read_compact_proofs(scrape_path, proofs[1:]) == PROOF[:2]
+    assert read_compact_proofs(scrape_path, proofs) == PROOF + PROOF[:2]
+
+
+def test_missing_index(tmp_path: Path) -> None:
+    scrape_path = write_scrape(tmp_path, PROOF)
+    index_path(scrape_path).unlink()
+    assert read_compact_index(scrape_path) is None
+    plain_path = tmp_path / "a.v.scrape"
+    plain_path.write_text(json.dumps("Require Import Arith.") + "\n")
+    assert not is_compact_scrape(plain_path)
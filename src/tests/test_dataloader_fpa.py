@@ -0,0 +1,74 @@
+import json
+import pickle
+from pathlib import Path
+from typing import List
+
+import pytest
+
+dataloader = pytest.importorskip("dataloader")
+
+HYPS = ["n : nat", "H : n = 0"]
+GOAL = "n + 0 = n"
+TACTICS = ["induction n.", "rewrite H.", "reflexivity."]
+
+
+def scraped_tactic(prev_tactics: List[str], tactic: str) -> str:
+    return json.dumps({"relevant_lemmas": [],
+                       "prev_tactics": prev_tactics,
+                       "context": {"fg_goals": [{"hypotheses": HYPS,
+                                                 "goal": GOAL}],
+                                   "bg_goals": [],
+                                   "shelved_goals": [],
+                                   "given_up_goals": []},
+                       "tactic": tactic})
+
+
+def fpa_args(tmp_path: Path) -> "dataloader.DataloaderArgs":
+    keywords = tmp_path / "tokens.txt"
+    keywords.write_text("n\nnat\n=\n+\n0\n")
+    args = dataloader.DataloaderArgs()
+    args.max_length = 30
+    args.max_string_distance = 50
+    args.max_premises = 20
+    args.num_keywords = 10
+    args.num_relevance_samples = 10
+    args.keywords_file = str(keywords)
+    args.context_filter = "all"
+    return args
+
+
+def metadata_handle(tmp_path: Path, args) -> "dataloader.FPAMetadataHandle":
+    scrape = tmp_path / "scrape.json"
+    lines = [json.dumps("Lemma add_zero : forall n, n + 0 = n.")]
+    for i, tactic in enumerate(TACTICS):
+        lines.append(scraped_tactic(TACTICS[:i], tactic))
+    scrape.write_text("\n".join(lines) + "\n")
+    metadata, _, _ = dataloader.features_polyarg_tensors(args, str(scrape))
+    return dataloader.FPAMetadataHandle(metadata)
+
+
+def test_encoded_actions_decode_to_the_same_tactics(tmp_path: Path) -> None:
+    args = fpa_args(tmp_path)
+    handle = metadata_handle(tmp_path, args)
+    actions = [("induction", "n."), ("rewrite", "H."), ("reflexivity", ".")]
+    encoded = dataloader.encode_fpa_actions(args, handle, HYPS, GOAL, actions)
+    assert all(arg_idx is not None for _, arg_idx in encoded)
+    decoded = dataloader.decode_fpa_results(
+        args, handle, HYPS, GOAL,
+        [(stem_idx, arg_idx) for stem_idx, arg_idx in encoded])
+    assert decoded == TACTICS
+    assert decoded == [dataloader.decode_fpa_result(args, handle, HYPS, GOAL,
+                                                    stem_idx, arg_idx)
+                       for stem_idx, arg_idx in encoded]
+
+
+def test_handles_survive_pickling(tmp_path: Path) -> None:
+    args = fpa_args(tmp_path)
+    handle = metadata_handle(tmp_path, args)
+    copy = pickle.loads(pickle.dumps(handle))
+    assert dataloader.get_all_tactics(copy) == \
+        dataloader.get_all_tactics(handle)
+    assert dataloader.encode_fpa_actions(args, copy, HYPS, GOAL,
+                                         [("rewrite", "H.")]) == \
+        dataloader.encode_fpa_actions(args, handle, HYPS, GOAL,
+                                      [("rewrite", "H.")])
@@ -0,0 +1,107 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import pytest
+
+from job_costs import (JobCostModel, rank, correlation, read_proofs_files,
+                       DEFAULT_SECONDS_PER_STEP, DEFAULT_SECONDS_PER_CHAR)
+from search_worker import ReportJob
+
+
+def job(filename: str, lemma: str) -> ReportJob:
+    return ReportJob(".", filename, "", lemma)
+
+
+def result(steps: int, time_taken=None) -> Dict:
+    return {"status": "SUCCESS", "steps_taken": steps,
+            "time_taken": time_taken}
+
+
+def test_rank_averages_ties() -> None:
+    assert rank([]) == []
+    assert rank([3.0, 1.0, 2.0]) == [2.0, 0.0, 1.0]
+    assert rank([5.0, 1.0, 5.0, 5.0]) == [2.0, 0.0, 2.0, 2.0]
+    assert rank([2.0, 2.0, 1.0, 3.0]) == [1.5, 1.5, 0.0, 3.0]
+
+
+def test_rank_correlation_with_ties() -> None:
+    # Two jobs that took the same time shouldn't count against a
+    # prediction that gets their order "wrong".
+    predicted = [1.0, 2.0, 3.0, 4.0]
+    actual = [10.0, 10.0, 30.0, 40.0]
+    assert correlation(rank(predicted), rank(actual)) == \
+        pytest.approx(correlation(rank(predicted), rank([20.0, 20.0, 30.0,
+                                                         40.0])))
+    assert correlation(rank(actual), rank(actual)) == pytest.approx(1.0)
+
+
+def test_correlation_degenerate() -> None:
+    assert correlation([1.0], [2.0]) is None
+    assert correlation([1.0, 1.0], [1.0, 2.0]) is None
+    assert correlation([1.0, 2.0, 3.0], [3.0, 2.0, 1.0]) == \
+        pytest.approx(-1.0)
+
+
+def test_estimate_fallbacks() -> None:
+    model = JobCostModel([(job("A.v", "Lemma a1 : True."), result(4, 8.0)),
+                          (job("A.v", "Lemma a2 : True."), result(2, 4.0)),
+                          (job("B.v", "Lemma b1 : True."), result(3))])
+    assert model.seconds_per_step == 2.0
+    # Known jobs use their own cost, untimed ones their steps
+    assert model.estimate(job("A.v", "Lemma a1 : True.")) == 8.0
+    assert model.estimate(job("B.v", "Lemma b1 : True.")) == 6.0
+    # New jobs in a known file get the file's mean
+    assert model.estimate(job("A.v", "Lemma a3 : True.")) == 6.0
+    # New jobs in a new file go by statement length
+    statement = "Lemma c1 : True."
+    assert model.estimate(job("C.v", statement)) == \
+        pytest.approx(len(statement) * model.seconds_per_char)
+
+
+def test_empty_history_uses_defaults() -> None:
+    model = JobCostModel([])
+    assert model.seconds_per_step == DEFAULT_SECONDS_PER_STEP
+    assert model.seconds_per_char == DEFAULT_SECONDS_PER_CHAR
+
+
+def costed_model(costs: List[Tuple[ReportJob, float]]) -> JobCostModel:
+    return JobCostModel([(job, result(1, cost)) for job, cost in costs])
+
+
+def test_split_group_keeps_runs_contiguous() -> None:
+    jobs = [job("A.v", f"Lemma a{i} : True.") for i in range(5)]
+    model = costed_model(list(zip(jobs, [3.0, 3.0, 3.0, 3.0, 3.0])))
+    assert model.split_group(jobs, 100.0) == [jobs]
+    assert model.split_group(jobs, 6.0) == [jobs[0:2], jobs[2:4], jobs[4:]]
+    # A single job bigger than the limit still gets a run
+    assert model.split_group(jobs[:2], 1.0) == [jobs[0:1], jobs[1:2]]
+
+
+def test_order_and_assign_balance_shards() -> None:
+    a_jobs = [job("A.v", f"Lemma a{i} : True.") for i in range(4)]
+    b_jobs = [job("B.v", "Lemma b0 : True.")]
+    c_jobs = [job("C.v", "Lemma c0 : True.")]
+    model = costed_model([(j, 5.0) for j in a_jobs] +
+                         [(b_jobs[0], 8.0), (c_jobs[0], 2.0)])
+    ordered = model.order_groups([c_jobs, a_jobs, b_jobs], 1)
+    assert ordered == [a_jobs, b_jobs, c_jobs]
+
+    # A.v is more than a fair share of two workers, so it's split
+    ordered = model.order_groups([c_jobs, a_jobs, b_jobs], 2)
+    assert ordered == [a_jobs[:3], b_jobs, a_jobs[3:], c_jobs]
+
+    shards = model.assign_shards([c_jobs, a_jobs, b_jobs], 2)
+    assert sorted(model.group_cost(shard) for shard in shards) == \
+        [15.0, 15.0]
+    assert sorted(j for shard in shards for j in shard) == \
+        sorted(a_jobs + b_jobs + c_jobs)
+
+
+def test_read_proofs_files_skips_partial_lines(tmp_path: Path) -> None:
+    (tmp_path / "proj").mkdir()
+    a1 = job("A.v", "Lemma a1 : True.")
+    with (tmp_path / "proj" / "A-proofs.txt").open('w') as f:
+        f.write(json.dumps((a1, result(2, 1.5))) + "\n")
+        f.write(json.dumps((job("A.v", "Lemma a2 : True."), result(1)))[:30])
+    assert list(read_proofs_files(tmp_path)) == [(a1, result(2, 1.5))]
@@ -0,0 +1,116 @@
+from pathlib import Path
+
+from coq_serapy.contexts import TacticContext
+
+from models.tactic_predictor import (PredictionCache, Prediction,
+                                     TacticPredictor)
+
+
+def context(goal: str) -> TacticContext:
+    return TacticContext([], ["intros."], ["n : nat"], goal)
+
+
+PREDICTIONS = [Prediction("auto.", 0.75), Prediction("lia.", 0.25)]
+
+
+def test_key_depends_on_request() -> None:
+    key = PredictionCache.key(context("n = n"), 2, None)
+    assert key == PredictionCache.key(context("n = n"), 2, [])
+    assert key != PredictionCache.key(context("n = m"), 2, None)
+    assert key != PredictionCache.key(context("n = n"), 3, None)
+    assert key != PredictionCache.key(context("n = n"), 2, ["auto."])
+    assert PredictionCache.key(context("n = n"), 2, ["a.", "b."]) == \
+        PredictionCache.key(context("n = n"), 2, ["b.", "a."])
+
+
+def test_lru_eviction_and_stats() -> None:
+    cache = PredictionCache(2)
+    cache.put("a", PREDICTIONS)
+    cache.put("b", PREDICTIONS[:1])
+    assert cache.get("a") == PREDICTIONS
+    cache.put("c", PREDICTIONS)
+    # "b" was the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == PREDICTIONS
+    assert cache.get("c") == PREDICTIONS
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert cache.hit_rate == 0.75
+
+
+def test_get_returns_a_copy() -> None:
+    cache = PredictionCache(2)
+    cache.put("a", PREDICTIONS)
+    cache.get("a").append(Prediction("trivial.", 0.0))
+    assert cache.get("a") == PREDICTIONS
+
+
+def test_save_and_load(tmp_path: Path) -> None:
+    cache_file = tmp_path / "predictions.cache"
+    cache = PredictionCache(10, cache_file, "model-a")
+    cache.put("a", PREDICTIONS)
+    cache.save()
+
+    loaded = PredictionCache(10, cache_file, "model-a")
+    assert loaded.get("a") == PREDICTIONS
+    assert all(isinstance(p, Prediction) for p in loaded.get("a"))
+    # Caches from a different model aren't used
+    assert PredictionCache(10, cache_file, "model-b").get("a") is None
+
+
+def test_save_merges_with_other_workers(tmp_path: Path) -> None:
+    cache_file = tmp_path / "predictions.cache"
+    first = PredictionCache(10, cache_file, "model-a")
+    second = PredictionCache(10, cache_file, "model-a")
+    first.put("a", PREDICTIONS)
+    first.put("shared", PREDICTIONS[:1])
+    first.save()
+    second.put("b", PREDICTIONS)
+    second.put("shared", PREDICTIONS[1:])
+    second.save()
+
+    loaded = PredictionCache(10, cache_file, "model-a")
+    assert loaded.get("a") == PREDICTIONS
+    assert loaded.get("b") == PREDICTIONS
+    assert loaded.get("shared") == PREDICTIONS[1:]
+
+
+def test_save_keeps_most_recent_entries(tmp_path: Path) -> None:
+    cache_file = tmp_path / "predictions.cache"
+    cache = PredictionCache(2, cache_file, "model-a")
+    for key in ["a", "b", "c"]:
+        cache.put(key, PREDICTIONS)
+    cache.save()
+    loaded = PredictionCache(2, cache_file, "model-a")
+    assert loaded.get("a") is None
+    assert loaded.get("c") == PREDICTIONS
+
+
+class CountingPredictor(TacticPredictor):
+    def __init__(self) -> None:
+        super().__init__()
+        self.num_calls = 0
+
+    def predictKTactics(self, in_data, k, blacklist=None):
+        self.num_calls += 1
+        return PREDICTIONS[:k]
+
+    def predictKTacticsWithLoss(self, in_data, k, correct):
+        raise NotImplementedError
+
+    def predictKTacticsWithLoss_batch(self, in_data, k, correct):
+        raise NotImplementedError
+
+    def getOptions(self):
+        return []
+
+
+def test_predictor_uses_cache() -> None:
+    predictor = CountingPredictor()
+    assert predictor.predictKTactics_cached(context("n = n"), 2) == \
+        PREDICTIONS
+    predictor.prediction_cache = PredictionCache(10)
+    for _ in range(3):
+        assert predictor.predictKTactics_cached(context("n = n"), 2) == \
+            PREDICTIONS
+    predictor.predictKTactics_cached(context("n = n"), 1)
+    assert predictor.num_calls == 3
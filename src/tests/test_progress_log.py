@@ -0,0 +1,108 @@
+import json
+import time
+from pathlib import Path
+
+from progress_log import ProgressLog, ProgressMonitor, events_path
+from search_worker import ReportJob
+
+JOB = ReportJob(".", "A.v", "A.", "Lemma a : True.")
+OTHER_JOB = ReportJob(".", "A.v", "A.", "Lemma b : True.")
+
+
+def test_monitor_counts_done_jobs(tmp_path: Path) -> None:
+    monitor = ProgressMonitor(tmp_path)
+    assert monitor.poll() == 0
+    with ProgressLog(tmp_path, 0, 1, heartbeat_interval=60) as log:
+        log.log("job_start", JOB)
+        assert monitor.poll() == 0
+        assert monitor.threads[(0, 1)].current_job == JOB
+        log.log("job_done", JOB)
+    assert monitor.poll() == 1
+    assert monitor.jobs_done == {JOB}
+    assert monitor.workers_started == {0}
+    assert monitor.threads[(0, 1)].exited
+    assert monitor.threads[(0, 1)].current_job is None
+
+
+def test_monitor_waits_for_complete_lines(tmp_path: Path) -> None:
+    line = json.dumps({"time": 0, "worker": 0, "thread": 0,
+                       "event": "job_done", "job": JOB})
+    with events_path(tmp_path).open('w') as f:
+        f.write(line[:10])
+    monitor = ProgressMonitor(tmp_path)
+    assert monitor.poll() == 0
+    with events_path(tmp_path).open('a') as f:
+        f.write(line[10:] + "\n")
+    assert monitor.poll() == 1
+
+
+def test_jobs_done_before_are_not_recounted(tmp_path: Path) -> None:
+    monitor = ProgressMonitor(tmp_path, {JOB})
+    with ProgressLog(tmp_path, 0, 0, heartbeat_interval=60) as log:
+        log.log("job_done", JOB)
+        log.log("job_done", OTHER_JOB)
+    assert monitor.poll() == 1
+
+
+def test_stalled_threads(tmp_path: Path) -> None:
+    monitor = ProgressMonitor(tmp_path)
+    with ProgressLog(tmp_path, 0, 0, heartbeat_interval=60):
+        pass
+    log = ProgressLog(tmp_path, 1, 0, heartbeat_interval=60)
+    log.log("start")
+    log.log("job_start", JOB)
+    monitor.poll()
+    assert monitor.stalled_threads(60) == []
+    assert monitor.num_threads_running(60) == 1
+    monitor.threads[(1, 0)].last_seen -= 120
+    # Threads that exited cleanly are never stalled
+    assert monitor.stalled_threads(60) == [(1, 0)]
+    assert monitor.num_threads_running(60) == 0
+
+
+def test_heartbeats_report_job_time(tmp_path: Path) -> None:
+    monitor = ProgressMonitor(tmp_path)
+    log = ProgressLog(tmp_path, 0, 0, heartbeat_interval=60)
+    log.log("start")
+    log.log("job_start", JOB)
+    monitor.poll()
+    assert monitor.overdue_jobs(100) == []
+    # A worker stuck in a job keeps sending heartbeats, which carry how
+    # long the job has been running.
+    log._job_start_time = time.time() - 500
+    log.log("heartbeat")
+    monitor.poll()
+    assert monitor.stalled_threads(60) == []
+    overdue = monitor.overdue_jobs(100)
+    assert [(thread_id, job) for thread_id, job, _ in overdue] == \
+        [((0, 0), JOB)]
+    assert overdue[0][2] >= 500
+    log.log("job_done", JOB)
+    monitor.poll()
+    assert monitor.overdue_jobs(100) == []
+
+
+def test_heartbeat_thread(tmp_path: Path) -> None:
+    with ProgressLog(tmp_path, 0, 0, heartbeat_interval=0.01):
+        time.sleep(0.1)
+    with events_path(tmp_path).open('r') as f:
+        events = [json.loads(line)["event"] for line in f]
+    assert events[0] == "start"
+    assert events[-1] == "exit"
+    assert "heartbeat" in events
+
+
+def test_jobs_done_outside_the_log(tmp_path: Path) -> None:
+    monitor = ProgressMonitor(tmp_path)
+    log = ProgressLog(tmp_path, 0, 0, heartbeat_interval=60)
+    log.log("start")
+    log.log("job_start", JOB)
+    monitor.poll()
+    # The worker wrote its result for JOB, but was killed before it could
+    # log job_done.
+    assert monitor.add_done_jobs([JOB]) == 1
+    assert monitor.jobs_done == {JOB}
+    assert monitor.threads[(0, 0)].current_job is None
+    assert monitor.add_done_jobs([JOB]) == 0
+    log.log("job_done", JOB)
+    assert monitor.poll() == 0
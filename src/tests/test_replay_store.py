@@ -0,0 +1,91 @@
+import random
+from pathlib import Path
+
+from coq_serapy.contexts import ProofContext
+
+from replay_store import ReplayStore, RECORD_HEADER
+from rgraph import LabeledTransition
+
+
+def transition(action: str) -> LabeledTransition:
+    return LabeledTransition([], ["Lemma a : True."],
+                             ProofContext([], [], [], []),
+                             ProofContext([], [], [], []),
+                             action, 0.5, 1.0, None)
+
+
+def actions(store: ReplayStore):
+    return sorted(sample.action for sample in store.samples)
+
+
+def test_reload_after_inserts_and_evictions(tmp_path: Path) -> None:
+    random.seed(0)
+    store = ReplayStore(tmp_path / "replay")
+    for i in range(20):
+        store.insert(transition(f"tac{i}."))
+    store.evict_random(5)
+    store.flush()
+    assert len(store) == 15
+    kept = actions(store)
+    store.close()
+
+    reloaded = ReplayStore(tmp_path / "replay")
+    assert actions(reloaded) == kept
+    # New samples after a reload don't reuse ids from before it
+    reloaded.insert(transition("new."))
+    reloaded.evict_random(3)
+    reloaded.close()
+    assert actions(ReplayStore(tmp_path / "replay")) == actions(reloaded)
+
+
+def test_insert_drops_graph_node(tmp_path: Path) -> None:
+    store = ReplayStore(tmp_path / "replay")
+    sample = transition("auto.")
+    sample.graph_node = object()
+    store.insert(sample)
+    assert store.samples[0].graph_node is None
+    store.close()
+
+
+def test_segments_roll_over(tmp_path: Path) -> None:
+    store = ReplayStore(tmp_path / "replay", segment_size=1)
+    for i in range(4):
+        store.insert(transition(f"tac{i}."))
+    store.close()
+    assert len(list((tmp_path / "replay").glob("segment-*.bin"))) == 4
+    assert actions(ReplayStore(tmp_path / "replay")) == \
+        ["tac0.", "tac1.", "tac2.", "tac3."]
+
+
+def test_compact_keeps_live_samples(tmp_path: Path) -> None:
+    random.seed(1)
+    store = ReplayStore(tmp_path / "replay", segment_size=1)
+    for i in range(10):
+        store.insert(transition(f"tac{i}."))
+    store.evict_random(6)
+    kept = actions(store)
+    store.compact()
+    segments = list((tmp_path / "replay").glob("segment-*.bin"))
+    assert len(segments) == 1
+    store.insert(transition("after."))
+    store.close()
+    assert actions(ReplayStore(tmp_path / "replay")) == \
+        sorted(kept + ["after."])
+
+
+def test_truncated_record_is_ignored(tmp_path: Path) -> None:
+    store = ReplayStore(tmp_path / "replay")
+    for i in range(3):
+        store.insert(transition(f"tac{i}."))
+    store.close()
+    segment_path, = (tmp_path / "replay").glob("segment-*.bin")
+    data = segment_path.read_bytes()
+    segment_path.write_bytes(data[:-(RECORD_HEADER.size // 2 + 1)])
+
+    reloaded = ReplayStore(tmp_path / "replay")
+    assert actions(reloaded) == ["tac0.", "tac1."]
+    # Later writes go to a new segment, after the truncated one
+    reloaded.insert(transition("tac3."))
+    reloaded.close()
+    assert actions(ReplayStore(tmp_path / "replay")) == \
+        ["tac0.", "tac1.", "tac3."]
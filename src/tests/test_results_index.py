@@ -0,0 +1,126 @@
+import argparse
+import json
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from results_index import ResultsIndex, RESULTS_INDEX_FILE
+from search_worker import ReportJob
+
+
+def make_args(tmp_path: Path) -> argparse.Namespace:
+    output_dir = tmp_path / "output"
+    (output_dir / ".").mkdir(parents=True)
+    return argparse.Namespace(output_dir=output_dir, splits_file=None,
+                              filenames=[Path("A.v"), Path("B.v")])
+
+
+def job(filename: str, lemma: str) -> ReportJob:
+    return ReportJob(".", filename, "", f"Lemma {lemma} : True.")
+
+
+def proofs_file(args: argparse.Namespace, filename: str) -> Path:
+    return args.output_dir / "." / (Path(filename).stem + "-proofs.txt")
+
+
+def append_results(args: argparse.Namespace, jobs: List[ReportJob],
+                   tail: str = "") -> None:
+    for filename in {job.filename for job in jobs}:
+        with proofs_file(args, filename).open('a') as f:
+            for job in jobs:
+                if job.filename == filename:
+                    f.write(json.dumps((job, {"status": "SUCCESS",
+                                              "steps_taken": 3})) + "\n")
+            f.write(tail)
+
+
+def test_update_reads_only_new_results(tmp_path: Path) -> None:
+    args = make_args(tmp_path)
+    index = ResultsIndex(args)
+    assert index.update() == 0
+    append_results(args, [job("A.v", "a1"), job("B.v", "b1")])
+    assert index.update() == 2
+    append_results(args, [job("A.v", "a2")])
+    assert index.update() == 1
+    assert index.update() == 0
+    assert job("A.v", "a2") in index
+    assert index.jobs() == [job("A.v", "a1"), job("A.v", "a2"),
+                            job("B.v", "b1")]
+
+
+def test_partial_line_waits_for_next_update(tmp_path: Path) -> None:
+    args = make_args(tmp_path)
+    line = json.dumps((job("A.v", "a1"), {"status": "SUCCESS"}))
+    with proofs_file(args, "A.v").open('w') as f:
+        f.write(line[:20])
+    index = ResultsIndex(args)
+    assert index.update() == 0
+    with proofs_file(args, "A.v").open('a') as f:
+        f.write(line[20:] + "\n")
+    assert index.update() == 1
+
+
+def test_saved_index_is_reused(tmp_path: Path) -> None:
+    args = make_args(tmp_path)
+    append_results(args, [job("A.v", "a1"), job("A.v", "a2")])
+    index = ResultsIndex(args)
+    index.update()
+    index.save()
+    assert (args.output_dir / RESULTS_INDEX_FILE).exists()
+
+    loaded = ResultsIndex(args)
+    assert len(loaded) == 2
+    assert loaded.update() == 0
+    append_results(args, [job("A.v", "a3")])
+    assert loaded.update() == 1
+    assert len(loaded) == 3
+
+
+def test_replaced_file_is_reread(tmp_path: Path) -> None:
+    args = make_args(tmp_path)
+    append_results(args, [job("A.v", "a1"), job("A.v", "a2")])
+    index = ResultsIndex(args)
+    index.update()
+    proofs_file(args, "A.v").unlink()
+    append_results(args, [job("A.v", "a3")])
+    assert index.update() == -1
+    assert index.jobs() == [job("A.v", "a3")]
+
+
+def test_removed_file_is_forgotten(tmp_path: Path) -> None:
+    args = make_args(tmp_path)
+    append_results(args, [job("A.v", "a1"), job("B.v", "b1")])
+    index = ResultsIndex(args)
+    index.update()
+    proofs_file(args, "B.v").unlink()
+    index.update()
+    assert index.jobs() == [job("A.v", "a1")]
+
+
+def test_duplicates_are_removed(tmp_path: Path) -> None:
+    args = make_args(tmp_path)
+    append_results(args, [job("A.v", "a1"), job("A.v", "a2")])
+    index = ResultsIndex(args)
+    assert index.update() == 2
+    append_results(args, [job("A.v", "a1"), job("A.v", "a3")])
+    assert index.update() == 1
+    assert index.jobs() == [job("A.v", "a1"), job("A.v", "a2"),
+                            job("A.v", "a3")]
+    with proofs_file(args, "A.v").open('r') as f:
+        assert len(f.readlines()) == 3
+
+
+def test_bad_line_reports_its_line_number(
+        tmp_path: Path, capsys: pytest.CaptureFixture) -> None:
+    args = make_args(tmp_path)
+    append_results(args, [job("A.v", "a1"), job("A.v", "a2")], tail="\n")
+    index = ResultsIndex(args)
+    index.update()
+    index.save()
+    index = ResultsIndex(args)
+    with proofs_file(args, "A.v").open('a') as f:
+        f.write("[[\n")
+    with pytest.raises(json.decoder.JSONDecodeError):
+        index.update()
+    assert "On line 4 " in capsys.readouterr().out
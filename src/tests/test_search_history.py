@@ -0,0 +1,31 @@
+from coq_serapy.contexts import FullContext, ProofContext, Obligation
+
+from models.tactic_predictor import Prediction
+from search_strategies import BFSNode, goal_fingerprints
+
+
+def context(*goals: str) -> ProofContext:
+    return ProofContext([Obligation([], goal) for goal in goals], [], [], [])
+
+
+def child(parent: BFSNode, *goals: str) -> BFSNode:
+    return BFSNode(Prediction("auto.", 1.0), 1.0, 0.0, [],
+                   FullContext([], [], context(*goals)), parent)
+
+
+def test_history_fingerprints_are_inherited() -> None:
+    root = BFSNode(Prediction("a", 1.0), 1.0, 0.0, [],
+                   FullContext([], [], context()), None)
+    assert root.history_fingerprints == frozenset()
+    first = child(root, "A", "B")
+    second = child(first, "C")
+    sibling = child(first, "D")
+
+    assert second.history_fingerprints == goal_fingerprints(
+        context("A", "B", "C"))
+    assert second.history_has_any_goal(goal_fingerprints(context("A")))
+    assert second.history_has_any_goal(goal_fingerprints(context("E", "C")))
+    assert not second.history_has_any_goal(goal_fingerprints(context("D")))
+    assert sibling.history_has_any_goal(goal_fingerprints(context("D")))
+    # Adding a child doesn't change what its parent has seen
+    assert not first.history_has_any_goal(goal_fingerprints(context("C")))
@@ -0,0 +1,140 @@
+import argparse
+from pathlib import Path
+from typing import List
+
+import pytest
+
+import coq_serapy
+from coq_serapy.contexts import ProofContext, Obligation
+
+import search_worker
+from search_results import SearchResult, SearchStatus
+from search_worker import Worker, ReportJob
+
+JOB = ReportJob(".", "A.v", "", "Lemma a : True.")
+LEMMA_CONTEXT = ProofContext([Obligation([], "True")], [], [], [])
+
+
+class TacticHistory:
+    def __init__(self, tactics: List[str]) -> None:
+        self.tactics = tactics
+
+    def getFullHistory(self) -> List[str]:
+        return list(self.tactics)
+
+
+class CoqAtLemma:
+    """
+    Just enough of a Coq instance sitting at JOB's lemma statement to
+    run searches and cancel them.
+    """
+    def __init__(self, cancel_fails: bool = False) -> None:
+        self.tactics: List[str] = []
+        self.tactic_history = TacticHistory(self.tactics)
+        self.sm_prefix = ""
+        self.local_lemmas = ["a : True"]
+        self.cancel_fails = cancel_fails
+        self.prev_tactics = [JOB.lemma_statement]
+
+    @property
+    def proof_context(self) -> ProofContext:
+        if self.tactics[-1:] == ["exact I."]:
+            return ProofContext([], [], [], [])
+        return LEMMA_CONTEXT
+
+    def run_stmt(self, stmt: str) -> None:
+        self.tactics.append(stmt)
+
+    def cancel_last(self) -> None:
+        if self.cancel_fails:
+            raise coq_serapy.CoqAnomaly("cancel")
+        self.tactics.pop()
+
+
+def make_worker(coq: CoqAtLemma) -> Worker:
+    args = argparse.Namespace(prediction_cache_size=0, hardfail=False,
+                              log_anomalies=None, log_hard_anomalies=None,
+                              add_env_lemmas=None, relevant_lemmas="local",
+                              careful=False, add_axioms=None,
+                              output_dir=Path("."), verbose=0)
+    worker = Worker(args, 0, None)
+    worker.coq = coq
+    worker.cur_project = "."
+    worker.cur_file = "A.v"
+    worker.remaining_commands = ["exact I.", "Qed.", "Lemma b : True."]
+    return worker
+
+
+@pytest.fixture
+def admitted(monkeypatch: pytest.MonkeyPatch) -> List[str]:
+    admitted: List[str] = []
+    monkeypatch.setattr(coq_serapy, "admit_proof",
+                        lambda coq, lemma, ending: admitted.append(lemma))
+    return admitted
+
+
+def searches(monkeypatch: pytest.MonkeyPatch, num_anomalies: int) -> None:
+    calls = 0
+
+    def attempt_search(args, lemma, module, context_lemmas, coq, *rest):
+        nonlocal calls
+        calls += 1
+        coq.run_stmt("Proof.")
+        if calls <= num_anomalies:
+            coq.run_stmt("intros.")
+            raise coq_serapy.CoqAnomaly("search")
+        coq.run_stmt("exact I.")
+        return SearchResult(SearchStatus.SUCCESS, context_lemmas, [], 1)
+    monkeypatch.setattr(search_worker, "attempt_search", attempt_search)
+
+
+def no_restarts(worker: Worker) -> None:
+    def restart_into_file(job_file: str) -> None:
+        raise AssertionError("Restarted Coq")
+    worker.restart_into_file = restart_into_file  # type: ignore
+
+
+def test_anomaly_retries_from_lemma(monkeypatch: pytest.MonkeyPatch,
+                                    admitted: List[str]) -> None:
+    searches(monkeypatch, 1)
+    worker = make_worker(CoqAtLemma())
+    no_restarts(worker)
+    result = worker.search_job(JOB, restart=True)
+    assert result.status == SearchStatus.SUCCESS
+    assert worker.coq.tactics == ["Proof.", "exact I."]
+    assert admitted == [JOB.lemma_statement]
+    assert worker.remaining_commands == ["Lemma b : True."]
+    assert worker.lemmas_encountered == [JOB]
+
+
+def test_repeated_anomaly_skips_job(monkeypatch: pytest.MonkeyPatch,
+                                    admitted: List[str]) -> None:
+    searches(monkeypatch, 2)
+    worker = make_worker(CoqAtLemma())
+    no_restarts(worker)
+    result = worker.search_job(JOB, restart=True)
+    assert result.status == SearchStatus.CRASHED
+    # The worker is still in the file, past the lemma
+    assert worker.coq.tactics == []
+    assert admitted == [JOB.lemma_statement]
+    assert worker.lemmas_encountered == [JOB]
+
+
+def test_restarts_when_cancelling_fails(monkeypatch: pytest.MonkeyPatch,
+                                        admitted: List[str]) -> None:
+    searches(monkeypatch, 1)
+    worker = make_worker(CoqAtLemma(cancel_fails=True))
+    restarted: List[str] = []
+    entered: List[ReportJob] = []
+
+    def restart_into_file(job_file: str) -> None:
+        restarted.append(job_file)
+        worker.coq = CoqAtLemma()
+        worker.remaining_commands = ["exact I.", "Qed."]
+    monkeypatch.setattr(worker, "restart_into_file", restart_into_file)
+    monkeypatch.setattr(worker, "enter_job",
+                        lambda job, restart: entered.append(job))
+    result = worker.search_job(JOB, restart=True)
+    assert result.status == SearchStatus.SUCCESS
+    assert restarted == ["A.v"]
+    assert entered == [JOB]
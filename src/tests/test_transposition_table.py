@@ -0,0 +1,50 @@
+from coq_serapy.contexts import ProofContext, Obligation
+
+from search_strategies import TranspositionTable
+
+
+def state(*goals: str, hyps=("n : nat", "m : nat"), bg=()) -> ProofContext:
+    return ProofContext([Obligation(list(hyps), goal) for goal in goals],
+                        [Obligation([], goal) for goal in bg], [], [])
+
+
+def test_keys_ignore_hypothesis_order() -> None:
+    assert TranspositionTable.canonical_key(state("n = m")) == \
+        TranspositionTable.canonical_key(state("n = m",
+                                               hyps=("m : nat", "n : nat")))
+    assert TranspositionTable.canonical_key(state("n = m")) != \
+        TranspositionTable.canonical_key(state("m = n"))
+    # Goal order matters, since tactics act on the first goal
+    assert TranspositionTable.canonical_key(state("A", "B")) != \
+        TranspositionTable.canonical_key(state("B", "A"))
+    assert TranspositionTable.canonical_key(state("A", bg=["B"])) != \
+        TranspositionTable.canonical_key(state("A", "B"))
+
+
+def test_dominated_states_are_pruned() -> None:
+    table = TranspositionTable()
+    assert not table.check_and_record(state("n = m"), 3)
+    assert table.check_and_record(state("n = m"), 3)
+    assert table.check_and_record(state("n = m"), 2)
+    # Reaching it with more budget searches it again, and raises the bar
+    assert not table.check_and_record(state("n = m"), 5)
+    assert table.check_and_record(state("n = m"), 4)
+    assert not table.check_and_record(state("m = n"), 1)
+    assert table.hits == 3
+    assert len(table) == 2
+
+
+def test_negative_budgets() -> None:
+    # The breadth-first strategies use negated path lengths
+    table = TranspositionTable()
+    assert not table.check_and_record(state("A"), -4)
+    assert not table.check_and_record(state("A"), -2)
+    assert table.check_and_record(state("A"), -3)
+
+
+def test_disabled_table_records_nothing() -> None:
+    table = TranspositionTable(enabled=False)
+    assert not table.check_and_record(state("A"), 1)
+    assert not table.check_and_record(state("A"), 1)
+    assert len(table) == 0
+    assert table.hits == 0